@@ -1,7 +1,7 @@
 #!/usr/local/bin/python
-from collections import defaultdict
-import math
+from collections import OrderedDict
 import argparse
+from helpers import get_log_odds, format_log_odds
 
 
 # Dan Jurafsky March 22 2013
@@ -9,6 +9,8 @@ import argparse
 # Computes the "weighted log-odds-ratio, informative dirichlet prior" algorithm for 
 # from page 388 of 
 # Monroe, Colaresi, and Quinn. 2009. "Fightin' Words: Lexical Feature Selection and Evaluation for Identifying the Content of Political Conflict"
+# The computation itself is helpers.get_log_odds, which can be called directly
+# on count arrays; this script computes it from count files.
 
 # assumes all 3 input files are space-separated, two columns, frequency followed by word
 #1371056 the
@@ -22,42 +24,31 @@ parser = argparse.ArgumentParser(description='Computes the weighted log-odds-rat
 parser.add_argument('-f','--first', help='Description for first counts file ', default='greatreviews.out')
 parser.add_argument('-s','--second', help='Description for second counts file', default='badreviews.out')
 parser.add_argument('-p','--prior', help='Description for prior counts file', default='allreviewwords.out')
-args = vars(parser.parse_args())
-
-counts1 = defaultdict(int,[myswap(line.strip().split(' ')) for line in open(args['first'])])
-counts2 = defaultdict(int,[myswap(line.strip().split(' ')) for line in open(args['second'])])
-prior = defaultdict(int,[myswap(line.strip().split(' ')) for line in open(args['prior'])])
-sigmasquared = defaultdict(float)
-sigma = defaultdict(float)
-delta = defaultdict(float)
-
-for word in prior.keys():
-    prior[word] = int(prior[word] + 0.5)
-
-for word in counts2.keys():
-    counts1[word] = int(counts1[word] + 0.5)
-    if prior[word] == 0:
-        prior[word] = 1
-
-for word in counts1.keys():
-    counts2[word] = int(counts2[word] + 0.5)
-    if prior[word] == 0:
-        prior[word] = 1
-
-n1  = sum(counts1.values())
-n2  = sum(counts2.values())
-nprior = sum(prior.values())
-
-
-for word in prior.keys():
-    #if prior[word] == 0 and (counts2[word] > 10):
-        #prior[word] = 1
-    if prior[word] > 0:
-        l1 = float(counts1[word] + prior[word]) / (( n1 + nprior ) - (counts1[word] + prior[word]))
-        l2 = float(counts2[word] + prior[word]) / (( n2 + nprior ) - (counts2[word] + prior[word]))
-        sigmasquared[word] =  1/(float(counts1[word]) + float(prior[word])) + 1/(float(counts2[word]) + float(prior[word]))
-        sigma[word] =  math.sqrt(sigmasquared[word])
-        delta[word] = ( math.log(l1) - math.log(l2) ) / sigma[word]
-
-for word in sorted(delta, key=delta.get):
-    print(word, "%.3f" % delta[word])
\ No newline at end of file
+
+def read_counts(filename):
+    return OrderedDict([myswap(line.strip().split(' ')) for line in open(filename)])
+
+def main():
+    args = vars(parser.parse_args())
+    counts1 = read_counts(args['first'])
+    counts2 = read_counts(args['second'])
+    prior = read_counts(args['prior'])
+
+    # words in either counts file get a prior count of at least 1
+    vocab = list(prior)
+    for word in list(counts2) + list(counts1):
+        if word not in prior:
+            prior[word] = 0
+            vocab.append(word)
+    in_groups = set(counts1) | set(counts2)
+    prior_counts = [1 if w in in_groups and int(prior[w] + 0.5) == 0 else prior[w]
+                    for w in vocab]
+
+    scores = get_log_odds([counts1.get(w, 0) for w in vocab],
+                          [counts2.get(w, 0) for w in vocab],
+                          prior_counts)
+    for line in format_log_odds(vocab, scores):
+        print(line)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Compares the per-sentence cost of TextCleaner with the implementation of
+clean_text that it replaced, and checks that both return the same tokens.
+
+Run from the root of the repository:
+python -m benchmarks.clean_text --input_dir data/coref_resolved_txts --stem
+'''
+import argparse
+import re
+import time
+from helpers import *
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--input_dir', required=True, help="Directory of input text files.")
+parser.add_argument('--max_sentences', default=100000, type=int, help="Number of sentences to time.")
+parser.add_argument('--stem', action='store_true', help="Whether to stem words.")
+
+def reference_clean_text(text,
+                         remove_stopwords=True,
+                         remove_numeric=True,
+                         stem=False,
+                         remove_short=True,
+                         stopwords_file="wordlists/stopwords/en/mallet.txt"):
+    '''
+    clean_text as it was before TextCleaner.
+    '''
+    text = text.lower()
+    text = re.sub(r'http\S*|\S*\.com\S*|\S*www\S*', ' ', text)
+    text = replace.sub(' ', text)
+    text = re.sub(r'\s+', ' ', text)
+    text = text.strip()
+    text = ''.join([c for c in text if c in printable])
+    words = text.split()
+    if remove_stopwords:
+        stopwords = open(stopwords_file, "r").read().splitlines()
+        words = [w for w in words if w not in stopwords]
+    if remove_numeric:
+        words = [w for w in words if not w.isdigit()]
+    if stem:
+        words = [sno.stem(w) for w in words]
+    if remove_short:
+        words = [w for w in words if len(w) >= 3]
+    return words
+
+def get_sentences(input_dir, max_sentences):
+    sentences = []
+    for title, lines in get_book_txts(input_dir, splitlines=True).items():
+        for line in lines:
+            sentences.extend(nltk.sent_tokenize(line))
+            if len(sentences) >= max_sentences:
+                return sentences[:max_sentences]
+    return sentences
+
+def main():
+    args = parser.parse_args()
+    sentences = get_sentences(args.input_dir, args.max_sentences)
+
+    start = time.perf_counter()
+    expected = [reference_clean_text(s, stem=args.stem) for s in sentences]
+    reference_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    cleaner = TextCleaner(stem=args.stem)
+    result = list(cleaner.clean_many(sentences))
+    cleaner_time = time.perf_counter() - start
+
+    assert result == expected, "TextCleaner and clean_text disagree"
+    n = len(sentences)
+    print("%d sentences" % n)
+    print("reference clean_text: %.2f us/sentence" % (reference_time / n * 1e6))
+    print("TextCleaner:          %.2f us/sentence" % (cleaner_time / n * 1e6))
+    print("speedup:              %.1fx" % (reference_time / cleaner_time))
+
+if __name__ == '__main__':
+    main()
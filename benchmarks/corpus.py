@@ -0,0 +1,172 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Generates synthetic textbooks to benchmark the pipeline on.
+
+Each book is a .txt file of lines, where most lines are paragraphs of a few
+sentences and some are short headings. Sentences mix stopwords, content words
+with Zipf-like frequencies, years, the people terms of
+wordlists/people_terms.csv (sometimes marked, e.g. "black farmers") and the
+names of wordlists/famous_people.txt, so that every stage has something to
+find. The words and phrases of the embedding queries (wordlists/liwc_queries.json,
+woman_terms.txt and man_terms.txt) are among the more common content words, so
+that they are in the vocabulary of the word vectors. The same arguments always
+give the same books.
+
+Run from the root of the repository:
+python -m benchmarks.corpus --output_dir cache/benchmarks/corpus --num_books 3 --lines_per_book 10000
+'''
+import argparse
+import json
+import os
+import random
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--output_dir', required=True, help="Directory for the generated .txt files.")
+parser.add_argument('--num_books', default=3, type=int)
+parser.add_argument('--lines_per_book', default=10000, type=int)
+parser.add_argument('--vocab_size', default=20000, type=int, help="Number of distinct content words.")
+parser.add_argument('--seed', default=0, type=int)
+
+SYLLABLES = ['ka', 'lo', 'mi', 'ra', 'te', 'su', 'no', 'vi', 'de', 'pa', 'ri', 'go',
+             'an', 'el', 'or', 'un', 'is', 'ba', 'ce', 'fu', 'ho', 'ly', 'ne', 'tor']
+VERBS = ['fought', 'led', 'helped', 'built', 'wrote', 'worked', 'opposed', 'supported',
+         'was elected', 'was defeated', 'freed', 'founded', 'argued', 'traveled', 'ruled']
+HEADING_WORDS = ['Chapter', 'Section', 'Lesson', 'Unit', 'Review']
+QUERY_FILES = ['wordlists/liwc_queries.json', 'wordlists/woman_terms.txt', 'wordlists/man_terms.txt']
+
+def read_query_phrases(paths):
+    '''
+    Words and phrases of the groups of a .json dictionary file (see
+    word2vec_calculate_similarity.py), or of the lines of a text file.
+    '''
+    phrases = []
+    for path in paths:
+        with open(path, 'r') as infile:
+            if path.endswith('.json'):
+                new_phrases = [p for group in json.load(infile).values() for p in group]
+            else:
+                new_phrases = [line.strip() for line in infile if line.strip()]
+        phrases.extend(p.lower() for p in new_phrases if p.lower() not in phrases)
+    return phrases
+
+class CorpusGenerator:
+    '''
+    @inputs:
+    - people_terms: path of the people terms csv
+    - famous_people: path of a file with one name per line
+    - stopwords_file: path of a file with one stopword per line
+    - query_files: paths of the embedding query files, whose words and phrases
+      are mixed into the vocabulary
+    - vocab_size: number of distinct content words (but at least the query
+      words and phrases)
+    - seed: random seed
+    '''
+    def __init__(self, people_terms='wordlists/people_terms.csv',
+                 famous_people='wordlists/famous_people.txt',
+                 stopwords_file='wordlists/stopwords/en/mallet.txt',
+                 query_files=QUERY_FILES, vocab_size=20000, seed=0):
+        self.rng = random.Random(seed)
+        with open(people_terms, 'r') as infile:
+            rows = [line.strip().split(',') for line in infile if line.strip()]
+        self.terms = sorted({row[0] for row in rows})
+        self.marks = sorted({row[0] for row in rows if len(row) > 2 and row[2] != 'unmarked'
+                             and len(row[0].split()) == 1})
+        self.unmarked = sorted({row[0] for row in rows if len(row) > 2 and row[2] == 'unmarked'})
+        with open(famous_people, 'r') as infile:
+            self.names = [line.strip() for line in infile if line.strip()]
+        with open(stopwords_file, 'r') as infile:
+            self.stopwords = [line.strip() for line in infile if line.strip()]
+        self.vocab = self.make_vocab(vocab_size, read_query_phrases(query_files))
+        # Zipf's law: the frequency of the k-th most common word is proportional to 1/k
+        self.cum_weights = []
+        total = 0.0
+        for k in range(1, len(self.vocab) + 1):
+            total += 1.0 / k
+            self.cum_weights.append(total)
+
+    def make_vocab(self, size, phrases):
+        vocab = []
+        seen = set(phrases)
+        while len(vocab) < size - len(phrases):
+            word = ''.join(self.rng.choice(SYLLABLES) for _ in range(self.rng.randint(2, 4)))
+            if word not in seen:
+                seen.add(word)
+                vocab.append(word)
+        # every 10th word from rank 10 on, frequent enough to get a vector
+        for i, phrase in enumerate(phrases):
+            vocab.insert(min(10 * (i + 1), len(vocab)), phrase)
+        return vocab
+
+    def person(self):
+        r = self.rng.random()
+        if r < 0.4:
+            return self.rng.choice(self.names)
+        if r < 0.6 and self.marks and self.unmarked:
+            return self.rng.choice(self.marks) + ' ' + self.rng.choice(self.unmarked)
+        return self.rng.choice(self.terms)
+
+    def sentence(self):
+        num_words = self.rng.randint(6, 24)
+        content = self.rng.choices(self.vocab, cum_weights=self.cum_weights, k=num_words)
+        words = []
+        for word in content:
+            r = self.rng.random()
+            if r < 0.45:
+                words.append(self.rng.choice(self.stopwords))
+            elif r < 0.47:
+                words.append(str(self.rng.randint(1500, 2020)))
+            words.append(word)
+        # a person doing something, somewhere in the sentence
+        i = self.rng.randint(0, len(words))
+        words[i:i] = [self.person(), self.rng.choice(VERBS)]
+        if self.rng.random() < 0.3:
+            words.extend(['the', self.person()])
+        s = ' '.join(words)
+        return s[0].upper() + s[1:] + '.'
+
+    def line(self):
+        if self.rng.random() < 0.1:
+            return self.rng.choice(HEADING_WORDS) + ' ' + str(self.rng.randint(1, 40)) + ': ' + \
+                ' '.join(w.title() for w in self.rng.choices(self.vocab[:2000], k=self.rng.randint(1, 5)))
+        # paragraphs of 1 to ~10 sentences, mostly 2 to 4
+        num_sentences = min(1 + int(self.rng.expovariate(1 / 2.5)), 12)
+        return ' '.join(self.sentence() for _ in range(num_sentences))
+
+    def write_book(self, path, num_lines):
+        with open(path, 'w', encoding='utf-8') as outfile:
+            for _ in range(num_lines):
+                outfile.write(self.line() + '\n')
+
+def generate_corpus(output_dir, num_books=3, lines_per_book=10000, vocab_size=20000, seed=0):
+    '''
+    Writes book0.txt, book1.txt, ... to output_dir, unless they already exist
+    with these settings.
+    @output:
+    - list of book paths
+    '''
+    os.makedirs(output_dir, exist_ok=True)
+    # books written before a query word was added are written again
+    settings = '%d %d %d %d %s' % (num_books, lines_per_book, vocab_size, seed,
+                                   '|'.join(read_query_phrases(QUERY_FILES)))
+    settings_path = os.path.join(output_dir, 'settings')
+    paths = [os.path.join(output_dir, 'book%d.txt' % i) for i in range(num_books)]
+    if os.path.isfile(settings_path) and all(os.path.isfile(p) for p in paths):
+        with open(settings_path, 'r') as infile:
+            if infile.read() == settings:
+                return paths
+    generator = CorpusGenerator(vocab_size=vocab_size, seed=seed)
+    for path in paths:
+        generator.write_book(path, lines_per_book)
+    with open(settings_path, 'w') as outfile:
+        outfile.write(settings)
+    return paths
+
+def main():
+    args = parser.parse_args()
+    paths = generate_corpus(args.output_dir, args.num_books, args.lines_per_book,
+                            args.vocab_size, args.seed)
+    print("Wrote %d books to %s" % (len(paths), args.output_dir))
+
+if __name__ == '__main__':
+    main()
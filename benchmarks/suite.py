@@ -0,0 +1,179 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Times each stage of the pipeline on synthetic corpora of several sizes.
+
+For every scale (number of lines per book), a corpus is generated with
+benchmarks.corpus, then each stage's script is run on it in a separate
+process. The wall time, throughput and peak memory of each run are appended
+to a JSON-lines results file, tagged with the current commit, so that runs
+on different commits can be compared with --report. A stage that reads the
+output of one that failed (e.g. log_odds after get_descriptors) is skipped.
+
+Peak memory is measured for each process alone with os.wait4, which is only
+available on Unix. Elsewhere, it is the peak of the largest stage run so far
+(or missing without the resource module, as on Windows).
+
+Run from the root of the repository:
+python -m benchmarks.suite --scales 1000,10000
+python -m benchmarks.suite --report
+'''
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import time
+from benchmarks.corpus import generate_corpus
+
+parser = argparse.ArgumentParser()
+parser.add_argument('--scales', default='1000,10000', help="Comma-separated numbers of lines per book.")
+parser.add_argument('--num_books', default=3, type=int)
+parser.add_argument('--stages', default=None, help="Comma-separated stages to run (by default all of them).")
+parser.add_argument('--work_dir', default='cache/benchmarks', help="Directory for corpora and stage outputs.")
+parser.add_argument('--results_file', default='cache/benchmarks/results.jsonl')
+parser.add_argument('--report', action='store_true', help="Print the results file as a table instead of running.")
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def get_stages(corpus_dir, out_dir):
+    '''
+    (name, command, names of the stages whose outputs it reads) for each
+    stage, in the order they are run.
+    '''
+    python = sys.executable
+    descriptors = os.path.join(out_dir, 'people_descriptors.csv')
+    word2vec_dir = os.path.join(out_dir, 'word2vec')
+    return [
+        ('clean_text', [python, 'get_word_counts.py', '--input_dir', corpus_dir,
+                        '--output', os.path.join(out_dir, 'word_counts.txt'), '--stem'], ()),
+        ('count_mentions', [python, 'count_mentions.py', '--input_dir', corpus_dir, '--output_dir', out_dir,
+                            '--people_terms', 'wordlists/people_terms.csv', '--cache_dir', ''], ()),
+        ('get_descriptors', [python, 'get_descriptors.py', '--input_dir', corpus_dir, '--output_dir', out_dir,
+                             '--people_terms', 'wordlists/people_terms.csv', '--cache_dir', ''], ()),
+        ('get_topics_prepare', [python, 'get_topics.py', '--input_dir', corpus_dir,
+                                '--output_dir', os.path.join(out_dir, 'topics'), '--stem', '--prepare_only'], ()),
+        ('log_odds', [python, 'run_log_odds.py', '--input_file', descriptors, '--output_dir', out_dir,
+                      '--group1', 'women', '--group2', 'men,other,other minority,white,black,hispanic/latinx'],
+         ('get_descriptors',)),
+        ('word2vec_train', [python, 'run_word2vec.py', '--input_dir', corpus_dir, '--output_dir', word2vec_dir,
+                            '--num_runs', '2', '--bootstrap', '--workers', '1'], ()),
+        ('embedding_queries', [python, 'word2vec_calculate_similarity.py', '--queries', 'wordlists/liwc_queries.json',
+                               '--words1', 'wordlists/woman_terms.txt', '--words2', 'wordlists/man_terms.txt',
+                               '--word2vec_dir', word2vec_dir,
+                               '--output_file', os.path.join(out_dir, 'word2vec_cosines.csv')],
+         ('word2vec_train',)),
+    ]
+
+def get_commit():
+    try:
+        return subprocess.check_output(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR,
+                                       stderr=subprocess.DEVNULL).decode().strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def get_exit_code(status):
+    # same as os.waitstatus_to_exitcode, which needs Python 3.9
+    if os.WIFSIGNALED(status):
+        return -os.WTERMSIG(status)
+    return os.WEXITSTATUS(status)
+
+def to_mb(maxrss):
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+def get_children_peak_rss_mb():
+    '''
+    Peak resident memory of the largest finished child process in MB, or
+    None without the resource module.
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    return to_mb(resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss)
+
+def run_stage(command, log_path):
+    '''
+    Runs command from the root of the repository.
+    @output:
+    - (exit code, seconds, peak resident memory of the process in MB or None)
+    '''
+    with open(log_path, 'w') as log:
+        start = time.perf_counter()
+        proc = subprocess.Popen(command, cwd=REPO_DIR, stdout=log, stderr=subprocess.STDOUT)
+        if hasattr(os, 'wait4'):
+            # unlike proc.wait(), wait4 gives the resource usage of this process alone
+            _, status, usage = os.wait4(proc.pid, 0)
+            seconds = time.perf_counter() - start
+            proc.returncode = get_exit_code(status)
+            return proc.returncode, seconds, to_mb(usage.ru_maxrss)
+        proc.wait()
+        seconds = time.perf_counter() - start
+    return proc.returncode, seconds, get_children_peak_rss_mb()
+
+def run_scale(lines_per_book, num_books, stage_names, work_dir, results_file, commit):
+    corpus_dir = os.path.abspath(os.path.join(work_dir, 'corpus_%d' % lines_per_book))
+    out_dir = os.path.abspath(os.path.join(work_dir, 'output_%d' % lines_per_book))
+    paths = generate_corpus(corpus_dir, num_books=num_books, lines_per_book=lines_per_book)
+    os.makedirs(out_dir, exist_ok=True)
+    num_lines = num_books * lines_per_book
+    num_bytes = sum(os.path.getsize(p) for p in paths)
+    failed = set()
+    for name, command, needs in get_stages(corpus_dir, out_dir):
+        if stage_names and name not in stage_names:
+            continue
+        if failed.intersection(needs):
+            failed.add(name)
+            print('%-20s skipped, needs %s' % (name, ', '.join(sorted(failed.intersection(needs)))))
+            continue
+        log_path = os.path.join(out_dir, name + '.log')
+        returncode, seconds, peak_rss_mb = run_stage(command, log_path)
+        if returncode != 0:
+            failed.add(name)
+        record = {
+            'commit': commit,
+            'date': datetime.datetime.now().isoformat(timespec='seconds'),
+            'stage': name,
+            'books': num_books,
+            'lines': num_lines,
+            'mb': round(num_bytes / 1e6, 3),
+            'seconds': round(seconds, 3),
+            'lines_per_sec': round(num_lines / seconds, 1),
+            'mb_per_sec': round(num_bytes / 1e6 / seconds, 3),
+            'peak_rss_mb': round(peak_rss_mb, 1) if peak_rss_mb is not None else None,
+            'exit_code': returncode,
+        }
+        with open(results_file, 'a') as outfile:
+            outfile.write(json.dumps(record) + '\n')
+        status = 'ok' if returncode == 0 else 'FAILED (see %s)' % log_path
+        memory = '%8.1f MB' % peak_rss_mb if peak_rss_mb is not None else '%8s MB' % '?'
+        print('%-20s %8d lines %8.2fs %10.1f lines/s %s  %s' % (
+            name, num_lines, seconds, num_lines / seconds, memory, status))
+
+def report(results_file):
+    import pandas as pd
+    df = pd.read_json(results_file, lines=True)
+    df = df[df['exit_code'] == 0]
+    # latest run of each stage, scale and commit
+    df = df.sort_values('date').groupby(['stage', 'lines', 'commit'], sort=False).last().reset_index()
+    for value in ['seconds', 'peak_rss_mb']:
+        print(value)
+        print(df.pivot_table(index=['stage', 'lines'], columns='commit', values=value).to_string())
+        print()
+
+def main():
+    args = parser.parse_args()
+    if args.report:
+        report(args.results_file)
+        return
+    stage_names = set(args.stages.split(',')) if args.stages else None
+    os.makedirs(os.path.dirname(args.results_file) or '.', exist_ok=True)
+    commit = get_commit()
+    for scale in [int(s) for s in args.scales.split(',')]:
+        print('%d books x %d lines' % (args.num_books, scale))
+        run_scale(scale, args.num_books, stage_names, args.work_dir, args.results_file, commit)
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,215 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+c_v topic coherence (Röder et al., 2015), computed from an on-disk index of
+the corpus that is built once and shared by every model scored against it.
+
+gensim's CoherenceModel(coherence='c_v') rescans all texts with a sliding
+window for every model it scores. Here the boolean windows are stored
+instead, as the sorted list of windows each word occurs in, under
+<cache_dir>/<key>/, where the key is a hash of the texts and window size.
+Scoring a topic then only reads the windows of its own words.
+
+As in gensim, each text is split into windows of window_size words (a
+shorter text is one window), word probabilities are the fraction of windows
+they occur in, and each topic is scored by the mean cosine similarity of its
+words' NPMI context vectors with that of the whole topic. Scores are the
+same as gensim's when no text is longer than the window, as with sentences.
+For longer texts they can differ slightly, because gensim updates each
+sliding window incrementally and can drop a word that is still in it.
+
+Example usage:
+index = get_index(all_sentences)
+scores = score_topic_sets(index, [topics_50, topics_100], processes=4)
+'''
+import hashlib
+import json
+import os
+import shutil
+from array import array
+from collections import defaultdict
+from multiprocessing import Pool
+import numpy as np
+from scipy import sparse
+
+WINDOW_SIZE = 110 # gensim's default for c_v
+EPSILON = 1e-12 # as in gensim.topic_coherence
+
+def get_texts_key(texts, window_size):
+    h = hashlib.sha1(str(window_size).encode('ascii'))
+    for text in texts:
+        b = ' '.join(text).encode('utf-8')
+        h.update(str(len(b)).encode('ascii') + b':' + b)
+    return h.hexdigest()[:16]
+
+def encode_texts(texts):
+    '''
+    @output:
+    - tokens: word ids of all texts, one after another
+    - offsets: start of each text in tokens, plus the total length
+    - words: list of words in order of first occurrence
+    '''
+    # a new word gets the next id
+    word2id = defaultdict()
+    word2id.default_factory = word2id.__len__
+    tokens = array('i')
+    offsets = array('q', [0])
+    for text in texts:
+        tokens.extend(map(word2id.__getitem__, text))
+        offsets.append(len(tokens))
+    words = [None] * len(word2id)
+    for w, i in word2id.items():
+        words[i] = w
+    return np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64), words
+
+def get_word_windows(tokens, offsets, num_words, window_size):
+    '''
+    Lists the windows each word occurs in. A text of n > window_size words has
+    n - window_size + 1 windows, one starting at each word; any other text,
+    even an empty one, is a single window.
+    @output:
+    - indptr: the windows of word i are windows[indptr[i]:indptr[i + 1]]
+    - windows: window numbers, sorted for each word
+    - number of windows
+    '''
+    lengths = np.diff(offsets)
+    num_windows = np.maximum(lengths - window_size + 1, 1)
+    first_window = np.concatenate([[0], np.cumsum(num_windows)])
+    # short texts: every token is in the text's only window
+    is_short = np.repeat(lengths <= window_size, lengths)
+    window_ids = [np.repeat(first_window[:-1], lengths)[is_short]]
+    word_ids = [tokens[is_short]]
+    # long texts: the token at position p is in windows p - window_size + 1 to p
+    for i in np.flatnonzero(lengths > window_size):
+        text = tokens[offsets[i]:offsets[i + 1]]
+        positions = np.arange(len(text))
+        for k in range(window_size):
+            starts = positions - k
+            keep = (starts >= 0) & (starts < num_windows[i])
+            window_ids.append(first_window[i] + starts[keep])
+            word_ids.append(text[keep])
+    total = int(first_window[-1])
+    pairs = np.unique(np.concatenate(word_ids).astype(np.int64) * total + np.concatenate(window_ids))
+    words = pairs // total
+    indptr = np.concatenate([[0], np.cumsum(np.bincount(words, minlength=num_words))])
+    dtype = np.int32 if total <= np.iinfo(np.int32).max else np.int64
+    return indptr, (pairs % total).astype(dtype), total
+
+def build_index(texts, path, window_size=WINDOW_SIZE):
+    '''
+    Writes the index of texts (lists of words) to the directory path. It is
+    written to a temporary directory first, so a partial index is never read.
+    '''
+    tokens, offsets, words = encode_texts(texts)
+    indptr, windows, num_windows = get_word_windows(tokens, offsets, len(words), window_size)
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'indptr.npy'), indptr)
+    np.save(os.path.join(tmp_path, 'windows.npy'), windows)
+    with open(os.path.join(tmp_path, 'vocab.txt'), 'w', encoding='utf-8') as outfile:
+        outfile.write('\n'.join(words))
+    with open(os.path.join(tmp_path, 'index.json'), 'w') as outfile:
+        json.dump({'window_size': window_size, 'num_windows': num_windows,
+                   'num_texts': len(offsets) - 1, 'num_tokens': len(tokens)}, outfile)
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def get_index(texts, cache_dir='cache/coherence', window_size=WINDOW_SIZE, key=None):
+    '''
+    The index of texts (lists of words), read from cache_dir if it was
+    built before, or else built and saved there.
+    @inputs:
+    - key: a string identifying the texts (e.g. a hash of the files they
+      come from), so that they are only read if the index is missing;
+      by default, the texts are hashed
+    '''
+    key = '%s-%d' % (key, window_size) if key else get_texts_key(texts, window_size)
+    path = os.path.join(cache_dir, key)
+    if not os.path.isfile(os.path.join(path, 'index.json')):
+        os.makedirs(cache_dir, exist_ok=True)
+        build_index(texts, path, window_size)
+    return CoherenceIndex(path)
+
+class CoherenceIndex:
+    '''
+    An index written by build_index. The window lists are memory-mapped, so
+    worker processes opening the same index share them.
+    '''
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, 'index.json'), 'r') as infile:
+            info = json.load(infile)
+        self.window_size = info['window_size']
+        self.num_windows = info['num_windows']
+        self.num_texts = info['num_texts']
+        self.indptr = np.load(os.path.join(path, 'indptr.npy'), mmap_mode='r')
+        self.windows = np.load(os.path.join(path, 'windows.npy'), mmap_mode='r')
+        with open(os.path.join(path, 'vocab.txt'), 'r', encoding='utf-8') as infile:
+            words = infile.read().split('\n') if len(self.indptr) > 1 else []
+        self.word2id = {w: i for i, w in enumerate(words)}
+
+    def get_cooccurrence(self, words):
+        '''
+        @output:
+        - matrix of the number of windows each pair of words occurs in
+        together, with the number of windows of each word on the diagonal
+        (words that are not in the corpus occur in none)
+        '''
+        rows = []
+        for w in words:
+            i = self.word2id.get(w)
+            if i is None:
+                rows.append(np.array([], dtype=np.int64))
+            else:
+                rows.append(self.windows[self.indptr[i]:self.indptr[i + 1]])
+        indptr = np.concatenate([[0], np.cumsum([len(r) for r in rows])])
+        indices = np.concatenate(rows) if rows else np.array([], dtype=np.int64)
+        occurs = sparse.csr_matrix((np.ones(len(indices)), indices, indptr), shape=(len(words), self.num_windows))
+        return (occurs @ occurs.T).toarray()
+
+    def score_topic(self, words):
+        '''
+        c_v coherence of a topic, given as its top words.
+        '''
+        cooccur = self.get_cooccurrence(words)
+        p = np.diag(cooccur) / self.num_windows
+        p_joint = cooccur / self.num_windows
+        with np.errstate(divide='ignore', invalid='ignore'):
+            npmi = np.log((p_joint + EPSILON) / np.outer(p, p)) / -np.log(p_joint + EPSILON)
+            # each word's context vector against that of the whole topic
+            topic_vector = npmi.sum(axis=0)
+            cosines = npmi @ topic_vector / (np.linalg.norm(npmi, axis=1) * np.linalg.norm(topic_vector))
+        return float(np.mean(cosines))
+
+    def score_topics(self, topics):
+        '''
+        @output:
+        - c_v coherence of each topic
+        '''
+        return [self.score_topic(words) for words in topics]
+
+# the CoherenceIndex of each worker, set by init_worker
+index = None
+
+def init_worker(path):
+    global index
+    index = CoherenceIndex(path)
+
+def score_worker(topics):
+    return index.score_topics(topics)
+
+def score_topic_sets(coherence_index, topic_sets, processes=1):
+    '''
+    Scores several topic sets (e.g. models with different numbers of
+    topics) against one index, one set per worker process.
+    @inputs:
+    - topic_sets: list of lists of topics, each a list of top words
+    @output:
+    - list with the c_v coherence of each topic of each set
+    '''
+    if processes > 1 and len(topic_sets) > 1:
+        with Pool(min(processes, len(topic_sets)), initializer=init_worker,
+                  initargs=(coherence_index.path,)) as pool:
+            return pool.map(score_worker, topic_sets)
+    return [coherence_index.score_topics(topics) for topics in topic_sets]
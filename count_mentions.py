@@ -1,68 +1,127 @@
 import spacy
 from helpers import *
+from doc_cache import get_docs, SHARD_SIZE
 import argparse
 import os
 import codecs
+import itertools
 from collections import Counter
+from multiprocessing import Pool
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True)
 parser.add_argument('--output_dir', required=True)
 parser.add_argument('--people_terms', required=True)
+parser.add_argument('--cache_dir', default='cache/spacy',
+    help="Directory for cached spaCy parses (set to '' to disable).")
+parser.add_argument('--batch_size', default=1000, type=int,
+    help="Number of lines spaCy parses at a time.")
+parser.add_argument('--n_process', default=1, type=int,
+    help="Number of worker processes; books are split into shards of lines across them.")
+parser.add_argument('--metrics_file', default=None,
+    help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
-def update_dict(dem_dict, word2dem, word): 
-    for cat in word2dem[word]: 
+# set in each worker by init_worker
+nlp = None
+possible_marks, not_marks, word2dem = None, None, None
+
+def init_worker(marks, unmarked, w2d):
+    global nlp, possible_marks, not_marks, word2dem
+    nlp = spacy.load("en_core_web_sm")
+    possible_marks, not_marks, word2dem = marks, unmarked, w2d
+
+def update_dict(dem_dict, word2dem, word):
+    for cat in word2dem[word]:
         dem_dict[cat] += 1
     return dem_dict
 
-def main():
-    possible_marks, not_marks = split_terms_into_sets(args.people_terms)
-    word2dem = get_word_to_category(args.people_terms) 
+def count_shard(task):
+    '''
+    Counts mentions of each demographic in a shard of consecutive lines.
+    @inputs:
+    - task: (title, index of the shard's first line, lines of the shard)
+    @output:
+    - title, Counter of demographic : count, and timings and counts from MetricsRecord
+    '''
+    title, start, lines = task
+    dem_dict = Counter() # demographic : count
+    stats = MetricsRecord()
+    docs = get_docs(nlp, lines, title, cache_dir=args.cache_dir, offset=start,
+                    batch_size=args.batch_size, stats=stats)
+    for doc in stats.timed(docs, rest='python'):
+        stats.count('lines')
+        stats.count('tokens', len(doc))
+        prev_word = None
+        for token in doc:
+            word = token.text.lower()
+            if word == 'democrat':
+                print(prev_word, word)
+            # only look at nouns
+            if token.pos_ != 'PROPN' and \
+                token.pos_ != 'NOUN' and token.pos_ != 'PRON': continue
+            if word in possible_marks:
+                #dem_dict[word2dem[word]] += 1
+                update_dict(dem_dict, word2dem, word)
+                if prev_word in possible_marks:
+                    # count previous word as well
+                    # e.g. "black women"
+                    #dem_dict[word2dem[prev_word]] += 1
+                    update_dict(dem_dict, word2dem, prev_word)
+            elif word in not_marks:
+                if prev_word not in possible_marks:
+                    #dem_dict[word2dem[word]] += 1
+                    update_dict(dem_dict, word2dem, word)
+                else:
+                    # count previous word but not unmarked word
+                    #dem_dict[word2dem[prev_word]] += 1
+                    update_dict(dem_dict, word2dem, prev_word)
+            prev_word = word
+    return title, dem_dict, stats.get_stats()
 
-    # load spacy
-    nlp = spacy.load("en_core_web_sm")
+def get_shards(books):
+    for title, book in books.items():
+        for i, lines in book.chunks(SHARD_SIZE):
+            yield title, i, lines
+
+def write_counts(f, title, dem_dict):
+    for demographic in dem_dict:
+        f.write(title + ',' + demographic + ',' + str(dem_dict[demographic]) + '\n')
+
+def main():
+    metrics = Metrics(args.metrics_file)
+    marks_and_terms = split_terms_into_sets(args.people_terms) + \
+        (get_word_to_category(args.people_terms),)
 
     # load books
-    books = get_book_txts(args.input_dir, splitlines=True)
+    books = get_books(args.input_dir)
 
     print('Counting groups of people...')
     os.makedirs(args.output_dir, exist_ok=True)
+    pool = None
+    if args.n_process > 1:
+        pool = Pool(args.n_process, initializer=init_worker, initargs=marks_and_terms)
+        results = bounded_imap(pool, count_shard, get_shards(books), 4 * args.n_process)
+    else:
+        init_worker(*marks_and_terms)
+        results = map(count_shard, get_shards(books))
     with codecs.open(os.path.join(args.output_dir, 'people_mentions.csv'), 'w', encoding='utf-8') as f:
-        for title, textbook_lines in books.items():
+        # shards come back in order, so merging them keeps each book's
+        # demographics in order of first mention
+        for title, shards in itertools.groupby(results, key=lambda result: result[0]):
             print(title)
-            dem_dict = Counter() # demographic : count
-            for line in textbook_lines:
-                doc = nlp(line)
-                prev_word = None
-                for token in doc: 
-                    word = token.text.lower()
-                    if word == 'democrat': 
-                        print(prev_word, word)
-                    # only look at nouns
-                    if token.pos_ != 'PROPN' and \
-                        token.pos_ != 'NOUN' and token.pos_ != 'PRON': continue
-                    if word in possible_marks:
-                        #dem_dict[word2dem[word]] += 1
-                        update_dict(dem_dict, word2dem, word)
-                        if prev_word in possible_marks:
-                            # count previous word as well
-                            # e.g. "black women"
-                            #dem_dict[word2dem[prev_word]] += 1
-                            update_dict(dem_dict, word2dem, prev_word)
-                    elif word in not_marks:
-                        if prev_word not in possible_marks: 
-                            #dem_dict[word2dem[word]] += 1
-                            update_dict(dem_dict, word2dem, word)
-                        else: 
-                            # count previous word but not unmarked word
-                            #dem_dict[word2dem[prev_word]] += 1
-                            update_dict(dem_dict, word2dem, prev_word)
-                    prev_word = word
-            for demographic in dem_dict: 
-                f.write(title + ',' + demographic + ',' + str(dem_dict[demographic]) + '\n')
+            with metrics.record('book', title=title) as record:
+                dem_dict = Counter()
+                for _, shard_dict, shard_stats in shards:
+                    dem_dict.update(shard_dict)
+                    record.update(shard_stats)
+                write_counts(f, title, dem_dict)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    metrics.close(n_process=args.n_process)
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
@@ -19,11 +19,12 @@ the most recent full name related to it.
 import argparse
 from helpers import *
 import os
-import urllib.parse
-from urllib.request import urlopen
+from array import array
 from collections import Counter
 import spacy
 import json
+from doc_cache import get_docs
+from wikidata import WIKIDATA_ENDPOINT, WikidataLookup, clean_entity, get_endpoint
 
 parser = argparse.ArgumentParser()
 
@@ -32,91 +33,169 @@ parser.add_argument('--ner_dir', required=True)
 parser.add_argument('--output_dir', required=True)
 parser.add_argument('--redo_intermediates', default=False, 
     help='True/False: calculate famous_people and full2wikiname.json.')
+parser.add_argument('--full2wikiname', default='results/full2wikiname.json',
+    help="JSON file of Wikidata names for each full name, reused across runs.")
+parser.add_argument('--famous_people', default='wordlists/famous_people',
+    help="File to save the 100 most mentioned people to, read by get_descriptors.py.")
+parser.add_argument('--cache_dir', default='cache/spacy',
+    help="Directory for cached spaCy parses (set to '' to disable).")
+parser.add_argument('--endpoint', default=WIKIDATA_ENDPOINT,
+    help="SPARQL endpoint, or a JSON file of canned answers to run offline (see wikidata.py).")
+parser.add_argument('--wikidata_cache', default='results/wikidata_cache.sqlite',
+    help="SQLite file caching Wikidata answers across runs.")
+parser.add_argument('--max_requests', default=4, type=int,
+    help="Number of Wikidata queries sent at the same time.")
+parser.add_argument('--metrics_file', default=None,
+    help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
-def get_official_name(entity): 
-    entity = entity.replace("\"", "").replace("—", "").replace("\\","")
+def get_query_name(entity): 
+    entity = clean_entity(entity)
     if entity.endswith("'s"):  # Remove possessives
         entity = entity[:-2]
     entity = entity.split(",")[0] # Only consider what's before commas
     entity = entity.strip()
-    url_prefix = "https://query.wikidata.org/sparql?format=json&query="
-    query = urllib.parse.quote("SELECT ?item ?itemLabel WHERE {" + \
-    "?item wdt:P31 wd:Q5." + \
-    "?item ?label \"" + entity + "\"@en ." + \
-    "SERVICE wikibase:label { bd:serviceParam wikibase:language \"en\". }" + \
-    "}", safe='')
-    url = url_prefix + query
-    res = json.loads(urlopen(url).read())
-    cands = []
-    if len(res['results']['bindings']) > 0:
-        for i in range(len(res['results']['bindings'])): 
-            wikiID = res['results']['bindings'][i]['item']['value'].split('/')[-1]
-            name = res['results']['bindings'][i]['itemLabel']['value'].split('/')[-1]
-            cands.append((name, wikiID)) 
-    return cands
-
-def get_full2wikiname_and_famous_people(books, nlp, redo=args.redo_intermediates): 
-    if redo or not os.path.isfile('./results/full2wikiname.json') or \
-        not os.path.isfile('./wordlists/famous_people'): 
-        if os.path.isfile('./results/full2wikiname.json'): 
-            with open('./results/full2wikiname.json', 'r') as infile: 
+    return entity
+
+def get_official_names(entities, lookup): 
+    '''
+    Maps each entity to its Wikidata name, or to itself when Wikidata
+    has no or more than one match (we do not match ambiguous terms).
+    '''
+    names = {entity: get_query_name(entity) for entity in entities}
+    cands = lookup.find_people(names.values())
+    official_names = {}
+    for entity, name in names.items(): 
+        if len(cands[name]) == 1: 
+            official_names[entity] = cands[name][0][0]
+        else: 
+            official_names[entity] = entity
+    return official_names
+
+def get_person_spans(nlp, title, textbook_lines, record): 
+    '''
+    Runs NER once and keeps where each person entity is.
+    @inputs:
+    - record: MetricsRecord for the book
+    @output:
+    - array of (line index, start char, end char), flattened
+    '''
+    spans = array('q')
+    docs = get_docs(nlp, textbook_lines, title, cache_dir=args.cache_dir, stats=record)
+    for i, doc in enumerate(record.timed(docs, rest='python')): 
+        record.count('lines')
+        record.count('tokens', len(doc))
+        for ent in doc.ents: 
+            if (ent.label_ == 'PERSON' and not ent.text[0].isdigit()): 
+                spans.extend((i, ent.start_char, ent.end_char))
+    record.count('person_entities', len(spans) // 3)
+    return spans
+
+def get_person_ents(textbook_lines, spans): 
+    '''
+    Yields each line with the (start char, end char, text) of its person entities,
+    without parsing the line again.
+    '''
+    j = 0
+    for i, line in enumerate(textbook_lines): 
+        ents = []
+        while j < len(spans) and spans[j] == i: 
+            start, end = spans[j + 1], spans[j + 2]
+            ents.append((start, end, line[start:end]))
+            j += 3
+        yield line, ents
+
+def replace_spans(line, replacements): 
+    '''
+    @inputs:
+    - replacements: list of (start char, end char, new text), in order and not overlapping
+    '''
+    pieces = []
+    prev_end = 0
+    for start, end, new_text in replacements: 
+        pieces.append(line[prev_end:start])
+        pieces.append(new_text)
+        prev_end = end
+    pieces.append(line[prev_end:])
+    return ''.join(pieces)
+
+def get_full2wikiname_and_famous_people(books, person_spans, metrics, redo=args.redo_intermediates): 
+    if redo or not os.path.isfile(args.full2wikiname) or \
+        not os.path.isfile(args.famous_people): 
+        if os.path.isfile(args.full2wikiname): 
+            with open(args.full2wikiname, 'r') as infile: 
                 full2wikiname = json.load(infile)
         else: 
             full2wikiname = {}
         
-        famous_counter = Counter()
         print("Getting wikidata aliases and most common people...")
+        # look up all new multi-word names at once
+        new_entities = {}
         for title, textbook_lines in books.items():
-            print(title)
-            for line in textbook_lines: 
-                doc = nlp(line)
-                for ent in doc.ents: 
-                    if (ent.label_ == 'PERSON' and not ent.text[0].isdigit()): 
-                        curr_entity = ent.text
-                        if ent.text in full2wikiname: 
-                            curr_entity = full2wikiname[ent.text]
-                        elif ent.text not in full2wikiname and len(ent.text.split()) > 1: 
-                            cands = get_official_name(ent.text)
-                            if len(cands) == 1: 
-                                full2wikiname[ent.text] = cands[0][0]
-                            else: 
-                                # do not match ambiguous terms
-                                full2wikiname[ent.text] = ent.text
-                            curr_entity = full2wikiname[ent.text]
-                        else: # ent.text not in full2wikiname and ent.text is single token
-                            full2wikiname[ent.text] = ent.text
-                        famous_counter[curr_entity] += 1
+            for line, ents in get_person_ents(textbook_lines, person_spans[title]): 
+                for _, _, entity in ents: 
+                    if entity not in full2wikiname and len(entity.split()) > 1: 
+                        new_entities[entity] = None
+        with metrics.record('wikidata') as record: 
+            lookup = WikidataLookup(get_endpoint(args.endpoint), cache_path=args.wikidata_cache, 
+                                    max_requests=args.max_requests)
+            official_names = get_official_names(new_entities, lookup)
+            record.count('names', len(new_entities))
+            record.count('http_requests', lookup.requests)
+            record.count('cache_hits', lookup.cache_hits)
+
+        famous_counter = Counter()
+        for title, textbook_lines in books.items(): 
+            for line, ents in get_person_ents(textbook_lines, person_spans[title]): 
+                for _, _, entity in ents: 
+                    curr_entity = entity
+                    if entity in full2wikiname: 
+                        curr_entity = full2wikiname[entity]
+                    elif len(entity.split()) > 1: 
+                        full2wikiname[entity] = official_names[entity]
+                        curr_entity = full2wikiname[entity]
+                    else: # entity not in full2wikiname and entity is single token
+                        full2wikiname[entity] = entity
+                    famous_counter[curr_entity] += 1
         famous_people = set()
         for tup in famous_counter.most_common(100):
             famous_people.add(tup[0])
         
-        with open('./results/full2wikiname.json', 'w') as outfile: 
+        with open(args.full2wikiname, 'w') as outfile: 
             json.dump(full2wikiname, outfile)
 
         # save famous people for getting descriptors later
-        with open('./wordlists/famous_people', 'w') as outfile: 
+        with open(args.famous_people, 'w') as outfile: 
             for person in famous_people: 
                 outfile.write(person + '\n')
     else: 
         print("Retrieving saved intermediate files...")
-        with open('./results/full2wikiname.json', 'r') as infile: 
+        with open(args.full2wikiname, 'r') as infile: 
             full2wikiname = json.load(infile)
 
         famous_people = set()
         # save famous people for getting descriptors later
-        with open('./wordlists/famous_people', 'r') as infile: 
+        with open(args.famous_people, 'r') as infile: 
             for line in infile: 
                 famous_people.add(line.strip())
 
     return famous_people, full2wikiname
 
 def main(): 
+    metrics = Metrics(args.metrics_file)
     nlp = spacy.load("en_core_web_sm")
-    books = get_book_txts(args.input_dir, splitlines=True)
+    books = get_books(args.input_dir)
+
+    # parse each book once and keep only the person entities
+    print("Running NER...")
+    person_spans = {} # title : spans
+    for title, textbook_lines in books.items():
+        print(title)
+        with metrics.record('ner', title=title) as record: 
+            person_spans[title] = get_person_spans(nlp, title, textbook_lines, record)
 
-    famous_people, full2wikiname = get_full2wikiname_and_famous_people(books, nlp)
+    famous_people, full2wikiname = get_full2wikiname_and_famous_people(books, person_spans, metrics)
 
     os.makedirs(args.ner_dir, exist_ok=True)
     os.makedirs(args.output_dir, exist_ok=True)
@@ -125,40 +204,33 @@ def main():
         print(title)
         entity_counter = Counter() # this time matching last names to common full names
         name_map = {} # last : full
-        with open(os.path.join(args.ner_dir, title), 'w') as outfile: 
-            for line in textbook_lines: 
-                doc = nlp(line)
-                replacements = {} # start : (entity, end)
-                for ent in doc.ents: 
-                    if (ent.label_ == 'PERSON' and not ent.text[0].isdigit()): 
-                        curr_entity = ent.text
-                        if ent.text in full2wikiname and ent.text != full2wikiname[ent.text]: 
-                            # replace with wikiname
-                            print("REPLACE", curr_entity, full2wikiname[ent.text])
-                            curr_entity = full2wikiname[ent.text]
-                        if len(curr_entity.split()) == 1: 
-                            if curr_entity in name_map: 
-                                # replace last name with latest full name
-                                curr_entity = name_map[curr_entity]
-                        elif curr_entity in famous_people: 
-                            # name map should only contain famous people
-                            last = curr_entity.split()[-1]
-                            name_map[last] = curr_entity
-                        entity_counter[curr_entity] += 1
-                        if curr_entity != ent.text: 
-                            replacements[ent.start_char] = (curr_entity, ent.end_char)
-                new_line = ''
-                curr_end = -1
-                for idx, char in enumerate(line): 
-                    if idx in replacements: 
-                        curr_end = replacements[idx][1]
-                        new_line += replacements[idx][0] 
-                    elif idx >= curr_end: 
-                        new_line += char
-                outfile.write(new_line + '\n')
+        with metrics.record('rewrite', title=title) as record, \
+            open(os.path.join(args.ner_dir, title), 'w') as outfile: 
+            for line, ents in get_person_ents(textbook_lines, person_spans[title]): 
+                record.count('lines')
+                replacements = [] # (start, end, entity)
+                for start, end, entity in ents: 
+                    curr_entity = entity
+                    if entity in full2wikiname and entity != full2wikiname[entity]: 
+                        # replace with wikiname
+                        print("REPLACE", curr_entity, full2wikiname[entity])
+                        curr_entity = full2wikiname[entity]
+                    if len(curr_entity.split()) == 1: 
+                        if curr_entity in name_map: 
+                            # replace last name with latest full name
+                            curr_entity = name_map[curr_entity]
+                    elif curr_entity in famous_people: 
+                        # name map should only contain famous people
+                        last = curr_entity.split()[-1]
+                        name_map[last] = curr_entity
+                    entity_counter[curr_entity] += 1
+                    if curr_entity != entity: 
+                        replacements.append((start, end, curr_entity))
+                outfile.write(replace_spans(line, replacements) + '\n')
         with open(os.path.join(args.output_dir, title), 'w') as outfile: 
             for tup in entity_counter.most_common(100):
                 outfile.write(tup[0] + ',' + str(tup[1]) + '\n')
+    metrics.close()
 
 if __name__ == '__main__':
     main()
@@ -0,0 +1,125 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+On-disk cache of spaCy parses shared by the spaCy-based scripts.
+
+Texts are parsed in shards of consecutive lines. Each shard is stored as a
+DocBin under <cache_dir>/<title>/<shard_size>/<start>-<end>-<key>.spacy, where
+the key is a hash of the shard's texts and of the pipeline (spaCy version,
+model name and version, pipe names and config). Any script that parses the
+same lines with the same model reads the shard back instead of running the
+parser again.
+'''
+import glob
+import hashlib
+import itertools
+import os
+import tempfile
+import spacy
+from spacy.tokens import DocBin
+from helpers import MetricsRecord
+
+SHARD_SIZE = 5000
+DOC_ATTRS = ["ORTH", "TAG", "POS", "HEAD", "DEP", "ENT_IOB", "ENT_TYPE", "LEMMA"]
+
+def get_pipeline_fingerprint(nlp):
+    '''
+    String identifying everything about the pipeline that affects a parse.
+    '''
+    meta = nlp.meta
+    parts = [spacy.__version__, meta.get('lang', ''), meta.get('name', ''),
+             meta.get('version', ''), ','.join(nlp.pipe_names)]
+    config = getattr(nlp, 'config', None) # only available in spaCy 3
+    if config is not None:
+        parts.append(config.to_str())
+    return '\n'.join(parts)
+
+def get_shard_key(fingerprint, texts):
+    h = hashlib.sha1(fingerprint.encode('utf-8'))
+    for text in texts:
+        b = text.encode('utf-8')
+        h.update(str(len(b)).encode('ascii') + b':' + b)
+    return h.hexdigest()[:16]
+
+def load_shard(path, nlp):
+    with open(path, 'rb') as infile:
+        doc_bin = DocBin().from_bytes(infile.read())
+    return list(doc_bin.get_docs(nlp.vocab))
+
+def save_shard(path, docs):
+    '''
+    Writes the shard atomically and removes stale shards for the same lines.
+    Several processes may write the same shard at once (e.g. two scripts
+    parsing the same book), so each writes to a temporary file of its own.
+    '''
+    book_dir = os.path.dirname(path)
+    start_end = os.path.basename(path).rsplit('-', 1)[0]
+    for old in glob.glob(os.path.join(book_dir, start_end + '-*.spacy')):
+        if old == path:
+            continue
+        try:
+            os.remove(old)
+        except FileNotFoundError: # removed by another process
+            pass
+    doc_bin = DocBin(attrs=DOC_ATTRS, store_user_data=False)
+    for doc in docs:
+        doc_bin.add(doc)
+    fd, tmp_path = tempfile.mkstemp(suffix='.tmp', dir=book_dir)
+    try:
+        with os.fdopen(fd, 'wb') as outfile:
+            outfile.write(doc_bin.to_bytes())
+        os.replace(tmp_path, path)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+def get_docs(nlp, texts, title, cache_dir='cache/spacy', shard_size=SHARD_SIZE,
+             offset=0, batch_size=1000, n_process=1, stats=None):
+    '''
+    Yields one Doc per text, in order, reading cached shards when possible
+    and parsing (then caching) the rest.
+    @inputs:
+    - nlp: spacy pipeline
+    - texts: an iterable of strings, e.g. the lines of a textbook
+    - title: title of the book, used to group shards on disk
+    - cache_dir: root of the cache; if empty, texts are always parsed
+    - shard_size: number of texts stored per shard
+    - offset: position of texts[0] in the book, a multiple of shard_size when
+      the book is split into several calls
+    - batch_size, n_process: passed on to nlp.pipe
+    - stats: MetricsRecord to add to, if any: the time spent parsing (timer
+      spacy), reading and writing shards (doc_cache_load, doc_cache_save),
+      and the number of shards read (doc_cache_hits) and parsed
+      (doc_cache_misses)
+    '''
+    if stats is None:
+        stats = MetricsRecord()
+    if not cache_dir:
+        for doc in stats.timed(nlp.pipe(texts, batch_size=batch_size, n_process=n_process), 'spacy'):
+            yield doc
+        return
+    fingerprint = get_pipeline_fingerprint(nlp)
+    book_dir = os.path.join(cache_dir, title, str(shard_size))
+    os.makedirs(book_dir, exist_ok=True)
+    texts = iter(texts)
+    start = offset
+    while True:
+        shard = list(itertools.islice(texts, shard_size))
+        if not shard:
+            break
+        end = start + len(shard)
+        key = get_shard_key(fingerprint, shard)
+        path = os.path.join(book_dir, '%d-%d-%s.spacy' % (start, end, key))
+        if os.path.isfile(path):
+            with stats.timer('doc_cache_load'):
+                docs = load_shard(path, nlp)
+            stats.count('doc_cache_hits')
+        else:
+            with stats.timer('spacy'):
+                docs = list(nlp.pipe(shard, batch_size=batch_size, n_process=n_process))
+            with stats.timer('doc_cache_save'):
+                save_shard(path, docs)
+            stats.count('doc_cache_misses')
+        for doc in docs:
+            yield doc
+        start = end
@@ -3,18 +3,29 @@ from helpers import *
 import spacy
 import os
 import math
+import shutil
+from multiprocessing import Pool
 from spacy.pipeline import merge_entities
+from doc_cache import get_docs
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True)
 parser.add_argument('--output_dir', required=True)
 parser.add_argument('--people_terms', required=True)
+parser.add_argument('--cache_dir', default='cache/spacy',
+    help="Directory for cached spaCy parses (set to '' to disable).")
+parser.add_argument('--n_process', default=1, type=int,
+    help="Number of worker processes; each parses one book at a time.")
+parser.add_argument('--metrics_file', default=None,
+    help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
+OUTPUT_BUFFER = 1 << 20
+
 def run_depparse(possible_marks, word2dem, famous_people, 
-    textbook_lines, title, nlp): 
+    textbook_lines, title, nlp, stats): 
     '''
     Get adjectives and verbs associated with frequent named entities
     and common nouns referring to people.
@@ -22,20 +33,25 @@ def run_depparse(possible_marks, word2dem, famous_people,
     - possible_marks: words that may mark common nouns with a social group, e.g. "black"
     - word2dem: word to demographic category
     - famous_people: a set of popular named entities
-    - textbook_lines: strings of textbook content in a list
+    - textbook_lines: lines of textbook content, as a Book
     - title: title of book
-    - outfile: opened file
     - nlp: spacy pipeline
+    - stats: MetricsRecord for the book
+    @output:
+    - yields a tuple per descriptor, as soon as its chunk is parsed
     '''
     print("Running dependency parsing for", title)
     # Break up every textbook into 5k line chunks to avoid spaCy's text length limit 
     j = 0
     k = 0
     num_lines = len(textbook_lines)
-    res = []
-    for i in range(0, num_lines, 5000):
-        chunk = '\n'.join(textbook_lines[i:i+5000])
-        doc = nlp(chunk)
+    stats.count('lines', num_lines)
+    chunks = ('\n'.join(lines) for _, lines in textbook_lines.chunks(5000))
+    # entities are merged after parsing so that cached parses can be reused
+    docs = get_docs(nlp, chunks, title, cache_dir=args.cache_dir, shard_size=1, stats=stats)
+    for doc in stats.timed(docs, rest='python'):
+        doc = merge_entities(doc)
+        stats.count('tokens', len(doc))
         k += 1
         print("Finished part", k, "of", math.ceil(num_lines/5000))
         prev_word = None
@@ -53,36 +69,36 @@ def run_depparse(possible_marks, word2dem, famous_people,
                     dem = word2dem[prev_word]
 
                 if token.dep_ == 'nsubj' and (token.head.pos_ == 'VERB' or token.head.pos_ == 'ADJ'): 
-                    res.append((str(j), title, word, dem, target_term, token.head.pos_, token.dep_))
+                    yield (str(j), title, word, dem, target_term, token.head.pos_, token.dep_)
                     if prev_word in possible_marks and word in possible_marks:
                         # handle intersectional markers if present
                         other_dem = set(word2dem[prev_word]) - set(dem)
                         if len(other_dem) > 0: 
-                            res.append((str(j), title, prev_word, other_dem, target_term, 
-                                token.head.pos_, token.dep_))
+                            yield (str(j), title, prev_word, other_dem, target_term, 
+                                token.head.pos_, token.dep_)
                 if token.dep_ == 'nsubjpass' and token.head.pos_ == 'VERB': 
-                    res.append((str(j), title, word, dem, target_term, token.head.pos_, token.dep_))
+                    yield (str(j), title, word, dem, target_term, token.head.pos_, token.dep_)
                     if prev_word in possible_marks and word in possible_marks:
                         other_dem = set(word2dem[prev_word]) - set(dem)
                         if len(other_dem) > 0: 
-                            res.append((str(j), title, prev_word, other_dem, target_term, 
-                                token.head.pos_, token.dep_))
+                            yield (str(j), title, prev_word, other_dem, target_term, 
+                                token.head.pos_, token.dep_)
                 if (token.dep_ == 'obj' or token.dep_ == 'dobj') and token.head.pos_ == 'VERB': 
-                    res.append((str(j), title, word, dem, target_term, token.head.pos_, token.dep_))
+                    yield (str(j), title, word, dem, target_term, token.head.pos_, token.dep_)
                     if prev_word in possible_marks and word in possible_marks:
                         other_dem = set(word2dem[prev_word]) - set(dem)
                         if len(other_dem) > 0: 
-                            res.append((str(j), title, prev_word, other_dem, target_term, 
-                                token.head.pos_, token.dep_))
+                            yield (str(j), title, prev_word, other_dem, target_term, 
+                                token.head.pos_, token.dep_)
             # named people
             if token.ent_type_ == 'PERSON':
                 if word in famous_people: 
                     if token.dep_ == 'nsubj' and (token.head.pos_ == 'VERB' or token.head.pos_ == 'ADJ'): 
-                        res.append((str(j), title, word, 'named', target_term, token.head.pos_, token.dep_))
+                        yield (str(j), title, word, 'named', target_term, token.head.pos_, token.dep_)
                     if token.dep_ == 'nsubjpass' and token.head.pos_ == 'VERB': 
-                        res.append((str(j), title, word, 'named', target_term, token.head.pos_, token.dep_))
+                        yield (str(j), title, word, 'named', target_term, token.head.pos_, token.dep_)
                     if (token.dep_ == 'obj' or token.dep_ == 'dobj') and token.head.pos_ == 'VERB': 
-                        res.append((str(j), title, word, 'named', target_term, token.head.pos_, token.dep_))
+                        yield (str(j), title, word, 'named', target_term, token.head.pos_, token.dep_)
 
             # adjectival modifier 
             if token.dep_ == 'amod':
@@ -98,37 +114,26 @@ def run_depparse(possible_marks, word2dem, famous_people,
                     if prev_target_term in possible_marks and target_term not in possible_marks:
                         # term is marked, assign to marker's category
                         dem = word2dem[prev_target_term]
-                    res.append((str(j), title, target_term, dem, word, token.pos_, token.dep_))
+                    yield (str(j), title, target_term, dem, word, token.pos_, token.dep_)
                     if prev_target_term in possible_marks and target_term in possible_marks:
                         other_dem = set(word2dem[prev_target_term]) - set(dem)
                         if len(other_dem) > 0: 
-                            res.append((str(j), title, prev_target_term, other_dem, 
-                                word, token.pos_, token.dep_))
+                            yield (str(j), title, prev_target_term, other_dem, 
+                                word, token.pos_, token.dep_)
                 # named people
                 if token.head.ent_type_ == 'PERSON' and target_term in famous_people:
-                    res.append((str(j), title, target_term, 'named', word, token.pos_, token.dep_))
+                    yield (str(j), title, target_term, 'named', word, token.pos_, token.dep_)
 
             prev_word = word
-    return res
 
-def main(): 
-    possible_marks, not_marks = split_terms_into_sets(args.people_terms)
-    word2dem = get_word_to_category(args.people_terms)
-    famous_people = set()
-    with open('./wordlists/famous_people', 'r') as infile: 
-        for line in infile: 
-            famous_people.add(line.strip().lower())
-    # load spacy
-    nlp = spacy.load("en_core_web_sm")
-    nlp.add_pipe(merge_entities)
-    # load books
-    books = get_book_txts(args.input_dir, splitlines=True)
-    res = []
-    for title, textbook_lines in books.items():
-        res.extend(run_depparse(possible_marks, word2dem, famous_people, 
-            textbook_lines, title, nlp))
-    outfile = codecs.open(os.path.join(args.output_dir, 'people_descriptors.csv'), 'w', encoding='utf-8')
-    for tup in res: 
+def write_descriptors(outfile, rows): 
+    '''
+    @output:
+    - number of rows written
+    '''
+    n = 0
+    for tup in rows: 
+        n += 1
         if type(tup[3]) == list or type(tup[3]) == set: 
             for d in tup[3]: 
                 outfile.write(tup[0] + ',' + tup[1] + ',' + tup[2] + ',' + d + ',' + \
@@ -136,7 +141,65 @@ def main():
         else: 
             outfile.write(tup[0] + ',' + tup[1] + ',' + tup[2] + ',' + tup[3] + ',' + \
                                 tup[4] + ',' + tup[5] + ',' + tup[6] + '\n')
-    outfile.close()
+    return n
+
+# set in each worker by init_worker
+nlp = None
+possible_marks, word2dem, famous_people = None, None, None
+
+def init_worker(marks, w2d, famous): 
+    global nlp, possible_marks, word2dem, famous_people
+    nlp = spacy.load("en_core_web_sm")
+    possible_marks, word2dem, famous_people = marks, w2d, famous
+
+def describe_book(task): 
+    '''
+    Writes the descriptors of one book to its own part file, so that rows
+    are never held in memory.
+    @inputs:
+    - task: (title, Book, path of the part file)
+    @output:
+    - path of the part file, and timings and counts from MetricsRecord
+    '''
+    title, textbook_lines, part_path = task
+    stats = MetricsRecord()
+    with open(part_path, 'w', encoding='utf-8', newline='', buffering=OUTPUT_BUFFER) as outfile: 
+        stats.count('descriptors', write_descriptors(outfile, run_depparse(possible_marks, word2dem, 
+            famous_people, textbook_lines, title, nlp, stats)))
+    return part_path, stats.get_stats()
+
+def main(): 
+    metrics = Metrics(args.metrics_file)
+    marks, _ = split_terms_into_sets(args.people_terms)
+    w2d = get_word_to_category(args.people_terms)
+    famous = set()
+    with open('./wordlists/famous_people', 'r') as infile: 
+        for line in infile: 
+            famous.add(line.strip().lower())
+    # load books
+    books = get_books(args.input_dir)
+    out_path = os.path.join(args.output_dir, 'people_descriptors.csv')
+    if args.n_process > 1: 
+        # each worker parses a whole book, then its rows are appended in book order
+        tasks = [(title, textbook_lines, '%s.%d.part' % (out_path, i)) 
+                 for i, (title, textbook_lines) in enumerate(books.items())]
+        with Pool(args.n_process, initializer=init_worker, initargs=(marks, w2d, famous)) as pool, \
+            open(out_path, 'wb') as outfile: 
+            results = pool.imap(describe_book, tasks)
+            for (title, _, _), (part_path, stats) in zip(tasks, results): 
+                with metrics.record('book', title=title) as record: 
+                    record.update(stats)
+                    with open(part_path, 'rb') as infile: 
+                        shutil.copyfileobj(infile, outfile, OUTPUT_BUFFER)
+                os.remove(part_path)
+    else: 
+        init_worker(marks, w2d, famous)
+        with open(out_path, 'w', encoding='utf-8', newline='', buffering=OUTPUT_BUFFER) as outfile: 
+            for title, textbook_lines in books.items():
+                with metrics.record('book', title=title) as record: 
+                    record.count('descriptors', write_descriptors(outfile, run_depparse(possible_marks, 
+                        word2dem, famous_people, textbook_lines, title, nlp, record)))
+    metrics.close(n_process=args.n_process)
 
 if __name__ == '__main__':
     main()
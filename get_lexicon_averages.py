@@ -5,14 +5,11 @@ scores for different categories of people.
 import argparse
 import csv
 from nltk.stem.wordnet import WordNetLemmatizer
-from collections import defaultdict, Counter
+from collections import Counter
+import numpy as np
 import pandas as pd
 from scipy.stats import zscore
-import math
-import warnings
-from pandas.core.common import SettingWithCopyWarning
-
-warnings.simplefilter(action="ignore", category=SettingWithCopyWarning)
+from helpers import Metrics
 
 parser = argparse.ArgumentParser()
 
@@ -21,216 +18,202 @@ parser.add_argument('--output_dir', required=True)
 parser.add_argument('--inspect', default=False)
 parser.add_argument('--category')
 parser.add_argument('--score_type')
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
 if args.inspect and (args.category is None or args.score_type is None):
     parser.error("--inspect requires --category and --score_type.")
 
-def get_ap_lexicon(): 
+# columns of people_descriptors.csv, in the order get_descriptors.py writes them
+DESCRIPTOR_COLUMNS = ['token_ID', 'filename', 'people_term', 'category', 'word', 'POS', 'rel']
+DIMENSIONS = ['power', 'agency', 'sentiment', 'valence', 'arousal', 'dominance']
+
+def lemmatize_verbs(words):
+    '''
+    @output:
+    - A dictionary of format {word : lemma as a verb}, lemmatizing
+    each distinct word once
+    '''
+    lemmatizer = WordNetLemmatizer()
+    return {w: lemmatizer.lemmatize(w, 'v') for w in set(words)}
+
+def get_ap_lexicon():
     '''
-    @output: 
-    - Two dictionaries of format {word : annotation}
+    @output:
+    - Two Series of format {word : annotation}
     '''
     lexicon = './wordlists/agency_power.csv'
-    agencies = {}
-    powers = {}
-    with open(lexicon, 'r') as infile:
-        reader = csv.DictReader(infile)
-        for row in reader:
-            word = WordNetLemmatizer().lemmatize(row['verb'], 'v')
-            if row['agency'] == 'agency_pos': 
-                agencies[word] = 1
-            elif row['agency'] == 'agency_neg': 
-                agencies[word] = -1
-            else: 
-                agencies[word] = 0
-            if row['power'] == 'power_agent': 
-                powers[word] = 1
-            elif row['power'] == 'power_theme': 
-                powers[word] = -1
-            else: 
-                powers[word] = 0
-    return (agencies, powers)
-
-def get_NRC_lexicon(): 
-    '''
-    @output: 
-    - A dictionary of format {word : score}
+    df = pd.read_csv(lexicon, dtype=str, keep_default_na=False)
+    words = df['verb'].map(lemmatize_verbs(df['verb'])).values
+    agencies = pd.Series(np.select([df['agency'] == 'agency_pos', df['agency'] == 'agency_neg'],
+                                   [1, -1], 0), index=words)
+    powers = pd.Series(np.select([df['power'] == 'power_agent', df['power'] == 'power_theme'],
+                                 [1, -1], 0), index=words)
+    # verbs with the same lemma: the last row wins
+    keep = ~agencies.index.duplicated(keep='last')
+    return (agencies[keep], powers[keep])
+
+def get_NRC_lexicon():
+    '''
+    @output:
+    - A DataFrame of format {word : {Valence, Arousal, Dominance}}
     '''
     lexicon = './wordlists/NRC-VAD-Lexicon.txt'
-    val_dict = {}
-    aro_dict = {}
-    dom_dict = {}
-    with open(lexicon, 'r') as infile:
-        reader = csv.DictReader(infile, delimiter="\t")
-        for row in reader:
-            word = row['Word']
-            val_dict[word] = float(row['Valence'])
-            aro_dict[word] = float(row['Arousal'])
-            dom_dict[word] = float(row['Dominance'])
-    return (val_dict, aro_dict, dom_dict)
-
-def get_conn_lexicon(): 
-    '''
-    @output: 
-    - A dictionary of format {measurement : {word : score}}
+    # keep_default_na=False, since "null" and "nan" are words too
+    df = pd.read_csv(lexicon, sep='\t', keep_default_na=False,
+                     dtype={'Word': str, 'Valence': float, 'Arousal': float, 'Dominance': float})
+    df = df.set_index('Word')
+    return df[~df.index.duplicated(keep='last')]
+
+def get_conn_lexicon():
+    '''
+    @output:
+    - A DataFrame of format {verb : {measurement : score}}
     '''
     lexicon = './wordlists/full_frame_info.txt'
-    ret = defaultdict(dict)
-    vocab = set()
-    with open(lexicon, 'r') as infile:
-        reader = csv.DictReader(infile, delimiter="\t")
-        for row in reader:
-            vocab.add(row['verb'])
-            for key in row: 
-                if key != 'verb':
-                    ret[key][row['verb']] = float(row[key])
-    return (ret, vocab)
-
-def calculate_scores(agencies, powers, val_dict, aro_dict, \
-        dom_dict, conn_lexicon, conn_vocab): 
-    '''
-    The outputs of this function are dictionaries that are formatted
-    in a way so that they can be easily transformed into pandas dataframes
-    if needed. 
-    '''
-    agen_d = {'Category' : [], 'Value': [], 'Word' : []}
-    power_d = {'Category' : [], 'Value': [], 'Word' : []}
-    adj = {'Category' : [], 'Measurement' : [], 'Value' : [], 'Word' : []}
-    sent_d = {'Category' : [], 'Value': [], 'Word' : []}
-    with open(args.input_file, 'r') as infile: 
-        reader = csv.DictReader(infile)
-        for row in reader: 
-            ID = row['token_ID']
-            title = row['filename']
-            category = row['category']
-            word = row['word']
-            pos = row['POS']
-            relation = row['rel']
-            if pos == 'VERB' and relation == 'nsubj':
-                # Connotation frames
-                word = WordNetLemmatizer().lemmatize(word, 'v')
-                if word in powers: 
-                    power_d['Value'].append(powers[word])
-                    power_d['Category'].append(category)
-                    power_d['Word'].append(word)
-                if word in agencies: 
-                    agen_d['Value'].append(agencies[word])
-                    agen_d['Category'].append(category)
-                    agen_d['Word'].append(word)
-                if word in conn_vocab: 
-                    sent_d['Category'].append(category)
-                    sent_d['Value'].append(conn_lexicon['Perspective(ws)'][word])
-                    sent_d['Word'].append(word)
-            elif relation == 'dobj':
-                # Connotation frames
-                word = WordNetLemmatizer().lemmatize(word, 'v')
-                if word in powers: 
-                    power_d['Value'].append(-powers[word])
-                    power_d['Category'].append(category)
-                    power_d['Word'].append(word)
-                if word in conn_vocab: 
-                    sent_d['Category'].append(category)
-                    sent_d['Value'].append(conn_lexicon['Perspective(wo)'][word])
-                    sent_d['Word'].append(word)
-            elif (pos == 'ADJ' and relation == 'nsubj') or (relation == 'amod'):
-                # NRC VAD
-                if word in val_dict: 
-                    val = val_dict[word]
-                    aro = aro_dict[word]
-                    dom = dom_dict[word]
-                    adj['Category'].append(category)
-                    adj['Measurement'].append('Valence')
-                    adj['Value'].append(val)
-                    adj['Word'].append(word)
-                    adj['Category'].append(category)
-                    adj['Measurement'].append('Arousal')
-                    adj['Value'].append(aro)
-                    adj['Word'].append(word)
-                    adj['Category'].append(category)
-                    adj['Measurement'].append('Dominance')
-                    adj['Value'].append(dom)
-                    adj['Word'].append(word)
-    return power_d, agen_d, sent_d, adj
-
-def look_at_examples(d, category, score_dict, top_n=30): 
+    df = pd.read_csv(lexicon, sep='\t', keep_default_na=False, dtype={'verb': str})
+    df = df.set_index('verb').astype(float)
+    return df[~df.index.duplicated(keep='last')]
+
+def load_descriptors(path):
+    '''
+    Reads the columns of people_descriptors.csv needed for scoring as
+    categorical columns, so that each distinct word is only looked up
+    once. The file may or may not start with a header row.
+    '''
+    with open(path, 'r') as infile:
+        has_header = infile.readline().startswith(DESCRIPTOR_COLUMNS[0] + ',')
+    return pd.read_csv(path, header=0 if has_header else None, names=DESCRIPTOR_COLUMNS,
+                       usecols=['category', 'word', 'POS', 'rel'], dtype='category', keep_default_na=False)
+
+def lookup(keys, codes, scores):
+    '''
+    @inputs:
+    - keys: array of the word of each category code
+    - codes: category code of each descriptor
+    - scores: Series of format {word : score}
+    @output:
+    - array of the score of each descriptor, NaN if its word has none
+    '''
+    return scores.reindex(keys).values.astype(float)[codes]
+
+def select_scores(categories, dimension, mask, words, values):
+    return pd.DataFrame({'Category': categories[mask],
+                         'Dimension': dimension,
+                         'Value': values[mask],
+                         'Word': words[mask]})
+
+def calculate_scores(descriptors, agencies, powers, vad, conn_lexicon):
+    '''
+    Scores verbs whose subject is the person with power, agency and the
+    writer's sentiment towards the subject, verbs whose object is the person
+    with reversed power and the sentiment towards the object, and adjectives
+    describing the person with NRC VAD. Verbs are lemmatized first.
+    @output:
+    - DataFrame with a row per descriptor and dimension it has a score for,
+    with columns Category, Dimension, Value and Word, in the order of the
+    descriptors within each dimension
+    '''
+    pos, rel = descriptors['POS'], descriptors['rel']
+    is_subj = ((pos == 'VERB') & (rel == 'nsubj')).values
+    is_obj = ~is_subj & (rel == 'dobj').values
+    is_adj = ~is_subj & ~is_obj & (((pos == 'ADJ') & (rel == 'nsubj')) | (rel == 'amod')).values
+    is_verb = is_subj | is_obj
+
+    # sorted, so that groupby lists the categories in alphabetical order
+    categories = descriptors['category'].values
+    categories = categories.reorder_categories(sorted(categories.categories))
+    codes = descriptors['word'].cat.codes.values
+    vocab = np.asarray(descriptors['word'].cat.categories, dtype=object)
+    verb_lemmas = lemmatize_verbs(vocab[np.unique(codes[is_verb])])
+    lemma_vocab = np.array([verb_lemmas.get(w, w) for w in vocab], dtype=object)
+    words, lemmas = vocab[codes], lemma_vocab[codes]
+
+    power = lookup(lemma_vocab, codes, powers)
+    agency = lookup(lemma_vocab, codes, agencies)
+    sentiment = np.where(is_subj, lookup(lemma_vocab, codes, conn_lexicon['Perspective(ws)']),
+                         lookup(lemma_vocab, codes, conn_lexicon['Perspective(wo)']))
+    in_conn = pd.Index(lemma_vocab).isin(conn_lexicon.index)[codes]
+    in_vad = is_adj & pd.Index(vocab).isin(vad.index)[codes]
+    scores = [
+        select_scores(categories, 'power', is_verb & ~np.isnan(power), lemmas, np.where(is_subj, power, -power)),
+        select_scores(categories, 'agency', is_subj & ~np.isnan(agency), lemmas, agency),
+        select_scores(categories, 'sentiment', is_verb & in_conn, lemmas, sentiment),
+    ]
+    for dimension in ['Valence', 'Arousal', 'Dominance']:
+        scores.append(select_scores(categories, dimension.lower(), in_vad, words,
+                                    lookup(vocab, codes, vad[dimension])))
+    return pd.concat(scores, ignore_index=True)
+
+def look_at_examples(scores, category, dimension, score_dict, top_n=30):
     '''
     Takes in a category of people and prints out the
-    most common words 
+    most common words
 
     For example, you can run this function with the following:
-    d = agen_d
+    scores = calculate_scores(...)
     category = 'black'
-    score_dict = agencies 
+    dimension = 'agency'
+    score_dict = agencies
     And it will print out the most common verbs associated
-    with black people in the text and those verbs' agency scores. 
+    with black people in the text and those verbs' agency scores.
 
-    Example usage: 
-    python get_lexicon_averages.py --input_file results/people_descriptors.csv 
+    Example usage:
+    python get_lexicon_averages.py --input_file results/people_descriptors.csv
         --output_dir results/ --inspect True --category black --score_type agency
     '''
-    df = pd.DataFrame.from_dict(d)
-    category_df = df[df['Category'] == category]
-    counts_words = Counter(category_df['Word'].tolist())
-    for w in counts_words.most_common(top_n): 
+    words = scores['Word'][(scores['Category'] == category) & (scores['Dimension'] == dimension)]
+    counts_words = Counter(words.tolist())
+    for w in counts_words.most_common(top_n):
         print(w, score_dict[w[0]])
 
-def write_output(writer, df, label): 
-    df.loc[:,'value'] = zscore(df['Value'])
-    df = df.drop(columns=['Value'])
-    stats = df.groupby(['Category']).agg(['mean', 'count', 'std'])
-    cis = []
-    for i in stats.index:
-        m, c, s = stats.loc[i]
-        cis.append(1.96*s/math.sqrt(c))
-    stats['ci'] = cis
-    for index, row in stats.iterrows():
-        writer.writerow({'category': row.name,
-                    'dimension': label, 
-                    'mean':row['value']['mean'], 
-                    "ci": row['ci'].values[0]})
+def write_output(writer, scores):
+    '''
+    Writes the mean z-scored value of each category for each dimension,
+    and its 95% confidence interval.
+    '''
+    scores = scores.assign(Dimension=pd.Categorical(scores['Dimension'], categories=DIMENSIONS, ordered=True))
+    scores['Value'] = scores.groupby('Dimension', observed=True)['Value'].transform(zscore)
+    stats = scores.groupby(['Dimension', 'Category'], observed=True)['Value'].agg(['mean', 'count', 'std'])
+    cis = 1.96 * stats['std'] / np.sqrt(stats['count'])
+    for (dimension, category), mean, ci in zip(stats.index, stats['mean'], cis):
+        writer.writerow({'category': category,
+                    'dimension': dimension,
+                    'mean': mean,
+                    'ci': ci})
 
 def main():
-    agencies, powers = get_ap_lexicon()
-    val_dict, aro_dict, dom_dict = get_NRC_lexicon()
-    conn_lexicon, conn_vocab = get_conn_lexicon()
-    power_d, agen_d, sent_d, adj = calculate_scores(agencies, powers, val_dict, aro_dict, \
-        dom_dict, conn_lexicon, conn_vocab)
-    if not args.inspect: 
-        power_df = pd.DataFrame.from_dict(power_d)
-        agen_df = pd.DataFrame.from_dict(agen_d)
-        sent_df = pd.DataFrame.from_dict(sent_d)
-        adj_df = pd.DataFrame.from_dict(adj)
-        val_df = adj_df[adj_df['Measurement'] == 'Valence']
-        aro_df = adj_df[adj_df['Measurement'] == 'Arousal']
-        dom_df = adj_df[adj_df['Measurement'] == 'Dominance']
+    metrics = Metrics(args.metrics_file)
+    with metrics.record('lexicons'):
+        agencies, powers = get_ap_lexicon()
+        vad = get_NRC_lexicon()
+        conn_lexicon = get_conn_lexicon()
+    with metrics.record('scores') as record:
+        descriptors = load_descriptors(args.input_file)
+        scores = calculate_scores(descriptors, agencies, powers, vad, conn_lexicon)
+        record.count('descriptors', len(descriptors))
+    if not args.inspect:
         with open(args.output_dir + 'lexicon_output.csv', 'w') as outfile:
             fieldnames = ['category', 'dimension', 'mean', 'ci']
             writer = csv.DictWriter(outfile, fieldnames=fieldnames)
             writer.writeheader()
-            write_output(writer, power_df, 'power')
-            write_output(writer, agen_df, 'agency')
-            write_output(writer, sent_df, 'sentiment')
-            write_output(writer, val_df, 'valence')
-            write_output(writer, aro_df, 'arousal')
-            write_output(writer, dom_df, 'dominance')
-    else: 
-        if args.score_type == 'agency':
-            look_at_examples(agen_d, args.category, agencies)
-        elif args.score_type == 'power':
-            look_at_examples(power_d, args.category, powers)
-        elif args.score_type == 'sentiment':
-            look_at_examples(sent_d, args.category, conn_lexicon['Perspective(ws)'])
-            look_at_examples(sent_d, args.category, conn_lexicon['Perspective(wo)'])
-        elif args.score_type == 'valence':
-            look_at_examples(adj, args.category, val_dict)
-        elif args.score_type == 'arousal':
-            look_at_examples(adj, args.category, aro_dict)
-        elif args.score_type == 'dominance':
-            look_at_examples(adj, args.category, dom_dict)
-        else: 
+            write_output(writer, scores)
+    else:
+        score_dicts = {
+            'agency': [agencies],
+            'power': [powers],
+            'sentiment': [conn_lexicon['Perspective(ws)'], conn_lexicon['Perspective(wo)']],
+            'valence': [vad['Valence']],
+            'arousal': [vad['Arousal']],
+            'dominance': [vad['Dominance']],
+        }
+        if args.score_type in score_dicts:
+            for score_dict in score_dicts[args.score_type]:
+                look_at_examples(scores, args.category, args.score_type, score_dict)
+        else:
             print("Invalid score type.")
+    metrics.close()
 
 if __name__ == '__main__':
     main()
@@ -4,35 +4,43 @@
 import argparse
 from helpers import *
 import pandas as pd
-import json
 import numpy as np
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--topic_dir', required=True, help="Directory containing the topic model files.")
-parser.add_argument('--textbook_dir', required=True, help="Directory containing the textbook files.")
+parser.add_argument('--textbook_dir', help="No longer needed: the titles are read from the topic model's "
+                                           "%s." % TOPIC_ARTIFACT)
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
+if args.textbook_dir:
+    print("Warning: --textbook_dir is ignored; the titles are read from the topic model's %s." % TOPIC_ARTIFACT)
+
 def main():
-    topic_names = json.load(open('%s/topic_names.json' % args.topic_dir, 'r'))
-    books = get_book_txts(args.textbook_dir, splitlines=False)
+    metrics = Metrics(args.metrics_file)
+    artifact = TopicArtifact('%s/%s' % (args.topic_dir, TOPIC_ARTIFACT))
+    topic_names = artifact.metadata['topic_names']
     dicts = []
 
-    for title, book in books.items():
-        topic_counts = np.load('%s/%s/topic_count.npy' % (args.topic_dir, title))
+    for title in artifact.titles:
+        topic_counts = artifact.get('topic_count', title)
         book_total = np.sum(topic_counts)
+        mean_proportions = artifact.get_doc_topics(title).mean(axis=0, dtype=np.float64)
         for topic_id, topic_words in topic_names.items():
             topic_count = topic_counts[int(topic_id)]
             d = {"book": title,
                  "topic_id": topic_id,
                  "topic_words": topic_words,
                  "raw_count": int(topic_count),
-                 "topic_proportion": topic_count / book_total
+                 "topic_proportion": topic_count / book_total,
+                 "mean_doc_proportion": mean_proportions[int(topic_id)]
             }
             dicts.append(d)
     df = pd.DataFrame(dicts)
     df.to_csv('%s/topic_prominence.csv' % args.topic_dir, index=False)
+    metrics.close(books=len(artifact.titles))
 
 
 
@@ -8,9 +8,13 @@ import logging
 from helpers import *
 from nltk import *
 import itertools
+import heapq
+from array import array
 import numpy as np
-from collections import Counter, defaultdict
+from scipy import sparse
+from collections import Counter, defaultdict, OrderedDict
 import io
+from gensim.models import LdaMulticore
 
 logging.basicConfig(level=logging.INFO)
 
@@ -19,136 +23,193 @@ parser.add_argument('--input_dir', required=True, help="Directory of input text
 parser.add_argument("--output_dir",
                     help=("output directory for intermediate data"),
                     type=str)
-parser.add_argument('--mallet_dir', required=True, help="Location of MALLET binary file.")
+parser.add_argument('--engine', default='mallet', choices=['mallet', 'gensim'],
+                    help="Run LDA with MALLET, or in-process with gensim's LdaMulticore (no Java needed).")
+parser.add_argument('--mallet_dir', help="Location of MALLET binary file.")
 parser.add_argument('--num_topics', default=100, type=int, help="Number of topics to induce.")
 parser.add_argument('--stem', action='store_true', help="Whether to stem words before running the topic model "
                                                         "(in the paper, we do).")
+parser.add_argument('--workers', default=None, type=int, help="Worker processes for the gensim engine "
+                                                              "(by default, all cores but one).")
+parser.add_argument('--passes', default=10, type=int, help="Passes over the corpus for the gensim engine.")
+parser.add_argument('--prepare_only', action='store_true', help="Only write the cleaned input for MALLET, "
+                                                                "without running the topic model.")
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
+def get_topic_matrix(articles, num_topics=100):
+    """Sparse binary matrix with a row per document and a column per topic"""
+    indices = np.fromiter(itertools.chain.from_iterable(articles), dtype=np.int32)
+    indptr = np.zeros(len(articles) + 1, dtype=np.int64)
+    np.cumsum([len(topics) for topics in articles], out=indptr[1:])
+    data = np.ones(len(indices))
+    return sparse.csr_matrix((data, indices, indptr), shape=(len(articles), num_topics))
+
 def generate_cooccurrence_from_int_set(articles, num_topics=100):
-    matrix = np.zeros((num_topics, num_topics))
-    for topics in articles:
-        for topic in topics:
-            matrix[topic, topic] += 1
-        for (i, j) in itertools.combinations(topics, 2):
-            matrix[i, j] += 1
-            matrix[j, i] += 1
-    return matrix
-
-def find_bigrams(sentences, output_file, threshold=100, min_count=5):
-    unigram_count = get_word_count(sentences, ngrams=1, words_func=get_ngram_list)
-    total_words = float(sum(unigram_count.values()))
-    bigram_count = get_word_count(sentences, ngrams=2, words_func=get_ngram_list)
-
-    bigram_list = []
-    for w in bigram_count:
-        words = w.split()
-        score = (bigram_count[w] - min_count) * total_words \
-                / (unigram_count[words[0]] * unigram_count[words[1]])
-        if score > threshold:
-            bigram_list.append((score, w))
+    """Number of documents that each pair of topics (and each topic) occurs in"""
+    if not sparse.issparse(articles):
+        articles = get_topic_matrix(articles, num_topics)
+    return (articles.T @ articles).toarray()
+
+def encode_sentences(sentences):
+    """Tokenizes every sentence once, as lowercased words.
+
+    Returns:
+        tokens: word ids of all sentences, one after another
+        offsets: start of each sentence in tokens, plus the total length
+        id2word: list of words in order of first occurrence
+    """
+    # a new word gets the next id
+    word2id = defaultdict()
+    word2id.default_factory = word2id.__len__
+    tokens = array('i')
+    offsets = array('q', [0])
+    for sent in sentences:
+        tokens.extend(map(word2id.__getitem__, sent.lower().split()))
+        offsets.append(len(tokens))
+    id2word = [None] * len(word2id)
+    for w, i in word2id.items():
+        id2word[i] = w
+    return np.frombuffer(tokens, dtype=np.int32), np.frombuffer(offsets, dtype=np.int64), id2word
+
+
+def get_pairs(tokens, offsets, vocab_size):
+    """Positions of the pairs of adjacent words within a sentence, and the pairs as word1 * vocab_size + word2"""
+    is_pair = np.ones(max(len(tokens) - 1, 0), dtype=bool)
+    starts = offsets[1:-1]
+    is_pair[starts[(starts > 0) & (starts < len(tokens))] - 1] = False
+    positions = np.flatnonzero(is_pair)
+    return positions, tokens[positions].astype(np.int64) * vocab_size + tokens[positions + 1]
+
+
+def find_bigrams(tokens, offsets, id2word, output_file, threshold=100, min_count=5):
+    """Writes the bigrams that score above threshold, and returns them as sorted pair ids"""
+    vocab_size = len(id2word)
+    unigram_count = np.bincount(tokens, minlength=vocab_size)
+    total_words = float(unigram_count.sum())
+    _, pairs = get_pairs(tokens, offsets, vocab_size)
+    pairs, bigram_count = np.unique(pairs, return_counts=True)
+    first, second = pairs // vocab_size, pairs % vocab_size
+    scores = (bigram_count - min_count) * total_words \
+             / (unigram_count[first] * unigram_count[second])
+    keep = scores > threshold
+
+    bigram_list = [(float(score), id2word[w1] + " " + id2word[w2])
+                   for score, w1, w2 in zip(scores[keep], first[keep], second[keep])]
     bigram_list.sort(reverse=True)
     with open(output_file, "w") as fout:
         for score, w in bigram_list:
             fout.write("%s\n" % json.dumps({"word": w, "score": score}))
-
-
-def get_ngram_list(input_words, ngrams=1, bigram_dict=None):
-    words = [w.lower() for w in input_words.split()]
-    result = []
-    for start in range(len(words) - ngrams + 1):
-        tmp_words = words[start:start + ngrams]
-        w = " ".join(tmp_words)
-        result.append(w)
-    return result
-
-
-def get_mixed_tokens(input_words, ngrams=1, bigram_dict=None):
-    words = [w.lower() for w in input_words.split()]
-    result, index = [], 0
-    while index < len(words):
-        w = words[index]
-        # look forward
-        if index < len(words) - 1:
-            bigram = w + " " + words[index + 1]
-            if bigram in bigram_dict:
-                result.append(bigram)
-                index += 2
-                continue
-        result.append(w)
-        index += 1
-    return result
-
-
-def get_word_count(sentences, ngrams=1, bigram_dict=None, words_func=None):
-    result = defaultdict(int)
-    for sent in sentences:
-        words = words_func(sent, ngrams=ngrams, bigram_dict=bigram_dict)
-        for w in words:
-            result[w] += 1
-    return result
-
-
-def load_bigrams(filename):
-    bigram_dict = {}
-    with open(filename) as fin:
-        for line in fin:
-            data = json.loads(line)
-            bigram_dict[data["word"]] = data["score"]
-    return bigram_dict
-
-
-def get_word_dict(word_count, top=10000, filter_regex=None):
-    if filter_regex:
-        word_count = {w: word_count[w] for w in word_count
-                      if all([re.match(filter_regex, sw) for sw in w.split()])}
-    words = get_most_frequent(word_count, top=top)
-    return {v[1]: i for i, v in enumerate(words)}
-
-
-def get_most_frequent(word_cnt, top=10000):
-    words = [(word_cnt[w], w) for w in word_cnt
-             if re.match("\w+", w)]
-    words.sort(reverse=True)
-    min_threshold = words[min(top, len(words)) - 1][0]
-    return [v for v in words if v[0] >= min_threshold]
-
-
-def write_word_dict(vocab_dict, word_count, filename):
+    return pairs[keep]
+
+
+def merge_bigrams(tokens, offsets, bigrams, vocab_size):
+    """Replaces the bigrams in each sentence by single tokens, from left to right.
+
+    A bigram w1 w2 that is bigrams[k] becomes token vocab_size + k.
+    Returns the new tokens and offsets.
+    """
+    positions, pairs = get_pairs(tokens, offsets, vocab_size)
+    index = np.searchsorted(bigrams, pairs)
+    found = index < len(bigrams)
+    found[found] = bigrams[index[found]] == pairs[found]
+    is_bigram = np.zeros(len(tokens), dtype=bool)
+    is_bigram[positions[found]] = True
+    bigram_index = np.zeros(len(tokens), dtype=np.int64)
+    bigram_index[positions[found]] = index[found]
+
+    # going from left to right, in a run of overlapping bigrams every other
+    # one is merged, starting with the first
+    run_starts = is_bigram & ~np.concatenate([[False], is_bigram[:-1]])
+    run_start = np.flatnonzero(run_starts)[np.maximum(np.cumsum(run_starts) - 1, 0)] \
+        if run_starts.any() else np.zeros(len(tokens), dtype=np.int64)
+    merged = is_bigram & ((np.arange(len(tokens)) - run_start) % 2 == 0)
+    keep = ~np.concatenate([[False], merged[:-1]])
+
+    new_tokens = np.where(merged, vocab_size + bigram_index, tokens)[keep]
+    new_offsets = np.concatenate([[0], np.cumsum(keep)])[offsets]
+    return new_tokens, new_offsets
+
+
+def get_word_dict(word_count, id2word, bigrams, top=10000, filter_regex=r"\w\w+"):
+    """Picks the top most frequent words (and any tied with the last one) whose words all match filter_regex.
+
+    Returns:
+        token ids of the vocabulary, from most to least frequent
+    """
+    # the bigram tokens come after the words
+    num_words = len(id2word) - len(bigrams)
+    matches = np.array([bool(re.match(filter_regex, w)) for w in id2word[:num_words]], dtype=bool)
+    matches = np.concatenate([matches, matches[bigrams // num_words] & matches[bigrams % num_words]])
+    candidates = np.flatnonzero(matches & (word_count > 0))
+    counts = word_count[candidates]
+    min_threshold = heapq.nlargest(top, counts.tolist())[-1]
+    words = sorted(((int(word_count[i]), id2word[i], i) for i in candidates[counts >= min_threshold]),
+                   reverse=True)
+    return np.array([i for _, _, i in words], dtype=np.int64)
+
+
+def write_word_dict(vocab, word_count, id2word, filename):
     with io.open(filename, mode="w", encoding="utf-8") as fout:
-        ids = sorted(vocab_dict.values())
-        reverse_dict = {i: w for (w, i) in vocab_dict.items()}
-        for wid in ids:
-            fout.write("%d\t%s\t%d\n" % (wid, reverse_dict[wid],
-                word_count[reverse_dict[wid]]))
-
-def convert_word_count_mallet(word_dict, sentences, output_file,
-                              words_func=None):
-    doc_id = 0
+        for wid, i in enumerate(vocab):
+            fout.write("%d\t%s\t%d\n" % (wid, id2word[i], word_count[i]))
+
+def convert_word_count_mallet(word2vocab, tokens, offsets, output_file):
+    """Writes a line per sentence with its id (from 1) and the sorted vocabulary ids of its words"""
+    wids = word2vocab[tokens]
+    docs = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+    keep = wids >= 0
+    wids, docs = wids[keep], docs[keep]
+    wids = wids[np.lexsort((wids, docs))]
+    bounds = np.concatenate([[0], np.cumsum(np.bincount(docs, minlength=len(offsets) - 1))])
+    wids = [str(w) for w in wids.tolist()]
     with open(output_file, "w") as fout:
-        for sent in sentences:
-            doc_id += 1
-            words = Counter(words_func(sent))
-            words = [(word_dict[w], words[w])
-                     for w in words if w in word_dict]
-            words.sort()
-            word_cnts = [" ".join([str(wid)] * cnt) for (wid, cnt) in words]
-            fout.write("%s %s\n" % (doc_id, " ".join(word_cnts)))
+        for doc_id in range(len(offsets) - 1):
+            fout.write("%s %s\n" % (doc_id + 1, " ".join(wids[bounds[doc_id]:bounds[doc_id + 1]])))
 
 def get_mallet_input_from_words(sentences, data_dir, vocab_size=10000):
+    """Writes bigram_phrases.txt, data.word_id.dict and data.input for MALLET, and returns the number of words"""
+    tokens, offsets, id2word = encode_sentences(sentences)
     bigram_file = "%s/bigram_phrases.txt" % data_dir
-    find_bigrams(sentences, bigram_file)
-    bigram_dict = load_bigrams(bigram_file)
-    word_cnts = get_word_count(sentences, bigram_dict=bigram_dict, words_func=get_mixed_tokens)
-    vocab_dict = get_word_dict(word_cnts, top=vocab_size, filter_regex="\w\w+")
-    write_word_dict(vocab_dict, word_cnts,
-                          "%s/data.word_id.dict" % data_dir)
-    convert_word_count_mallet(vocab_dict, sentences,
-                              "%s/data.input" % data_dir,
-                              words_func=functools.partial(
-                                  get_mixed_tokens,
-                                  bigram_dict=bigram_dict))
+    bigrams = find_bigrams(tokens, offsets, id2word, bigram_file)
+    num_words = len(id2word)
+    tokens, offsets = merge_bigrams(tokens, offsets, bigrams, num_words)
+    id2word.extend(id2word[b // num_words] + " " + id2word[b % num_words] for b in bigrams.tolist())
+    word_cnts = np.bincount(tokens, minlength=len(id2word))
+    vocab = get_word_dict(word_cnts, id2word, bigrams, top=vocab_size)
+    write_word_dict(vocab, word_cnts, id2word,
+                    "%s/data.word_id.dict" % data_dir)
+    word2vocab = np.full(len(id2word), -1, dtype=np.int64)
+    word2vocab[vocab] = np.arange(len(vocab))
+    convert_word_count_mallet(word2vocab, tokens, offsets,
+                              "%s/data.input" % data_dir)
+    return len(tokens)
+
+def read_mallet_input(filename):
+    """Bag-of-words documents from data.input, as (vocabulary id, count) pairs"""
+    corpus = []
+    with open(filename) as fin:
+        for line in fin:
+            # the first field is the document's id
+            wids = line.split()[1:]
+            corpus.append(sorted(Counter(map(int, wids)).items()))
+    return corpus
+
+def run_gensim(data_dir, num_topics, workers=None, passes=10):
+    """Trains LDA in-process on data.input and writes doc-topics.gz and topic-words.gz as MALLET would"""
+    corpus = read_mallet_input("%s/data.input" % data_dir)
+    vocab = read_word_dict("%s/data.word_id.dict" % data_dir)
+    lda = LdaMulticore(corpus=corpus,
+                       num_topics=num_topics,
+                       id2word=vocab,
+                       workers=workers or max(os.cpu_count() - 1, 1),
+                       passes=passes,
+                       eval_every=None,
+                       random_state=42)
+    lda.save("%s/lda.gensim" % data_dir)
+    write_mallet_topics(lda, corpus, "%s/doc-topics.gz" % data_dir, "%s/topic-words.gz" % data_dir)
+    return len(corpus)
 
 def read_word_dict(filename, vocab_size=-1):
     vocab_map = {}
@@ -177,19 +238,13 @@ def load_topic_words(vocab, input_file, top=10):
     return topic_map
 
 
-def load_doc_topics(sentences, doc_topic_file, threshold):
-    """Load topics in each document"""
-    articles = []
-    with open(doc_topic_file) as tfin:
-        for _ in sentences:
-            topic_line = tfin.readline()
-            if not topic_line:
-                break
-            topics = topic_line.strip().split()[2:]
-            topics = set([i for (i, v) in enumerate(topics)
-                         if float(v) > threshold])
-            articles.append(topics)
-    return articles
+def load_doc_topics(sentences, doc_topic_file, threshold, chunk_size=100000):
+    """Sparse binary matrix of the topics above threshold in each document"""
+    doc_topics = load_doc_topic_matrix(doc_topic_file)[:len(sentences)]
+    # a chunk at a time, so that the memory-mapped matrix is not all read at once
+    chunks = [sparse.csr_matrix(doc_topics[i:i + chunk_size] > threshold, dtype=np.float64)
+              for i in range(0, max(len(doc_topics), 1), chunk_size)]
+    return sparse.vstack(chunks, format='csr')
 
 def load_articles(sentences, topic_dir, threshold):
     vocab_file = "%s/data.word_id.dict" % topic_dir
@@ -205,21 +260,21 @@ def get_count_cooccur(articles, func=generate_cooccurrence_from_int_set):
     count = np.diag(cooccur).copy()
     np.fill_diagonal(cooccur, 0)
     return {"count": count, "cooccur": cooccur,
-            "articles": len(articles)}
+            "articles": articles.shape[0] if sparse.issparse(articles) else len(articles)}
 
 def get_pmi(matrix, topic_count, total,
             num_topics=50,
             add_one=1.0):
     result = matrix.copy()
-    for i in range(num_topics):
-        for j in range(i + 1, num_topics):
-            score = get_log_pmi(matrix[i, j],
-                                      topic_count[i], topic_count[j], total,
-                                      add_one=add_one)
-            if np.isnan(score):
-                score = 0
-            result[i, j] = score
-            result[j, i] = score
+    count = topic_count[:num_topics]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        scores = get_log_pmi(matrix[:num_topics, :num_topics],
+                             count[:, None], count[None, :], total,
+                             add_one=add_one)
+    scores[np.isnan(scores)] = 0
+    # the diagonal is left as it is in matrix
+    off_diagonal = ~np.eye(num_topics, dtype=bool)
+    result[:num_topics, :num_topics][off_diagonal] = scores[off_diagonal]
     print('pmi')
     print(result[:10, :10])
     return result
@@ -230,37 +285,36 @@ def get_log_pmi(xy, x, y, total, add_one=1.0):
     return np.log(xy + add_one) + np.log(total + add_one) \
             - np.log(x + add_one) - np.log(y + add_one)
 
-def get_scores(articles, num_topics, output_dir,
-                               cooccur_func=None):
+def get_scores(articles, num_topics, cooccur_func=None):
     print('Counting co-occurrence...')
     result = get_count_cooccur(articles, func=cooccur_func)
-    np.save('%s/cooccur.npy' %output_dir, result['cooccur'])
-    np.save('%s/topic_count.npy' % output_dir, result['count'])
     print(result['cooccur'][:10, :10])
     print('Getting pmi...')
     # pmi is based on overall co-occurrences
     pmi = get_pmi(result["cooccur"], result["count"],
                   float(result["articles"]), num_topics=num_topics)
-    np.save('%s/pmi.npy' % output_dir, pmi)
-    return pmi
+    return {'topic_count': result['count'], 'cooccur': result['cooccur'], 'pmi': pmi}
 
 
 def main():
+    metrics = Metrics(args.metrics_file)
     print("Loading books...")
-    books = get_book_txts(args.input_dir, splitlines=True)
+    books = get_books(args.input_dir)
+
+    if not books:
+        sys.exit("Error: No .txt files found in %s" % args.input_dir)
 
     print('Combining data and cleaning data...')
+    cleaner = TextCleaner(stem=args.stem, remove_short=True, remove_stopwords=True)
     book_texts = {}
     for k, v in books.items():
-        book_texts[k] = []
-        for line in v:
-            for sent in nltk.sent_tokenize(line):
-                if len(sent) < 15:
-                    continue
-                book_texts[k].append(' '.join(clean_text(sent,
-                                             stem=args.stem,
-                                             remove_short=True,
-                                             remove_stopwords=True)))
+        with metrics.record('clean', title=k) as record:
+            sents = []
+            for line in v:
+                record.count('lines')
+                sents.extend(sent for sent in nltk.sent_tokenize(line) if len(sent) >= 15)
+            book_texts[k] = [' '.join(words) for words in cleaner.clean_many(sents)]
+            record.count('sentences', len(sents))
 
     titles = sorted(books.keys())
     all_text = []
@@ -283,20 +337,33 @@ def main():
 
 
     # generate mallet topics
-    get_mallet_input_from_words(all_text, output_dir)
+    with metrics.record('mallet_input') as record:
+        num_tokens = get_mallet_input_from_words(all_text, output_dir)
+        record.count('documents', len(all_text))
+        record.count('tokens', num_tokens)
+    if args.prepare_only:
+        metrics.close(num_topics=num_topics)
+        return
 
     # run mallet to prepare topics inputs
     # users can also generate mallet-style topic inputs inputs
-    logging.info("running mallet to get topics")
-    if not os.path.exists(os.path.join(args.mallet_dir, 'mallet')):
-        sys.exit("Error: Unable to find mallet at %s" % args.mallet_dir)
-    os.system("./mallet.sh %s %s %d" % (args.mallet_dir,
-                                        output_dir,
-                                        num_topics))
+    if args.engine == 'gensim':
+        logging.info("running gensim to get topics")
+        with metrics.record('gensim') as record:
+            record.count('documents', run_gensim(output_dir, num_topics, args.workers, args.passes))
+    else:
+        logging.info("running mallet to get topics")
+        if not args.mallet_dir or not os.path.exists(os.path.join(args.mallet_dir, 'mallet')):
+            sys.exit("Error: Unable to find mallet at %s" % args.mallet_dir)
+        with metrics.record('mallet'):
+            os.system("./mallet.sh %s %s %d" % (args.mallet_dir,
+                                                output_dir,
+                                                num_topics))
 
 
     # load mallet outputs (threshold for keeping a topic = 0.1)
-    articles, vocab, topic_names = load_articles(all_text, output_dir, threshold=.1)
+    threshold = .1
+    articles, vocab, topic_names = load_articles(all_text, output_dir, threshold=threshold)
     save_topic_names = '%s/topic_names.json' % output_dir
     with open(save_topic_names, 'w') as f:
         f.write(json.dumps(topic_names))
@@ -305,23 +372,34 @@ def main():
 
 
     # compute strength between pairs and generate outputs
-    get_scores(articles, num_topics, output_dir, cooccur_func=cooccur_func)
+    with metrics.record('scores'):
+        scores = get_scores(articles, num_topics, cooccur_func=cooccur_func)
+    for name in ['cooccur', 'topic_count', 'pmi']:
+        np.save('%s/%s.npy' % (output_dir, name), scores[name])
 
     print("Separating topics per book...")
+    book_scores = []
+    book_offsets = [0]
+    for (title, length) in book2length:
+        prev = book_offsets[-1]
+        with metrics.record('scores', title=title):
+            book_scores.append(get_scores(articles[prev:prev + length], num_topics, cooccur_func))
+        book_offsets.append(prev + length)
 
-    doc_topic_file = '%s/doc-topics.gz' % output_dir
-    doc_topics = open(doc_topic_file).read().splitlines()
+    # one file for all books, rather than a directory of files per book
+    doc_topics = load_doc_topic_matrix('%s/doc-topics.gz' % output_dir)
     print(len(doc_topics), 'articles total')
-    prev = 0
-    for (title, length) in book2length:
-        book_output_dir = "%s/%s" % (output_dir, title)
-        if not os.path.exists(book_output_dir):
-            os.makedirs(book_output_dir)
-        with open(book_output_dir + '/doc-topics.gz', 'w') as outf:
-            outf.write('\n'.join(doc_topics[prev:prev + length]))
-
-        get_scores(articles[prev:prev + length], num_topics, book_output_dir, cooccur_func)
-        prev += length
+    arrays = OrderedDict([('doc_topics', doc_topics[:len(all_text)])])
+    for name in ['topic_count', 'cooccur', 'pmi']:
+        arrays[name] = scores[name]
+        arrays['book_' + name] = np.stack([book[name] for book in book_scores])
+    metadata = {'num_topics': num_topics,
+                'threshold': threshold,
+                'titles': [title for title, _ in book2length],
+                'book_offsets': book_offsets,
+                'topic_names': topic_names}
+    write_topic_artifact('%s/%s' % (output_dir, TOPIC_ARTIFACT), metadata, arrays)
+    metrics.close(num_topics=num_topics)
 
 
 if __name__ == "__main__":
@@ -5,89 +5,74 @@ Get Wikidata attributes for names
 import argparse
 from helpers import *
 import os
-import urllib.parse
-from urllib.request import urlopen
 from collections import Counter
 import spacy
 import json
 import codecs
+from wikidata import WIKIDATA_ENDPOINT, WikidataLookup, clean_entity, get_endpoint
 
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True)
 parser.add_argument('--output_dir', required=True)
+parser.add_argument('--endpoint', default=WIKIDATA_ENDPOINT,
+    help="SPARQL endpoint, or a JSON file of canned answers to run offline (see wikidata.py).")
+parser.add_argument('--wikidata_cache', default='results/wikidata_cache.sqlite',
+    help="SQLite file caching Wikidata answers across runs.")
+parser.add_argument('--max_requests', default=4, type=int,
+    help="Number of Wikidata queries sent at the same time.")
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
-def query_for_multiple_properties(person): 
-    return urllib.parse.quote("SELECT ?propLabel ?propertyLabel WHERE { " + \
-      "SERVICE wikibase:label { bd:serviceParam wikibase:language \"[AUTO_LANGUAGE],en\". } " + \
-      "{wd:" + person + " wdt:P21 ?property. " + \
-      "?name ?ref wdt:P21. " + \
-      "?name rdfs:label ?propLabel} " + \
-      "UNION " + \
-      "{wd:" + person + " wdt:P106 ?property. " + \
-      "?name ?ref wdt:P106. " + \
-      "?name rdfs:label ?propLabel} " + \
-      "UNION " + \
-      "{wd:" + person + " wdt:P172 ?property. " + \
-      "?name ?ref wdt:P172. " + \
-      "?name rdfs:label ?propLabel} " + \
-      "FILTER((LANG(?propLabel)) = \"en\") " + \
-      "} LIMIT 100", safe="")
-
-def retrieve_wikidata(entity): 
+def retrieve_wikidata(entities, lookup): 
     """
-    Input 
+    Input: list of entity names
+    Output: {entity : [person_dict]} where person_dict has the name, wikiID and 
+    properties of the first Wikidata match, or [] if there is no match
     """
-    entity = entity.replace("\"", "").replace("—", "").replace("\\","")
-    entity = entity.strip()
-    url_prefix = "https://query.wikidata.org/sparql?format=json&query="
-    query = urllib.parse.quote("SELECT ?item ?itemLabel WHERE {" + \
-    "?item wdt:P31 wd:Q5." + \
-    "?item ?label \"" + entity + "\"@en ." + \
-    "SERVICE wikibase:label { bd:serviceParam wikibase:language \"en\". }" + \
-    "}", safe='')
-    print(entity)
-    url = url_prefix + query
-    res = json.loads(urlopen(url).read())
-    cands = []
-    if len(res['results']['bindings']) > 0:
-        wikiID = res['results']['bindings'][0]['item']['value'].split('/')[-1]
-        name = res['results']['bindings'][0]['itemLabel']['value'].split('/')[-1]
-        person_dict = {}
-        person_dict['name'] = name
-        person_dict['wikiID'] = wikiID
-        query_for_multiple_properties(wikiID)
-        person_url = url_prefix + query_for_multiple_properties(wikiID)
-        response = urlopen(person_url)
-        result = json.loads(response.read())
-        for item in result['results']['bindings']: 
-            label = item["propLabel"]["value"]
-            prop_val = item["propertyLabel"]["value"]
-            if label not in person_dict: 
-                person_dict[label] = [prop_val]
-            else: 
-                person_dict[label].append(prop_val)
-        cands.append(person_dict)
-    return cands
+    names = {entity: clean_entity(entity).strip() for entity in entities}
+    people = lookup.find_people(names.values())
+    wikiIDs = [people[name][0][1] for name in names.values() if len(people[name]) > 0]
+    properties = lookup.get_properties(wikiIDs)
+    wikidata_dict = {}
+    for entity, name in names.items(): 
+        cands = []
+        if len(people[name]) > 0: 
+            wikiname, wikiID = people[name][0]
+            person_dict = {}
+            person_dict['name'] = wikiname
+            person_dict['wikiID'] = wikiID
+            for label, prop_vals in properties[wikiID].items(): 
+                person_dict[label] = list(prop_vals)
+            cands.append(person_dict)
+        wikidata_dict[entity] = cands
+    return wikidata_dict
 
 
 def main():
-    wikidata_dict = {}
-    num_ambig = 0
+    metrics = Metrics(args.metrics_file)
+    entities = []
+    seen = set()
     for f in os.listdir(args.input_dir): 
         with open(os.path.join(args.input_dir, f), 'r', encoding='utf-8') as infile: 
             for line in infile: 
                 contents = line.strip().split(',')
                 count = contents[1]
                 entity = contents[0]
-                if entity in wikidata_dict:
+                if entity in seen:
                     continue
                 if len(entity.split()) > 1: 
-                    cands = retrieve_wikidata(entity) 
-                    if len(cands) > 1: num_ambig += 1
-                    wikidata_dict[entity] = cands
+                    seen.add(entity)
+                    entities.append(entity)
+    lookup = WikidataLookup(get_endpoint(args.endpoint), cache_path=args.wikidata_cache, 
+                            max_requests=args.max_requests)
+    with metrics.record('wikidata') as record:
+        wikidata_dict = retrieve_wikidata(entities, lookup)
+        record.count('names', len(entities))
+        record.count('http_requests', lookup.requests)
+        record.count('cache_hits', lookup.cache_hits)
+    num_ambig = sum(len(cands) > 1 for cands in wikidata_dict.values())
     print("Number of entities total", len(wikidata_dict))
     print("Number of entities with multiple wikidata entries:", num_ambig) 
     with open(os.path.join(args.output_dir, 'wikidata_attributes.csv'), 'w') as outfile: 
@@ -111,6 +96,7 @@ def main():
                 else: 
                     outfile.write('None')
                 outfile.write('\n')
+    metrics.close()
 
 
 if __name__ == '__main__':
@@ -11,23 +11,32 @@ parser.add_argument("--output",
                     help=("Output file for word counts."),
                     type=str)
 parser.add_argument('--stem', action='store_true', help="Whether to stem words.")
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
 def main():
+    metrics = Metrics(args.metrics_file)
     print("Loading books...")
-    books = get_book_txts(args.input_dir, splitlines=False)
+    books = get_books(args.input_dir)
 
-    all_text = []
+    cleaner = TextCleaner(stem=args.stem, remove_short=True, remove_stopwords=True)
+    counts = Counter()
     print("Counting words...")
     for k, v in books.items():
         print(k)
-        all_text.extend(clean_text(v, stem=args.stem, remove_short=True, remove_stopwords=True))
+        with metrics.record('book', title=k) as record:
+            for line in v:
+                tokens = cleaner.clean(line)
+                counts.update(tokens)
+                record.count('lines')
+                record.count('tokens', len(tokens))
 
-    counts = Counter(all_text).most_common()
+    counts = counts.most_common()
     with open(args.output, "w") as f:
         for w, c in counts:
             f.write("%s\t%d\n" % (w, c))
+    metrics.close(words=len(counts))
 
 if __name__ == "__main__":
     main()
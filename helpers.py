@@ -1,14 +1,28 @@
 #!/usr/bin/env python
 # -*- coding: utf-8 -*-
 # Authors: Dora Demszky (ddemszky@stanford.edu) and Lucy Li (lucy3_li@berkeley.edu)
+import bisect
 import codecs
 import glob
+import hashlib
+import itertools
+import json
+import mmap
+import os
 import string
+import struct
 import nltk
+import numpy as np
+import pandas as pd
 import re
+import sys
+import time
 from gensim.models import KeyedVectors
 import seaborn as sns
-from collections import defaultdict
+from array import array
+from collections import Counter, defaultdict, deque, OrderedDict
+from collections.abc import Mapping
+from contextlib import contextmanager
 
 punct_chars = list((set(string.punctuation) | {'»', '–', '—', '-',"­", '\xad', '-', '◾', '®', '©','✓','▲', '◄','▼','►', '~', '|', '“', '”', '…', "'", "`", '_', '•', '*', '■'} - {"'"}))
 punct_chars.sort()
@@ -43,35 +57,128 @@ def get_word_to_category(people_terms_path):
             word2dem[contents[0]].append(contents[1])
     return word2dem
 
+url_pattern = re.compile(r'http\S*|\S*\.com\S*|\S*www\S*')
+
+class CleaningTable(dict):
+    '''
+    Translation table for str.translate that replaces punctuation and
+    whitespace with a space and drops any other non-printable character.
+    Entries are filled in the first time a character is seen.
+    '''
+    def __missing__(self, key):
+        c = chr(key)
+        if c in punctuation or c.isspace():
+            value = ' '
+        elif c in printable:
+            value = c
+        else:
+            value = None
+        self[key] = value
+        return value
+
+class TextCleaner:
+    '''
+    Tokenizes and cleans text the same way as clean_text, but loads the
+    stopwords and builds its tables once, so it should be created once and
+    reused for every sentence.
+
+    Example usage:
+    cleaner = TextCleaner(stem=True)
+    sentences = cleaner.clean_many(nltk.sent_tokenize(book))
+    '''
+    def __init__(self,
+                 remove_stopwords=True,
+                 remove_numeric=True,
+                 stem=False,
+                 remove_short=True,
+                 stopwords_file="wordlists/stopwords/en/mallet.txt"):
+        self.remove_numeric = remove_numeric
+        self.stem = stem
+        self.remove_short = remove_short
+        self.stopwords = frozenset()
+        if remove_stopwords:
+            with open(stopwords_file, "r") as infile:
+                self.stopwords = frozenset(infile.read().splitlines())
+        self.table = CleaningTable()
+        self.stems = {}
+
+    def get_stem(self, word):
+        stem = self.stems.get(word)
+        if stem is None:
+            stem = sno.stem(word)
+            self.stems[word] = stem
+        return stem
+
+    def clean(self, text):
+        # lower case and eliminate urls
+        text = url_pattern.sub(' ', text.lower())
+        # substitute punctuation and whitespace with a space and drop
+        # non-printable chars
+        words = text.translate(self.table).split()
+        if self.stopwords:
+            words = [w for w in words if w not in self.stopwords]
+        if self.remove_numeric:
+            words = [w for w in words if not w.isdigit()]
+        if self.stem:
+            words = [self.get_stem(w) for w in words]
+        if self.remove_short:
+            words = [w for w in words if len(w) >= 3]
+        return words
+
+    def clean_many(self, texts):
+        '''
+        Cleans every text in an iterable, yielding one list of words per text.
+        '''
+        for text in texts:
+            yield self.clean(text)
+
+_cleaners = {}
+
+def get_log_odds(counts1, counts2, prior):
+    '''
+    Computes the "weighted log-odds-ratio, informative dirichlet prior"
+    z-scores from page 388 of Monroe, Colaresi, and Quinn (2009), the same as
+    bayesequal.py, for every word at once.
+    @inputs:
+    - counts1, counts2, prior: arrays of counts aligned to one vocabulary
+      (words that occur in either group should have a prior count of at least 1)
+    @output:
+    - an array of z-scores, which is nan for words whose prior count is 0
+    '''
+    counts1 = np.floor(np.asarray(counts1, dtype=float) + 0.5)
+    counts2 = np.floor(np.asarray(counts2, dtype=float) + 0.5)
+    prior = np.floor(np.asarray(prior, dtype=float) + 0.5)
+    n1 = counts1.sum()
+    n2 = counts2.sum()
+    nprior = prior.sum()
+    scores = np.full(prior.shape, np.nan)
+    keep = prior > 0
+    a1 = counts1[keep] + prior[keep]
+    a2 = counts2[keep] + prior[keep]
+    l1 = a1 / ((n1 + nprior) - a1)
+    l2 = a2 / ((n2 + nprior) - a2)
+    sigma = np.sqrt(1 / a1 + 1 / a2)
+    scores[keep] = (np.log(l1) - np.log(l2)) / sigma
+    return scores
+
+def format_log_odds(vocab, scores):
+    '''
+    Lines of "word z-score", from most associated with the second group to
+    most associated with the first.
+    '''
+    order = np.argsort(scores, kind='stable')
+    return ["%s %.3f" % (vocab[i], scores[i]) for i in order if not np.isnan(scores[i])]
+
 def clean_text(text,
                remove_stopwords=True,
                remove_numeric=True,
                stem=False,
                remove_short=True,
                stopwords_file="wordlists/stopwords/en/mallet.txt"):
-    # lower case
-    text = text.lower()
-    # eliminate urls
-    text = re.sub(r'http\S*|\S*\.com\S*|\S*www\S*', ' ', text)
-    # substitute all other punctuation with whitespace
-    text = replace.sub(' ', text)
-    # replace all whitespace with a single space
-    text = re.sub(r'\s+', ' ', text)
-    # strip off spaces on either end
-    text = text.strip()
-    # make sure all chars are printable
-    text = ''.join([c for c in text if c in printable])
-    words = text.split()
-    if remove_stopwords:
-        stopwords = open(stopwords_file, "r").read().splitlines()
-        words = [w for w in words if w not in stopwords]
-    if remove_numeric:
-        words = [w for w in words if not w.isdigit()]
-    if stem:
-        words = [sno.stem(w) for w in words]
-    if remove_short:
-        words = [w for w in words if len(w) >= 3]
-    return words
+    key = (remove_stopwords, remove_numeric, stem, remove_short, stopwords_file)
+    if key not in _cleaners:
+        _cleaners[key] = TextCleaner(*key)
+    return _cleaners[key].clean(text)
 
 def get_book_txts(path, splitlines=False):
     print('Getting books...')
@@ -87,11 +194,507 @@ def get_book_txts(path, splitlines=False):
     print("Finished getting books.")
     return books
 
+class Book:
+    '''
+    The lines of one textbook, read lazily from disk. Lines are split the
+    same way as str.splitlines, so a Book gives the same lines as
+    get_book_txts(path, splitlines=True), without holding the text in memory.
+
+    Iterating streams lines through a memory map of the file. len(), indexing
+    and slicing (book[i:j]) build an index of line offsets the first time they
+    are used, after which any range of lines is read without scanning the
+    lines before it.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.title = path.split('/')[-1].split(".")[0]
+        self.starts = None # byte offset of each '\n'-terminated line
+        self.counts = None # number of lines before each '\n'-terminated line
+
+    def raw_lines(self, offset=0):
+        '''
+        Yields (byte offset, bytes) for each '\n'-terminated line from offset
+        on, including the '\n'.
+        '''
+        with open(self.path, 'rb') as infile:
+            if os.fstat(infile.fileno()).st_size == 0:
+                return
+            with mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                size = len(mm)
+                while offset < size:
+                    end = mm.find(b'\n', offset) + 1
+                    if end == 0:
+                        end = size
+                    yield offset, mm[offset:end]
+                    offset = end
+
+    @staticmethod
+    def split_raw_line(raw):
+        # other line boundaries (e.g. \r, \x0c, \u2028) may be inside the line
+        return raw.decode('utf-8').splitlines()
+
+    def __iter__(self):
+        for _, raw in self.raw_lines():
+            for line in self.split_raw_line(raw):
+                yield line
+
+    def build_index(self):
+        if self.starts is not None:
+            return
+        starts = array('q')
+        counts = array('q')
+        total = 0
+        for offset, raw in self.raw_lines():
+            starts.append(offset)
+            counts.append(total)
+            total += len(self.split_raw_line(raw))
+        counts.append(total)
+        self.starts, self.counts = starts, counts
+
+    def __len__(self):
+        self.build_index()
+        return self.counts[-1]
+
+    def lines(self, start, end):
+        '''
+        Returns lines start to end (exclusive) as a list.
+        '''
+        self.build_index()
+        start, end = max(start, 0), min(end, self.counts[-1])
+        if start >= end:
+            return []
+        idx = bisect.bisect_right(self.counts, start) - 1
+        skip = start - self.counts[idx]
+        result = []
+        for _, raw in self.raw_lines(self.starts[idx]):
+            result.extend(self.split_raw_line(raw))
+            if len(result) >= skip + end - start:
+                break
+        return result[skip:skip + end - start]
+
+    def __getitem__(self, key):
+        if isinstance(key, slice):
+            start, end, step = key.indices(len(self))
+            if step != 1:
+                return self.lines(0, len(self))[key]
+            return self.lines(start, end)
+        if key < 0:
+            key += len(self)
+        if not 0 <= key < len(self):
+            raise IndexError('line index out of range')
+        return self.lines(key, key + 1)[0]
+
+    def chunks(self, size):
+        '''
+        Yields (index of first line, list of lines) for consecutive chunks of
+        size lines, streaming through the file once.
+        '''
+        lines = iter(self)
+        start = 0
+        while True:
+            chunk = list(itertools.islice(lines, size))
+            if not chunk:
+                return
+            yield start, chunk
+            start += len(chunk)
+
+    def read(self):
+        with codecs.open(self.path, 'r', encoding='utf-8') as infile:
+            return infile.read()
+
+class BookCorpus(Mapping):
+    '''
+    Dictionary of title to Book for every *.txt file in a directory, in the
+    same order as get_book_txts. Books are only read when they are iterated.
+    '''
+    def __init__(self, path):
+        bookfiles = sorted([f for f in glob.glob(path + '/*.txt')])
+        self.books = OrderedDict()
+        for f in bookfiles:
+            book = Book(f)
+            self.books[book.title] = book
+
+    def __getitem__(self, title):
+        return self.books[title]
+
+    def __iter__(self):
+        return iter(self.books)
+
+    def __len__(self):
+        return len(self.books)
+
+def get_books(path):
+    '''
+    Lazy alternative to get_book_txts(path, splitlines=True): the values are
+    Books, which can be iterated, sliced and measured like lists of lines.
+    Scripts that stream the lines keep memory use independent of the size
+    of the books; get_topics.py still gathers every cleaned sentence in a
+    list before writing MALLET's input.
+    '''
+    books = BookCorpus(path)
+    print('Found %d books.' % len(books))
+    return books
+
+def bounded_imap(pool, func, tasks, window):
+    '''
+    Like pool.imap(func, tasks), but with at most window tasks submitted
+    and not yet yielded, so that a long stream of tasks (e.g. chunks of a
+    large book) is not loaded into memory all at once. A new task is
+    submitted as each result is yielded, in order, so the pool is kept busy.
+    '''
+    tasks = iter(tasks)
+    pending = deque(pool.apply_async(func, (task,)) for task in itertools.islice(tasks, window))
+    while pending:
+        result = pending.popleft().get()
+        for task in itertools.islice(tasks, 1):
+            pending.append(pool.apply_async(func, (task,)))
+        yield result
+
+def get_file_hash(path, block_size=1 << 20):
+    '''
+    sha1 of a file's contents, read in blocks.
+    '''
+    h = hashlib.sha1()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b''):
+            h.update(block)
+    return h.hexdigest()
+
+def write_json_atomic(path, obj):
+    '''
+    Writes obj as JSON so that path always holds either the old or the new
+    contents, even if the process is killed while writing.
+    '''
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'w') as outfile:
+        json.dump(obj, outfile, indent=2, sort_keys=True)
+    os.replace(tmp_path, path)
+
+def get_peak_rss_mb(children=False):
+    '''
+    Peak resident memory of this process (or of its largest finished child
+    process, e.g. a pool worker), in MB. None where the resource module is
+    not available (it is Unix only).
+    '''
+    try:
+        import resource
+    except ImportError:
+        return None
+    usage = resource.getrusage(resource.RUSAGE_CHILDREN if children else resource.RUSAGE_SELF)
+    # ru_maxrss is in bytes on macOS and in KB elsewhere
+    return usage.ru_maxrss / (1024 * 1024 if sys.platform == 'darwin' else 1024)
+
+class MetricsRecord:
+    '''
+    Counters and timers for one unit of work, e.g. a book or a stage. Used
+    as a context manager (see Metrics.record), it is written out on exit
+    along with its wall time and the rate of each counter per second.
+
+    Pool workers can create a MetricsRecord() of their own, return
+    get_stats(), and the main process adds it to its record with update().
+    Rates are then per second of the workers' time rather than wall time.
+    '''
+    def __init__(self, metrics=None, event=None, fields=None):
+        self.metrics = metrics
+        self.event = event
+        self.fields = fields or {}
+        self.counts = Counter()
+        self.times = Counter() # seconds
+        self.created = time.perf_counter()
+        self.worker_seconds = 0.0
+        self.start = None
+
+    def count(self, name, n=1):
+        self.counts[name] += n
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.times[name] += time.perf_counter() - start
+
+    def timed(self, iterable, name=None, rest=None):
+        '''
+        Yields from iterable, adding the time spent producing each item
+        (e.g. parsing a doc in nlp.pipe) to the timer name, and the time
+        spent by the caller on each item to the timer rest. Leave out name
+        if the iterable records its own timers (e.g. doc_cache.get_docs).
+        '''
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                if name is not None:
+                    self.times[name] += time.perf_counter() - start
+                return
+            resumed = time.perf_counter()
+            if name is not None:
+                self.times[name] += resumed - start
+            yield item
+            if rest is not None:
+                self.times[rest] += time.perf_counter() - resumed
+
+    def get_stats(self):
+        return {'counts': dict(self.counts), 'times': dict(self.times),
+                'seconds': time.perf_counter() - self.created}
+
+    def update(self, stats):
+        self.counts.update(stats['counts'])
+        self.times.update(stats['times'])
+        self.worker_seconds += stats['seconds']
+
+    def get_row(self, seconds):
+        row = {'event': self.event}
+        row.update(self.fields)
+        row['seconds'] = round(seconds, 4)
+        if self.worker_seconds:
+            row['worker_seconds'] = round(self.worker_seconds, 4)
+        work_seconds = self.worker_seconds or seconds
+        for name, n in sorted(self.counts.items()):
+            row[name] = n
+            if work_seconds > 0:
+                row[name + '_per_sec'] = round(n / work_seconds, 2)
+        for name, t in sorted(self.times.items()):
+            row[name + '_seconds'] = round(t, 4)
+        peak_rss_mb = get_peak_rss_mb()
+        if peak_rss_mb is not None:
+            row['peak_rss_mb'] = round(peak_rss_mb, 1)
+        return row
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def write(self, seconds):
+        '''
+        Writes the record with its wall time as seconds, e.g. the time a
+        worker measured, and adds it to the totals of the run.
+        '''
+        self.metrics.write(self.get_row(seconds))
+        self.metrics.totals.counts.update(self.counts)
+        self.metrics.totals.times.update(self.times)
+
+    def __exit__(self, *exc):
+        self.write(time.perf_counter() - self.start)
+        return False
+
+class Metrics:
+    '''
+    Writes metrics for one run of a script as JSON lines, one per record and
+    one for the whole run (event "run") when the script calls close(). Every
+    line has the script name and a run id, so several runs can share a file.
+    If path is empty, nothing is written.
+
+    metrics = Metrics(args.metrics_file)
+    for title, textbook_lines in books.items():
+        with metrics.record('book', title=title) as m:
+            for doc in m.timed(nlp.pipe(textbook_lines), 'spacy'):
+                m.count('lines')
+    metrics.close()
+    '''
+    def __init__(self, path=None):
+        self.path = path
+        self.script = os.path.basename(sys.argv[0])
+        self.run_id = '%s-%d' % (time.strftime('%Y%m%dT%H%M%S'), os.getpid())
+        self.start = time.perf_counter()
+        self.totals = MetricsRecord(self, 'run')
+        if path and os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    def record(self, event, **fields):
+        return MetricsRecord(self, event, fields)
+
+    def write(self, row):
+        if not self.path:
+            return
+        row = dict(script=self.script, run_id=self.run_id, **row)
+        with open(self.path, 'a') as outfile:
+            outfile.write(json.dumps(row) + '\n')
+
+    def close(self, **fields):
+        '''
+        Writes the totals of all records, along with fields (e.g. settings
+        such as the number of processes).
+        '''
+        self.totals.fields.update(fields)
+        row = self.totals.get_row(time.perf_counter() - self.start)
+        children_peak_rss_mb = get_peak_rss_mb(children=True)
+        if children_peak_rss_mb is not None:
+            row['children_peak_rss_mb'] = round(children_peak_rss_mb, 1)
+        self.write(row)
+
+def count_lines(path, block_size=1 << 20):
+    num_lines = 0
+    last = b'\n'
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(block_size), b''):
+            num_lines += block.count(b'\n')
+            last = block[-1:]
+    # the last line may not end with a newline
+    return num_lines + (last != b'\n')
+
+def load_doc_topic_matrix(doc_topic_file, chunk_size=100000):
+    '''
+    The topic proportions of each document in a MALLET doc-topics file
+    (--output-doc-topics), as a float32 array of shape (documents, topics).
+    The text is parsed once into doc_topic_file + '.npy', which later calls
+    memory-map, so slicing rows or thresholding does not read the text again.
+    The cache is rebuilt if the text file is newer.
+    '''
+    cache_path = doc_topic_file + '.npy'
+    if os.path.isfile(cache_path) and os.path.getmtime(cache_path) >= os.path.getmtime(doc_topic_file):
+        return np.load(cache_path, mmap_mode='r')
+    num_docs = count_lines(doc_topic_file)
+    with open(doc_topic_file, 'r') as infile:
+        # each line is the document's number and name, then a proportion per topic
+        num_topics = max(len(infile.readline().split()) - 2, 0)
+    tmp_path = cache_path + '.tmp'
+    matrix = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.float32, shape=(num_docs, num_topics))
+    row = 0
+    if num_docs > 0:
+        # MALLET names the file .gz, but it is plain text
+        chunks = pd.read_csv(doc_topic_file, sep=r'\s+', header=None, usecols=range(2, num_topics + 2),
+                             dtype=np.float32, chunksize=chunk_size, compression=None)
+        for chunk in chunks:
+            matrix[row:row + len(chunk)] = chunk.values
+            row += len(chunk)
+    if row != num_docs:
+        raise ValueError('%s: expected %d documents, read %d' % (doc_topic_file, num_docs, row))
+    matrix.flush()
+    del matrix
+    os.replace(tmp_path, cache_path)
+    return np.load(cache_path, mmap_mode='r')
+
+def write_mallet_topics(lda, corpus, doc_topic_file, topic_word_file, token=str,
+                        num_top_words=500, chunk_size=10000):
+    '''
+    Writes the topics of a gensim LDA model in the formats MALLET writes
+    with --output-doc-topics and --output-topic-keys, so that the rest of
+    the pipeline reads them the same way.
+    @inputs:
+    - lda: trained gensim LdaModel (or LdaMulticore)
+    - corpus: the bag-of-words documents, in order
+    - token: function giving the token MALLET would print for a word id
+    '''
+    with open(doc_topic_file, 'w') as outfile:
+        docs = iter(corpus)
+        doc_id = 0
+        for chunk in iter(lambda: list(itertools.islice(docs, chunk_size)), []):
+            # one inference call per chunk, rather than one per document
+            gamma, _ = lda.inference(chunk)
+            proportions = gamma / gamma.sum(axis=1, keepdims=True)
+            for row in proportions:
+                outfile.write('%d\t%d\t%s\n' % (doc_id, doc_id + 1, '\t'.join('%g' % p for p in row)))
+                doc_id += 1
+    alpha = np.broadcast_to(lda.alpha, (lda.num_topics,))
+    top_words = np.argsort(-lda.get_topics(), axis=1, kind='stable')[:, :num_top_words]
+    with open(topic_word_file, 'w') as outfile:
+        for topic_id, words in enumerate(top_words):
+            outfile.write('%d\t%g\t%s\n' % (topic_id, alpha[topic_id], ' '.join(token(w) for w in words)))
+
+TOPIC_ARTIFACT = 'topic_artifact.bin'
+ARTIFACT_MAGIC = b'TOPICS\x00\x01'
+ARTIFACT_ALIGNMENT = 64
+
+def align(n, alignment=ARTIFACT_ALIGNMENT):
+    return -(-n // alignment) * alignment
+
+def write_topic_artifact(path, metadata, arrays, chunk_size=100000):
+    '''
+    Writes arrays (an ordered dict of name : array, possibly memory-mapped)
+    and metadata (anything JSON-serializable) to the single file read by
+    TopicArtifact. The file is a magic string, the length of a JSON header
+    with metadata and the dtype, shape and offset of each array, and then
+    the arrays, each starting at a multiple of 64 bytes. Large arrays are
+    copied chunk_size rows at a time, and the file is written under a
+    temporary name first, so readers never see a partial file.
+    '''
+    specs = OrderedDict()
+    offset = 0
+    for name, a in arrays.items():
+        specs[name] = {'dtype': a.dtype.str, 'shape': list(a.shape), 'offset': offset}
+        offset += align(a.nbytes)
+    header = json.dumps({'metadata': metadata, 'arrays': specs}).encode('utf-8')
+    data_start = align(len(ARTIFACT_MAGIC) + 8 + len(header))
+    tmp_path = path + '.tmp'
+    with open(tmp_path, 'wb') as outfile:
+        outfile.write(ARTIFACT_MAGIC)
+        outfile.write(struct.pack('<Q', len(header)))
+        outfile.write(header)
+        for name, a in arrays.items():
+            outfile.seek(data_start + specs[name]['offset'])
+            for i in range(0, len(a), chunk_size):
+                outfile.write(np.ascontiguousarray(a[i:i + chunk_size]).tobytes())
+        outfile.truncate(data_start + offset)
+    os.replace(tmp_path, path)
+
+class TopicArtifact:
+    '''
+    A topic model's outputs for all books, written by get_topics.py as one
+    file (see write_topic_artifact) and memory-mapped with a single open, so
+    only the parts that are used are read. Arrays:
+    - doc_topics: topic proportions of each sentence, with the books' sentences
+      one after another
+    - topic_count, cooccur, pmi: over all books, as in get_topics.get_scores
+    - book_topic_count, book_cooccur, book_pmi: the same for each book, stacked
+      in the order of titles
+    metadata has the titles, book_offsets (the first sentence of each book,
+    plus the total), topic_names, num_topics and the threshold above which
+    a topic counts as present in a sentence.
+
+    Example usage:
+    artifact = TopicArtifact('topics/topics_70/topic_artifact.bin')
+    pmi = artifact.get('pmi', title)
+    '''
+    def __init__(self, path):
+        with open(path, 'rb') as infile:
+            if infile.read(len(ARTIFACT_MAGIC)) != ARTIFACT_MAGIC:
+                raise ValueError('%s is not a topic artifact' % path)
+            header_length, = struct.unpack('<Q', infile.read(8))
+            header = json.loads(infile.read(header_length).decode('utf-8'))
+            self.buffer = mmap.mmap(infile.fileno(), 0, access=mmap.ACCESS_READ)
+        data_start = align(len(ARTIFACT_MAGIC) + 8 + header_length)
+        self.metadata = header['metadata']
+        self.arrays = {}
+        for name, spec in header['arrays'].items():
+            shape = tuple(spec['shape'])
+            self.arrays[name] = np.frombuffer(self.buffer, dtype=np.dtype(spec['dtype']), count=int(np.prod(shape)),
+                                              offset=data_start + spec['offset']).reshape(shape)
+        self.titles = self.metadata['titles']
+        self.title2index = {title: i for i, title in enumerate(self.titles)}
+
+    def get(self, name, title=None):
+        '''
+        The array name for all books, or for the book title.
+        '''
+        if title is None:
+            return self.arrays[name]
+        return self.arrays['book_' + name][self.title2index[title]]
+
+    def get_doc_topics(self, title=None):
+        if title is None:
+            return self.arrays['doc_topics']
+        i = self.title2index[title]
+        offsets = self.metadata['book_offsets']
+        return self.arrays['doc_topics'][offsets[i]:offsets[i + 1]]
+
 def get_models(filelist):
     model_files = [f for f in filelist if f.endswith('.wv')]
     models = [KeyedVectors.load(fname, mmap='r') for fname in model_files]
     return models
 
+def get_unit_vectors(model, words):
+    '''
+    Matrix of the model's vectors for words, one row per word, normalized
+    so that dot products are cosine similarities.
+    '''
+    vectors = np.asarray(model[list(words)], dtype=np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
 title_abbreviations = {
     "America_A_Narrative_History_WWNorton_10th": "Am. Narr. Hist., W.W.N.",
     "America_Past_And_Present_Pearson_10th": "Am. Past & Present, Pearson",
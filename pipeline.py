@@ -0,0 +1,303 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Runs the analysis scripts as one pipeline, only redoing what is out of date.
+
+The stages are declared in pipeline.json: each has a script, its arguments,
+and the files or directories it reads (inputs) and writes (outputs), which
+may refer to shared parameters such as "{coref_dir}". A stage depends on
+every stage that writes one of its inputs.
+
+Before a stage runs, it is fingerprinted by the contents of its inputs, its
+script (and the local modules that script imports) and its arguments. If the
+fingerprint matches the last successful run and its outputs exist, the stage
+is skipped. A stage may also read one of its own outputs (such as a cache of
+Wikidata names): it need not exist before the first run, and the stage is
+fingerprinted again once it has rewritten it. So editing wordlists/people_terms.csv reruns the mention and
+descriptor stages (and whatever reads their outputs), but not coref or the
+topic model. Stages whose dependencies are finished run at the same time, up
+to --jobs at once.
+
+python pipeline.py                         # bring every stage up to date
+python pipeline.py descriptors log_odds    # only these and what they need
+python pipeline.py --dry_run               # print what would run
+python pipeline.py --set num_topics=50 topics
+'''
+import argparse
+import hashlib
+import json
+import os
+import re
+import subprocess
+import sys
+import threading
+import time
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+
+from helpers import get_file_hash, write_json_atomic
+
+REPO_DIR = os.path.dirname(os.path.abspath(__file__))
+
+class Stage:
+    def __init__(self, name, spec, params):
+        self.name = name
+        self.script = spec['script']
+        self.args = {k: render(v, params) for k, v in spec.get('args', {}).items()}
+        self.inputs = [os.path.normpath(render(p, params)) for p in spec.get('inputs', [])]
+        self.outputs = [os.path.normpath(render(p, params)) for p in spec.get('outputs', [])]
+        self.deps = set()
+
+    def get_command(self):
+        command = [sys.executable, os.path.join(REPO_DIR, self.script)]
+        for key, value in self.args.items():
+            if value is True:
+                command.append('--' + key)
+            elif value is not False and value is not None:
+                command.extend(['--' + key, str(value)])
+        return command
+
+def render(value, params):
+    if isinstance(value, str):
+        return value.format(**params)
+    return value
+
+def overlaps(path1, path2):
+    '''
+    True if one path is the same as, or inside, the other.
+    '''
+    return path1 == path2 or path1.startswith(path2 + os.sep) or path2.startswith(path1 + os.sep)
+
+def load_stages(config_path, overrides):
+    with open(config_path, 'r') as infile:
+        config = json.load(infile)
+    params = dict(config.get('params', {}))
+    params.update(overrides)
+    stages = {name: Stage(name, spec, params) for name, spec in config['stages'].items()}
+    for stage in stages.values():
+        for other in stages.values():
+            if other is not stage and any(overlaps(i, o) for i in stage.inputs for o in other.outputs):
+                stage.deps.add(other.name)
+    get_order(stages, stages) # fails on cycles
+    return stages
+
+def get_order(stages, names):
+    '''
+    names and everything they depend on, dependencies first.
+    '''
+    order = []
+    state = {} # name : 'visiting' or 'done'
+    def visit(name, path):
+        if state.get(name) == 'done':
+            return
+        if state.get(name) == 'visiting':
+            raise ValueError('Stages depend on each other: ' + ' -> '.join(path + [name]))
+        state[name] = 'visiting'
+        for dep in sorted(stages[name].deps):
+            visit(dep, path + [name])
+        state[name] = 'done'
+        order.append(name)
+    for name in names:
+        visit(name, [])
+    return order
+
+def get_local_modules(script, seen=None):
+    '''
+    The script and the modules of this repo it imports, directly or not.
+    '''
+    seen = set() if seen is None else seen
+    path = os.path.join(REPO_DIR, script)
+    if script in seen or not os.path.isfile(path):
+        return seen
+    seen.add(script)
+    with open(path, 'r', encoding='utf-8') as infile:
+        for module in re.findall(r'^\s*(?:from|import)\s+(\w+)', infile.read(), flags=re.M):
+            get_local_modules(module + '.py', seen)
+    return seen
+
+class PipelineState:
+    '''
+    Fingerprint of each stage's last successful run, and the hashes of the
+    files seen so far, keyed on their size and modification time so that
+    unchanged files are not read again.
+    '''
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.fingerprints = {}
+        self.file_hashes = {}
+        if os.path.isfile(path):
+            with open(path, 'r') as infile:
+                saved = json.load(infile)
+            self.fingerprints = saved.get('fingerprints', {})
+            self.file_hashes = saved.get('file_hashes', {})
+
+    def get_file_hash(self, path):
+        stat = os.stat(path)
+        key = '%d:%d' % (stat.st_size, stat.st_mtime_ns)
+        with self.lock:
+            cached = self.file_hashes.get(path)
+        if cached is not None and cached[0] == key:
+            return cached[1]
+        h = get_file_hash(path)
+        with self.lock:
+            self.file_hashes[path] = [key, h]
+        return h
+
+    def get_path_hash(self, path, exclude=()):
+        '''
+        Hash of a file, or of every file in a directory, leaving out the
+        paths in exclude. None if the path does not exist.
+        '''
+        if os.path.isfile(path):
+            return self.get_file_hash(path)
+        if not os.path.isdir(path):
+            return None
+        h = hashlib.sha1()
+        for root, dirs, files in os.walk(path):
+            dirs.sort()
+            for f in sorted(files):
+                file_path = os.path.join(root, f)
+                if any(overlaps(file_path, e) for e in exclude):
+                    continue
+                h.update(os.path.relpath(file_path, path).encode('utf-8') + b'\0')
+                h.update(self.get_file_hash(file_path).encode('ascii'))
+        return h.hexdigest()
+
+    def get_fingerprint(self, stage):
+        missing = [p for p in stage.inputs if not os.path.exists(p) and p not in stage.outputs]
+        if missing:
+            raise FileNotFoundError('missing input ' + ', '.join(missing))
+        parts = {
+            'command': stage.get_command()[1:],
+            'code': {m: self.get_file_hash(os.path.join(REPO_DIR, m))
+                     for m in sorted(get_local_modules(stage.script))},
+            # a stage's own outputs may sit inside its inputs (e.g. a topic
+            # directory), and are not part of what it reads
+            'inputs': {p: self.get_path_hash(p, exclude=stage.outputs) for p in stage.inputs},
+        }
+        return hashlib.sha1(json.dumps(parts, sort_keys=True).encode('utf-8')).hexdigest()
+
+    def is_current(self, stage, fingerprint):
+        return self.fingerprints.get(stage.name) == fingerprint and \
+            all(os.path.exists(p) for p in stage.outputs)
+
+    def record(self, stage, fingerprint):
+        with self.lock:
+            self.fingerprints[stage.name] = fingerprint
+            write_json_atomic(self.path, {'fingerprints': self.fingerprints,
+                                          'file_hashes': self.file_hashes})
+
+def run_stage(stage, state, log_dir, force):
+    '''
+    Runs the stage if it is out of date.
+    @output:
+    - True if the stage ran, False if it was up to date
+    '''
+    fingerprint = state.get_fingerprint(stage)
+    if not force and state.is_current(stage, fingerprint):
+        print('[%s] up to date' % stage.name)
+        return False
+    log_path = os.path.join(log_dir, stage.name + '.log')
+    print('[%s] running (log in %s)' % (stage.name, log_path))
+    start = time.time()
+    with open(log_path, 'w') as log:
+        log.write(' '.join(stage.get_command()) + '\n')
+        log.flush()
+        returncode = subprocess.call(stage.get_command(), stdout=log, stderr=subprocess.STDOUT)
+    if returncode != 0:
+        raise RuntimeError('%s: failed with exit code %d, see %s' % (stage.name, returncode, log_path))
+    # inputs may not change while a stage runs, so the fingerprint still holds,
+    # unless the stage rewrote one of its own inputs
+    if set(stage.inputs) & set(stage.outputs):
+        fingerprint = state.get_fingerprint(stage)
+    state.record(stage, fingerprint)
+    print('[%s] done in %.1fs' % (stage.name, time.time() - start))
+    return True
+
+def dry_run(stages, order, state):
+    stale = set()
+    for name in order:
+        stage = stages[name]
+        if stage.deps & stale:
+            stale.add(name)
+            print('[%s] would run after %s' % (name, ', '.join(sorted(stage.deps & stale))))
+            continue
+        try:
+            fingerprint = state.get_fingerprint(stage)
+        except FileNotFoundError as e:
+            stale.add(name)
+            print('[%s] cannot run: %s' % (name, e))
+            continue
+        if state.is_current(stage, fingerprint):
+            print('[%s] up to date' % name)
+        else:
+            stale.add(name)
+            print('[%s] would run' % name)
+
+def run(stages, order, state, jobs, log_dir, force=False):
+    '''
+    Runs the stages in order, starting each one as soon as all of its
+    dependencies have finished, with at most jobs running at a time.
+    @output:
+    - names of the stages that failed or could not run
+    '''
+    os.makedirs(log_dir, exist_ok=True)
+    pending = list(order)
+    finished, failed = set(), set()
+    running = {} # future : name
+    with ThreadPoolExecutor(jobs) as executor:
+        while pending or running:
+            for name in list(pending):
+                deps = stages[name].deps
+                if deps & failed:
+                    print('[%s] skipped, since %s failed' % (name, ', '.join(sorted(deps & failed))))
+                    failed.add(name)
+                    pending.remove(name)
+                elif deps <= finished and len(running) < jobs:
+                    running[executor.submit(run_stage, stages[name], state, log_dir, force)] = name
+                    pending.remove(name)
+            if not running:
+                continue
+            done, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in done:
+                name = running.pop(future)
+                try:
+                    future.result()
+                    finished.add(name)
+                except (RuntimeError, FileNotFoundError) as e:
+                    print('[%s] %s' % (name, e))
+                    failed.add(name)
+    return failed
+
+def main():
+    parser = argparse.ArgumentParser(description='Runs the stages of pipeline.json that are out of date.')
+    parser.add_argument('stages', nargs='*', help="Stages to bring up to date (by default all of them).")
+    parser.add_argument('--config', default=os.path.join(REPO_DIR, 'pipeline.json'))
+    parser.add_argument('--state', default='cache/pipeline_state.json',
+        help="File recording the fingerprint of each stage's last successful run.")
+    parser.add_argument('--log_dir', default='cache/pipeline_logs', help="Directory for the output of each stage.")
+    parser.add_argument('--jobs', default=2, type=int, help="Number of stages run at the same time.")
+    parser.add_argument('--set', action='append', default=[], metavar='PARAM=VALUE',
+        help="Override a parameter of pipeline.json, e.g. --set num_topics=50.")
+    parser.add_argument('--dry_run', action='store_true', help="Only print which stages would run.")
+    parser.add_argument('--force', action='store_true', help="Run the stages even if they are up to date.")
+    args = parser.parse_args()
+
+    overrides = dict(s.split('=', 1) for s in args.set)
+    stages = load_stages(args.config, overrides)
+    unknown = [name for name in args.stages if name not in stages]
+    if unknown:
+        parser.error('unknown stages: %s (choose from %s)' % (', '.join(unknown), ', '.join(stages)))
+    order = get_order(stages, args.stages or list(stages))
+    os.makedirs(os.path.dirname(args.state) or '.', exist_ok=True)
+    state = PipelineState(args.state)
+    if args.dry_run:
+        dry_run(stages, order, state)
+        return
+    failed = run(stages, order, state, args.jobs, args.log_dir, force=args.force)
+    if failed:
+        print('Failed:', ', '.join(sorted(failed)))
+        sys.exit(1)
+
+if __name__ == '__main__':
+    main()
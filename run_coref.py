@@ -6,13 +6,22 @@ import spacy
 import neuralcoref
 import argparse
 import os
+from multiprocessing import Pool
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True)
 parser.add_argument('--output_dir', required=True)
+parser.add_argument('--batch_size', default=100, type=int,
+    help="Number of lines SpaCy parses at a time.")
+parser.add_argument('--n_process', default=1, type=int,
+    help="Number of worker processes; each resolves one book at a time.")
+parser.add_argument('--metrics_file', default=None,
+    help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
+MANIFEST = 'coref_manifest.json'
+
 possessives = {'his', 'her', 'its', 'their', 'hers', 'theirs'}
 
 def lowercase_if_not_entity(span):
@@ -53,29 +62,79 @@ def get_resolved(doc, clusters):
     return ''.join(resolved)
 
 
-def main():
+# set in each worker by init_worker
+nlp = None
+
+def init_worker():
+    global nlp
     # Load your usual SpaCy model (one of SpaCy English models)
     nlp = spacy.load('en_core_web_sm')
 
     # Add neural coref to SpaCy's pipe
     neuralcoref.add_to_pipe(nlp, blacklist=True)
 
+def resolve_book(task):
+    '''
+    Resolves coref in one book. The output is written to a temporary file
+    that replaces the book's output file only once the book is finished.
+    @inputs:
+    - task: (title, Book, input hash)
+    @output:
+    - title, input hash, and timings and counts from MetricsRecord
+    '''
+    title, textbook_lines, input_hash = task
+    stats = MetricsRecord()
+    out_path = os.path.join(args.output_dir, title)
+    with codecs.open(out_path + '.tmp', 'w', encoding='utf-8') as f:
+        docs = nlp.pipe(textbook_lines, batch_size=args.batch_size)
+        for doc in stats.timed(docs, 'spacy', rest='python'):
+            stats.count('lines')
+            stats.count('tokens', len(doc))
+            f.write(get_resolved(doc, doc._.coref_clusters) + '\n')
+    os.replace(out_path + '.tmp', out_path)
+    return title, input_hash, stats.get_stats()
+
+def main():
+    metrics = Metrics(args.metrics_file)
     # load books
-    books = get_book_txts(args.input_dir, splitlines=True)
+    books = get_books(args.input_dir)
 
     print('Resolving coref...')
     os.makedirs(args.output_dir, exist_ok=True)
+    # title : hash of the input of each finished book
+    manifest_path = os.path.join(args.output_dir, MANIFEST)
+    manifest = {}
+    if os.path.isfile(manifest_path):
+        with open(manifest_path, 'r') as infile:
+            manifest = json.load(infile)
+    tasks = []
     for title, textbook_lines in books.items():
+        input_hash = get_file_hash(textbook_lines.path)
+        if manifest.get(title) == input_hash and os.path.isfile(os.path.join(args.output_dir, title)):
+            print('Skipping', title)
+            continue
+        manifest.pop(title, None)
+        tasks.append((title, textbook_lines, input_hash))
+
+    pool = None
+    if args.n_process > 1:
+        pool = Pool(args.n_process, initializer=init_worker)
+        results = pool.imap_unordered(resolve_book, tasks)
+    elif tasks:
+        init_worker()
+        results = map(resolve_book, tasks)
+    else:
+        results = []
+    for title, input_hash, stats in results:
         print(title)
-        with codecs.open(os.path.join(args.output_dir, title), 'w', encoding='utf-8') as f:
-            for line in textbook_lines:
-                doc = nlp(line)
-                f.write(get_resolved(doc, doc._.coref_clusters) + '\n')
+        with metrics.record('book', title=title) as record:
+            record.update(stats)
+        manifest[title] = input_hash
+        write_json_atomic(manifest_path, manifest)
+    if pool is not None:
+        pool.close()
+        pool.join()
+    metrics.close(n_process=args.n_process, skipped=len(books) - len(tasks))
 
 if __name__ == '__main__':
     main()
-
-
-
-
-
@@ -3,83 +3,318 @@
 # Author: Dora Demszky (ddemszky@stanford.edu)
 import argparse
 import gensim.corpora as corpora
-from gensim.models.wrappers import LdaMallet
-from gensim.models import CoherenceModel
+from gensim.models import LdaMulticore
+from gensim import matutils
 from helpers import *
+from coherence import get_index, score_topic_sets
 import nltk
 import json
+import csv
+import functools
+import hashlib
+import shutil
+from array import array
+from concurrent.futures import ThreadPoolExecutor, as_completed
+
+def parse_values(value, minimum=1):
+    '''
+    "50" -> [50], "20,50,100" -> [20, 50, 100], and
+    "20:100:20" -> [20, 40, 60, 80, 100] (start:stop:step, including stop),
+    rejecting values below minimum
+    '''
+    values = []
+    try:
+        for part in value.split(','):
+            if ':' in part:
+                start, stop, step = (int(v) for v in (part.split(':') + ['1'])[:3])
+                if step <= 0:
+                    raise argparse.ArgumentTypeError("step must be positive, got %r" % part)
+                values.extend(range(start, stop + 1, step))
+            else:
+                values.append(int(part))
+    except ValueError:
+        raise argparse.ArgumentTypeError("expected numbers like 50, 20,50,100 or 20:100:20, got %r" % value)
+    if not values:
+        raise argparse.ArgumentTypeError("%r gives no values (is start greater than stop?)" % value)
+    if min(values) < minimum:
+        raise argparse.ArgumentTypeError("values must be at least %d, got %r" % (minimum, value))
+    return values
 
 parser = argparse.ArgumentParser()
 
-parser.add_argument('--mallet_dir', required=True, help="Location of MALLET binary file.")
+parser.add_argument('--engine', default='mallet', choices=['mallet', 'gensim'],
+                    help="Run LDA with MALLET, or in-process with gensim's LdaMulticore (no Java needed).")
+parser.add_argument('--mallet_dir', help="Location of MALLET binary file.")
 parser.add_argument('--input_dir', required=True, help="Directory of input text files.")
 parser.add_argument('--output_dir', required=True, help="Directory for the topic model.")
-parser.add_argument('--num_topics', default=100, type=int, help="Number of topics to induce.")
+parser.add_argument('--num_topics', default=[100], type=parse_values,
+                    help="Number of topics to induce, or several to sweep over, e.g. 20,50,100 or 20:100:20.")
+parser.add_argument('--seeds', default=[42], type=functools.partial(parse_values, minimum=0),
+                    help="Random seed, or several (e.g. 1,2,3); every number of topics is run with each.")
 parser.add_argument('--stem', action='store_true', help="Whether to stem words before running the topic model "
                                                         "(in the paper, we do).")
+parser.add_argument('--cores', default=os.cpu_count(), type=int,
+                    help="Cores to share between the topic models trained at the same time.")
+parser.add_argument('--workers', default=None, type=int, help="Cores per topic model (by default 4 for MALLET, "
+                                                              "and all of them for gensim, which trains one at a time).")
+parser.add_argument('--passes', default=10, type=int, help="Passes over the corpus for the gensim engine.")
+parser.add_argument('--corpus_cache', default='cache/lda_corpus',
+                    help="Directory for the cleaned sentences as word ids, reused by later runs on the same books.")
+parser.add_argument('--coherence_cache', default='cache/coherence',
+                    help="Directory for the sliding-window index used to score topic coherence.")
+parser.add_argument('--summary_file', default=None,
+                    help="CSV file with the coherence and training time of each model "
+                         "(by default, sweep_summary.csv in output_dir).")
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
+if args.engine == 'mallet' and args.mallet_dir is None:
+    parser.error("--engine mallet requires --mallet_dir.")
+
+
+class StreamedCorpus:
+    '''
+    The cleaned sentences of all books, stored by build_corpus as one array
+    of word ids with the offset of each sentence, along with their gensim
+    Dictionary. The arrays are memory-mapped, and iterating gives each
+    sentence's bag of words, the same as id2word.doc2bow, so the corpus is
+    streamed to the topic models rather than held in memory as lists. It
+    can be iterated any number of times, also by several threads at once.
+    '''
+    def __init__(self, path, chunk_size=10000):
+        self.path = path
+        self.chunk_size = chunk_size
+        self.tokens = np.load(os.path.join(path, 'tokens.npy'), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, 'offsets.npy'), mmap_mode='r')
+        self.id2word = corpora.Dictionary.load(os.path.join(path, 'dictionary.dict'))
+        with open(os.path.join(path, 'book_start_end.json'), 'r') as infile:
+            self.start_end = json.load(infile)
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def chunks(self):
+        '''
+        Yields (offsets, tokens) of chunk_size sentences at a time, with the
+        offsets counted from the start of the chunk.
+        '''
+        for start in range(0, len(self), self.chunk_size):
+            offsets = np.array(self.offsets[start:start + self.chunk_size + 1])
+            yield offsets - offsets[0], np.array(self.tokens[offsets[0]:offsets[-1]])
+
+    def __iter__(self):
+        vocab_size = max(len(self.id2word), 1)
+        for offsets, tokens in self.chunks():
+            # counts of each (sentence, word) pair, sorted like doc2bow
+            docs = np.repeat(np.arange(len(offsets) - 1), np.diff(offsets))
+            pairs, counts = np.unique(docs * vocab_size + tokens, return_counts=True)
+            bounds = np.searchsorted(pairs // vocab_size, np.arange(len(offsets))).tolist()
+            words, counts = (pairs % vocab_size).tolist(), counts.tolist()
+            for start, end in zip(bounds[:-1], bounds[1:]):
+                yield list(zip(words[start:end], counts[start:end]))
+
+    def iter_texts(self):
+        '''
+        Yields each sentence as its list of words.
+        '''
+        id2token = [self.id2word[i] for i in range(len(self.id2word))]
+        for offsets, tokens in self.chunks():
+            words = [id2token[t] for t in tokens.tolist()]
+            for start, end in zip(offsets[:-1].tolist(), offsets[1:].tolist()):
+                yield words[start:end]
+
+def get_corpus_key(books):
+    '''
+    Hash of the contents of the books and of how they are cleaned.
+    '''
+    h = hashlib.sha1(('stem=%s' % args.stem).encode('ascii'))
+    for title, book in books.items():
+        h.update(('%s:%s\n' % (title, get_file_hash(book.path))).encode('utf-8'))
+    return h.hexdigest()[:16]
+
+def build_corpus(books, path, metrics):
+    '''
+    Cleans the books a sentence at a time and writes them to the directory
+    path as a StreamedCorpus. Only one book's sentences are held in memory
+    at once. Word ids are the same as those of corpora.Dictionary(all_sentences).
+    '''
+    cleaner = TextCleaner(stem=args.stem)
+    id2word = corpora.Dictionary()
+    tokens = array('i')
+    offsets = array('q', [0])
+    start_end_dict = {}
+    for title, book in books.items():
+        print(title)
+        with metrics.record('clean', title=title) as record:
+            sents = [s for line in book for s in nltk.sent_tokenize(line)]
+            start = len(offsets) - 1
+            for words in cleaner.clean_many(sents):
+                # adds new words as Dictionary(all_sentences) would, but never
+                # prunes, so that ids stay the same once sentences are encoded
+                id2word.doc2bow(words, allow_update=True)
+                tokens.extend(id2word.token2id[w] for w in words)
+                offsets.append(len(tokens))
+            record.count('sentences', len(sents))
+        start_end_dict[title] = (start, start + len(sents) - 1)
+
+    tmp_path = path + '.tmp'
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    np.save(os.path.join(tmp_path, 'tokens.npy'), np.frombuffer(tokens, dtype=np.int32))
+    np.save(os.path.join(tmp_path, 'offsets.npy'), np.frombuffer(offsets, dtype=np.int64))
+    id2word.save(os.path.join(tmp_path, 'dictionary.dict'))
+    with open(os.path.join(tmp_path, 'book_start_end.json'), 'w') as f:
+        f.write(json.dumps(start_end_dict))
+    shutil.rmtree(path, ignore_errors=True)
+    os.replace(tmp_path, path)
+
+def get_budget(num_models):
+    '''
+    @output:
+    - cores per model, and number of models to train at a time, so that
+    together they use at most args.cores cores
+    '''
+    if args.engine == 'gensim':
+        # LdaMulticore forks its worker processes, which is not safe from
+        # several threads at once, so models are trained one after another
+        return args.workers or args.cores, 1
+    workers = args.workers or min(4, args.cores)
+    return workers, max(min(num_models, args.cores // workers), 1)
+
+def get_run_name(num, seed):
+    # a single seed keeps the names of one model per number of topics
+    return str(num) if len(args.seeds) == 1 else '%d_seed%d' % (num, seed)
+
+def train_gensim(num, seed, corpus, id2word, prefix, workers):
+    '''
+    Trains LDA in-process, with one core for the main process and the rest
+    for LdaMulticore's workers, and writes the same doctopics.txt and
+    topickeys.txt files that LdaMallet leaves behind.
+    '''
+    lda = LdaMulticore(corpus=corpus,
+                       num_topics=num,
+                       id2word=id2word,
+                       workers=max(workers - 1, 1),
+                       passes=args.passes,
+                       eval_every=None,
+                       random_state=seed)
+    write_mallet_topics(lda, corpus, prefix + 'doctopics.txt', prefix + 'topickeys.txt',
+                        token=id2word.__getitem__, num_top_words=20)
+    return lda
 
-def get_topics(num, corpus, id2word, output_dir, all_sentences):
-    print(num)
-    ldamallet = LdaMallet(args.mallet_dir,
-                          corpus=corpus,
-                          num_topics=num,
-                          prefix=output_dir + "/" + str(num),
-                          workers=4,
-                          id2word=id2word,
-                          iterations=1000,
-                          random_seed=42)
-    coherence_model_ldamallet = CoherenceModel(model=ldamallet,
-                                               texts=all_sentences,
-                                               dictionary=id2word,
-                                               coherence='c_v')
-    coherence_ldamallet = coherence_model_ldamallet.get_coherence()
-    print('\nCoherence Score: ', coherence_ldamallet)
+def get_topic_words(model, id2word, topn=20):
+    '''
+    The topn most probable words of each topic, as gensim's CoherenceModel takes them.
+    '''
+    return [[id2word[i] for i in matutils.argsort(topic, topn=topn, reverse=True)]
+            for topic in model.get_topics()]
+
+def get_topics(num, seed, corpus, id2word, output_dir, workers):
+    '''
+    Trains and saves one topic model.
+    @output:
+    - top words of each topic, for scoring coherence
+    - stats of a MetricsRecord timing the training
+    '''
+    print("Training %d topics with seed %d" % (num, seed))
+    record = MetricsRecord()
+    prefix = output_dir + "/" + get_run_name(num, seed)
+    if args.engine == 'gensim':
+        ldamallet = train_gensim(num, seed, corpus, id2word, prefix, workers)
+    else:
+        # gensim 4 no longer has the MALLET wrapper, which --engine gensim does not need
+        from gensim.models.wrappers import LdaMallet
+        ldamallet = LdaMallet(args.mallet_dir,
+                              corpus=corpus,
+                              num_topics=num,
+                              prefix=prefix,
+                              workers=workers,
+                              id2word=id2word,
+                              iterations=1000,
+                              random_seed=seed)
     keywords = {i: ", ".join([word for word, prop in ldamallet.show_topic(i)]) for i in range(ldamallet.num_topics)}
-    with open(output_dir + "/" + str(num) + '_words.json', 'w') as f:
+    with open(prefix + '_words.json', 'w') as f:
         f.write(json.dumps(keywords))
-    ldamallet.save(output_dir + "/" + str(num))
+    ldamallet.save(prefix)
     #ldamallet.show_topics(num_topics=num, formatted=True)
-    return coherence_ldamallet
+    return get_topic_words(ldamallet, id2word), record.get_stats()
+
+def train_all(configs, corpus, id2word, workers, jobs):
+    '''
+    Trains a topic model for each (num_topics, seed) in configs, jobs at a
+    time in threads (each MALLET run is a process of its own).
+    @output:
+    - yields (num_topics, seed) and the output of get_topics, as each model
+    is done
+    '''
+    if jobs == 1:
+        for num, seed in configs:
+            yield (num, seed), get_topics(num, seed, corpus, id2word, args.output_dir, workers)
+        return
+    with ThreadPoolExecutor(jobs) as executor:
+        futures = {executor.submit(get_topics, num, seed, corpus, id2word, args.output_dir, workers): (num, seed)
+                   for num, seed in configs}
+        for future in as_completed(futures):
+            yield futures[future], future.result()
+
+def write_summary(filename, rows):
+    with open(filename, 'w') as outfile:
+        writer = csv.DictWriter(outfile, fieldnames=['num_topics', 'seed', 'engine', 'workers',
+                                                     'coherence', 'train_seconds'])
+        writer.writeheader()
+        for row in rows:
+            writer.writerow(row)
 
 
 def main():
+    metrics = Metrics(args.metrics_file)
     print("Loading books...")
-    books = get_book_txts(args.input_dir, splitlines=False)
+    books = get_books(args.input_dir)
 
-    print("Cleaning and combining texts...")
-    all_sentences = []
-    start_end = []
-    prev = 0
-    for title, book in books.items():
-        print(title)
-        sents = nltk.sent_tokenize(book)
-        start = prev
-        for i, s in enumerate(sents):
-            all_sentences.append(clean_text(s, stem=args.stem))
-        end = start + len(sents) - 1
-        start_end.append((title, start, end))
-        prev = end + 1
-
-    start_end_dict = {}
-    for tup in start_end:
-        start_end_dict[tup[0]] = (tup[1], tup[2])
+    key = get_corpus_key(books)
+    corpus_path = os.path.join(args.corpus_cache, key)
+    if os.path.isdir(corpus_path):
+        print("Reading cleaned texts from %s..." % corpus_path)
+    else:
+        print("Cleaning and combining texts...")
+        os.makedirs(args.corpus_cache, exist_ok=True)
+        build_corpus(books, corpus_path, metrics)
+    corpus = StreamedCorpus(corpus_path)
+    id2word = corpus.id2word
     with open(args.output_dir + '/book_start_end.json', 'w') as f:
-        f.write(json.dumps(start_end_dict))
+        f.write(json.dumps(corpus.start_end))
+    id2word.save(args.output_dir + '/dictionary.dict')
 
-    print("%d sentences total" % len(all_sentences))
+    print("%d sentences total" % len(corpus))
 
-    print("Creating dictionary...")
-    id2word = corpora.Dictionary(all_sentences)
-    id2word.save(args.output_dir + '/dictionary.dict')
+    print("Indexing windows for topic coherence...")
+    with metrics.record('coherence_index') as record:
+        coherence_index = get_index(corpus.iter_texts(), args.coherence_cache, key=key)
+        record.count('windows', coherence_index.num_windows)
 
-    print("Getting term-document frequencies...")
-    corpus = [id2word.doc2bow(t) for t in all_sentences]
+    # every model shares the prepared corpus
+    configs = [(num, seed) for num in args.num_topics for seed in args.seeds]
+    workers, jobs = get_budget(len(configs))
+    print("Running %d topic models, %d at a time with %d cores each..." % (len(configs), jobs, workers))
+    results = {}
+    for (num, seed), result in train_all(configs, corpus, id2word, workers, jobs):
+        results[num, seed] = result
+        record = metrics.record('train', num_topics=num, seed=seed, engine=args.engine, workers=workers)
+        record.update(result[1])
+        record.write(result[1]['seconds'])
 
-    print("Running topic model with %d topics..." % args.num_topics)
-    get_topics(args.num_topics, corpus, id2word, args.output_dir, all_sentences)
+    print("Scoring topic coherence...")
+    with metrics.record('coherence', models=len(configs)):
+        coherences = score_topic_sets(coherence_index, [results[c][0] for c in configs], processes=args.cores)
+    rows = []
+    for (num, seed), scores in zip(configs, coherences):
+        coherence = float(np.mean(scores))
+        print('%d topics, seed %d. Coherence Score: %f' % (num, seed, coherence))
+        rows.append({'num_topics': num, 'seed': seed, 'engine': args.engine, 'workers': workers,
+                     'coherence': coherence, 'train_seconds': round(results[num, seed][1]['seconds'], 3)})
+    write_summary(args.summary_file or os.path.join(args.output_dir, 'sweep_summary.csv'), rows)
+    metrics.close(cores=args.cores, jobs=jobs)
 
 
 if __name__ == '__main__':
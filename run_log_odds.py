@@ -1,10 +1,12 @@
 """
-Calculate log odds for two groups of descriptors. 
+Calculate log odds for two groups of descriptors.
 """
 
 import os
+import re
 import json
-from collections import defaultdict, Counter
+from array import array
+import numpy as np
 import helpers
 import string
 import argparse
@@ -13,63 +15,132 @@ parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_file', required=True)
 parser.add_argument('--output_dir', required=True)
-parser.add_argument('--group1', required=True)
-parser.add_argument('--group2', required=True)
+parser.add_argument('--group1', help="Comma-separated categories of the first group.")
+parser.add_argument('--group2', help="Comma-separated categories of the second group.")
+parser.add_argument('--comparisons', help="JSON file of comparison names to "
+                    "{\"group1\": [categories], \"group2\": [categories]}.")
+parser.add_argument('--one_vs_rest', action='store_true', help="Compare every category with all the others.")
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
-group1 = args.group1.split(',')
-group2 = args.group2.split(',')
+if (args.group1 is None) != (args.group2 is None):
+    parser.error("--group1 and --group2 go together.")
+if args.group1 is None and args.comparisons is None and not args.one_vs_rest:
+    parser.error("Give --group1 and --group2, --comparisons, or --one_vs_rest.")
 
-def write_out_log_odds():
-    translator = str.maketrans('', '', string.punctuation)
-    marked = set() # word IDs associated with group 1
-    all_count = Counter() # {(id, word) : count}
-    group1_count = Counter()
-    group2_count = Counter()
-    with open(args.input_file, 'r') as infile: 
-        for line in infile:
-            contents = line.strip().split(',')
-            word = contents[4]
-            proc_word = word.translate(translator)
-            if proc_word == '': continue
-            if contents[3] in group1: 
-                group1_count[proc_word] += 1
-                marked.add(contents[0] + contents[1])
-    # we open the file twice to avoid overlap w/ group 1
-    with open(args.input_file, 'r') as infile: 
-        for line in infile:
-            contents = line.strip().split(',')
-            word = contents[4]
-            proc_word = word.translate(translator)
-            if proc_word == '': continue
-            if contents[3] in group2 and (contents[0] + contents[1]) not in marked: 
-                group2_count[word] += 1
-            all_count[word] += 1
+class DescriptorCounts:
+    '''
+    The descriptors of people_descriptors.csv, read once and integer-encoded,
+    so that any number of groups can be compared without reading it again.
+    Words are counted both as they are and without punctuation, in one
+    vocabulary.
+    @inputs:
+    - input_file: path of people_descriptors.csv
+    '''
+    def __init__(self, input_file):
+        translator = str.maketrans('', '', string.punctuation)
+        self.word2id = {}
+        self.category2id = {}
+        title2id = {}
+        titles, tokens, categories, words, proc_words = array('q'), array('q'), array('i'), array('i'), array('i')
+        with open(input_file, 'r') as infile:
+            for line in infile:
+                contents = line.strip().split(',')
+                word = contents[4]
+                proc_word = word.translate(translator)
+                if proc_word == '': continue
+                try:
+                    token = int(contents[0])
+                except ValueError:
+                    continue # e.g. a header row
+                titles.append(title2id.setdefault(contents[1], len(title2id)))
+                tokens.append(token)
+                categories.append(self.category2id.setdefault(contents[3], len(self.category2id)))
+                words.append(self.word2id.setdefault(word, len(self.word2id)))
+                proc_words.append(self.word2id.setdefault(proc_word, len(self.word2id)))
+        self.categories = np.frombuffer(categories, dtype=np.int32)
+        self.words = np.frombuffer(words, dtype=np.int32)
+        self.proc_words = np.frombuffer(proc_words, dtype=np.int32)
+        # a person is a token of a book, which may have several categories
+        mentions = np.frombuffer(titles, dtype=np.int64) << 32 | np.frombuffer(tokens, dtype=np.int64)
+        _, self.mentions = np.unique(mentions, return_inverse=True)
+        self.num_mentions = int(self.mentions.max()) + 1 if len(self.mentions) else 0
+        # the vocabulary is every word as written, in order of appearance
+        uniq, first = np.unique(self.words, return_index=True)
+        self.vocab_ids = uniq[np.argsort(first)]
+        id2word = {i: w for w, i in self.word2id.items()}
+        self.vocab = [id2word[i] for i in self.vocab_ids]
+        self.all_count = np.bincount(self.words, minlength=len(self.word2id))[self.vocab_ids]
+
+    def __len__(self):
+        return len(self.words)
+
+    def get_mask(self, group):
+        ids = [self.category2id[c] for c in group if c in self.category2id]
+        return np.isin(self.categories, ids)
+
+    def compare(self, group1, group2):
+        '''
+        Counts the descriptors of two groups of categories. If a person falls
+        under both groups, their descriptors only count for the first.
+        @output:
+        - counts of group 1 and group 2, aligned with self.vocab
+        '''
+        in_group1 = self.get_mask(group1)
+        marked = np.zeros(self.num_mentions, dtype=bool)
+        marked[self.mentions[in_group1]] = True
+        in_group2 = self.get_mask(group2) & ~marked[self.mentions]
+        # group 1 is counted without punctuation, but looked up with the words as written
+        group1_count = np.bincount(self.proc_words[in_group1], minlength=len(self.word2id))
+        group2_count = np.bincount(self.words[in_group2], minlength=len(self.word2id))
+        return group1_count[self.vocab_ids], group2_count[self.vocab_ids]
+
+def get_comparisons():
+    '''
+    @output:
+    - list of (output file name, group 1, group 2)
+    '''
+    comparisons = []
+    if args.group1 is not None:
+        comparisons.append(('log_odds.txt', args.group1.split(','), args.group2.split(',')))
+    if args.comparisons is not None:
+        with open(args.comparisons, 'r') as infile:
+            for name, groups in json.load(infile).items():
+                group1, group2 = groups['group1'], groups['group2']
+                if isinstance(group1, str): group1 = group1.split(',')
+                if isinstance(group2, str): group2 = group2.split(',')
+                comparisons.append((get_filename(name), group1, group2))
+    return comparisons
 
-    with open(os.path.join(args.output_dir, 'group1_counts.txt'), 'w') as outfile: 
-        for word in all_count: 
-            outfile.write(str(group1_count[word]) + ' ' + word + '\n')
-    with open(os.path.join(args.output_dir, 'group2_counts.txt'), 'w') as outfile: 
-        for word in all_count: 
-            outfile.write(str(group2_count[word]) + ' ' + word + '\n')
-    with open(os.path.join(args.output_dir, 'all_counts.txt'), 'w') as outfile: 
-        for word in all_count: 
-            outfile.write(str(all_count[word]) + ' ' + word + '\n')
+def get_filename(name):
+    return 'log_odds_' + re.sub(r'[^\w\-]+', '_', name) + '.txt'
 
-def descriptor_log_odds(): 
+def descriptor_log_odds(vocab, group1_count, group2_count, all_count, filename):
     '''
     Runs log odds on people descriptors, which
     is the output of main_people_descriptors().
     '''
-    os.system('python ./bayesequal.py -f ' + os.path.join(args.output_dir, 'group1_counts.txt') + \
-        ' -s ' + os.path.join(args.output_dir, 'group2_counts.txt') + \
-        ' -p ' + os.path.join(args.output_dir, 'all_counts.txt') + ' > ' + \
-        os.path.join(args.output_dir, 'log_odds.txt'))
+    scores = helpers.get_log_odds(group1_count, group2_count, all_count)
+    with open(os.path.join(args.output_dir, filename), 'w') as outfile:
+        for line in helpers.format_log_odds(vocab, scores):
+            outfile.write(line + '\n')
 
-def main(): 
-	write_out_log_odds()                                     
-	descriptor_log_odds()
+def main():
+	metrics = helpers.Metrics(args.metrics_file)
+	with metrics.record('count') as record:
+		counts = DescriptorCounts(args.input_file)
+		record.count('descriptors', len(counts))
+	comparisons = get_comparisons()
+	if args.one_vs_rest:
+		for category in counts.category2id:
+			rest = [c for c in counts.category2id if c != category]
+			comparisons.append((get_filename(category + '_vs_rest'), [category], rest))
+	for filename, group1, group2 in comparisons:
+		with metrics.record('scores', comparison=filename) as record:
+			descriptor_log_odds(counts.vocab, *counts.compare(group1, group2), counts.all_count, filename)
+			record.count('words', len(counts.vocab))
+	metrics.close(comparisons=len(comparisons))
 
 if __name__ == '__main__':
-    main()
\ No newline at end of file
+    main()
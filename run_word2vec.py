@@ -6,10 +6,12 @@ from helpers import *
 import nltk
 import numpy as np
 import codecs
-from collections import Counter
+from multiprocessing import Pool
 from nltk.corpus import stopwords
 import argparse
+import functools
 import os
+import zlib
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_dir', required=True, help="Directory of input text files.")
@@ -20,20 +22,93 @@ parser.add_argument('--window', default=5, type=int, help="Window size for word2
 parser.add_argument('--stem', action='store_true', help="Whether to stem words (in the paper, we don't).")
 parser.add_argument('--bootstrap', action='store_true', help="Whether to bootstrap sample from sentences in the data "
                                                              "(in the paper, we do).")
+parser.add_argument('--num_procs', default=1, type=int, help="Number of training runs to run at the same time.")
+parser.add_argument('--workers', default=10, type=int, help="Number of worker threads for each training run "
+                                                            "(set to 1 for models that are the same on every run).")
+parser.add_argument('--seed', default=42, type=int, help="Random seed; run i uses seed + i.")
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
 stopwords = set(stopwords.words('english'))
 
+cleaner = TextCleaner(stem=args.stem, remove_stopwords=False, remove_short=False)
+
 def get_sentences(book):
-    sents = nltk.sent_tokenize(book)
-    return [clean_text(s, stem=args.stem, remove_stopwords=False, remove_short=False) for s in sents]
+    sents = (s for line in book for s in nltk.sent_tokenize(line))
+    return list(cleaner.clean_many(sents))
+
+# (tokens, offsets, id2word) of the phrased corpus, set in each worker by init_worker
+corpus = None
+
+def init_worker(tokens, offsets, id2word):
+    global corpus
+    corpus = (tokens, offsets, id2word)
+
+class SampledSentences:
+    """Sentences of the encoded corpus at the given indices, as lists of words.
+    Can be iterated several times, as word2vec needs."""
+
+    def __init__(self, indices):
+        self.indices = indices
+
+    def __iter__(self):
+        tokens, offsets, id2word = corpus
+        for i in self.indices:
+            yield [id2word[t] for t in tokens[offsets[i]:offsets[i + 1]].tolist()]
 
-def run_on_all_books(books, bootstrap=True):
+def encode_sentences(sentences, bigrams):
+    """Applies the phrase model once to every sentence and encodes the result as integers.
+
+    Returns:
+        tokens: word ids of all sentences, one after another
+        offsets: start of each sentence in tokens, plus the total length
+        id2word: list of words in order of first occurrence
+    """
+    word2id = {}
+    tokens = []
+    offsets = [0]
+    for sent in sentences:
+        tokens.extend(word2id.setdefault(w, len(word2id)) for w in bigrams[sent])
+        offsets.append(len(tokens))
+    id2word = [None] * len(word2id)
+    for w, i in word2id.items():
+        id2word[i] = w
+    return np.array(tokens, dtype=np.int32), np.array(offsets, dtype=np.int64), id2word
+
+def stable_hash(text):
+    """Hash for seeding word vectors. Unlike the default, Python's hash(),
+    it does not change between processes (see PYTHONHASHSEED)."""
+    return zlib.crc32(text.encode('utf-8'))
+
+def train_run(run_idx, bootstrap=True):
+    """Trains and saves one word2vec model, seeded with args.seed + run_idx.
+
+    Returns:
+        run_idx, and timings and counts from MetricsRecord
+
+    """
+    stats = MetricsRecord()
+    tokens, offsets, id2word = corpus
+    num_sentences = len(offsets) - 1
+    seed = args.seed + run_idx
+    if bootstrap:
+        indices = np.random.RandomState(seed).randint(0, num_sentences, num_sentences)
+    else:
+        indices = range(num_sentences)
+    model = word2vec.Word2Vec(SampledSentences(indices), size=args.dim, window=args.window, sg=1, min_count=5,
+                              workers=args.workers, seed=seed, hashfxn=stable_hash)
+    model.wv.save(os.path.join(args.output_dir, str(run_idx) + '.wv'))
+    stats.count('sampled_sentences', len(indices))
+    stats.count('tokens', int(np.diff(offsets)[indices].sum()))
+    return run_idx, stats.get_stats()
+
+def run_on_all_books(books, metrics, bootstrap=True):
     """Runs word2vec training on data.
 
     Args:
-        books: dictionary of titles to text (str)
+        books: dictionary of titles to Books
+        metrics: Metrics of this run
         bootstrap: whether to bootstrap sample from the sentences
 
     """
@@ -42,34 +117,50 @@ def run_on_all_books(books, bootstrap=True):
     print("Getting sentences...")
     all_sentences = []
     for title, book in books.items():
-        all_sentences.extend(get_sentences(book))
+        with metrics.record('clean', title=title) as record:
+            sents = get_sentences(book)
+            record.count('sentences', len(sents))
+        all_sentences.extend(sents)
 
     # Create model
-    bigrams = phrases.Phrases(all_sentences, min_count=5, delimiter=b' ', common_terms=stopwords)
+    with metrics.record('phrases'):
+        bigrams = phrases.Phrases(all_sentences, min_count=5, delimiter=b' ', common_terms=stopwords)
+
+        # Merge phrases once; every run samples from the encoded sentences
+        print("Merging phrases...")
+        tokens, offsets, id2word = encode_sentences(all_sentences, phrases.Phraser(bigrams))
+    del all_sentences
 
     # Create vocabulary of bigrams
     print("Creating vocabulary...")
-    vocab = [w for sent in bigrams[all_sentences] for w in sent]
-    vocab = [w for w, count in Counter(vocab).most_common() if count >= 5]
+    counts = np.bincount(tokens, minlength=len(id2word))
+    vocab = [id2word[i] for i in np.argsort(-counts, kind='stable') if counts[i] >= 5]
 
     # Save vocab
     with codecs.open(os.path.join(args.output_dir, 'vocab.txt'), 'w', encoding='utf-8') as f:
         f.write('\n'.join(vocab))
 
     # Run word2vec model
-    for run_idx in range(args.num_runs):
-        print("Run #%d" % run_idx)
-        if bootstrap:
-            data = bigrams[np.random.choice(all_sentences, len(all_sentences), replace=True)]
-        else:
-            data = bigrams[all_sentences]
-        model = word2vec.Word2Vec(data, size=args.dim, window=args.window, sg=1, min_count=5, workers=10)
-        model.wv.save(os.path.join(args.output_dir, str(run_idx) + '.wv'))
+    run = functools.partial(train_run, bootstrap=bootstrap)
+    if args.num_procs > 1:
+        with Pool(args.num_procs, initializer=init_worker, initargs=(tokens, offsets, id2word)) as pool:
+            for run_idx, stats in pool.imap_unordered(run, range(args.num_runs)):
+                print("Finished run #%d" % run_idx)
+                with metrics.record('train', run=run_idx) as record:
+                    record.update(stats)
+    else:
+        init_worker(tokens, offsets, id2word)
+        for run_idx in range(args.num_runs):
+            print("Run #%d" % run_idx)
+            with metrics.record('train', run=run_idx) as record:
+                record.update(run(run_idx)[1])
 
 def main():
-    books = get_book_txts(args.input_dir, splitlines=False)
+    metrics = Metrics(args.metrics_file)
+    books = get_books(args.input_dir)
     os.makedirs(args.output_dir, exist_ok=True)
-    run_on_all_books(books, args.bootstrap)
+    run_on_all_books(books, metrics, args.bootstrap)
+    metrics.close(num_procs=args.num_procs, workers=args.workers)
 
 
 if __name__ == '__main__':
@@ -2,8 +2,8 @@
 # -*- coding: utf-8 -*-
 # Author: Dora Demszky (ddemszky@stanford.edu)
 import argparse
-import json
 import numpy as np
+from helpers import TopicArtifact, TOPIC_ARTIFACT
 
 parser = argparse.ArgumentParser()
 
@@ -26,17 +26,18 @@ def get_topics_for_word(words, topic_names):
 
 
 def main():
-    topic_names = json.load(open('%s/topic_names.json' % args.topic_dir, 'r'))
+    artifact = TopicArtifact('%s/%s' % (args.topic_dir, TOPIC_ARTIFACT))
+    topic_names = artifact.metadata['topic_names']
     print("Analyzing words: %s" % args.words)
-    dir = None
     if args.all_books:
-        dir = args.topic_dir
+        title = None
     elif not args.title:
         print("If you don't set --all_books, then you must specify a book title.")
+        return
     else:
-        dir = "%s/%s" % (args.topic_dir, args.title)
+        title = args.title
     topic_ids = get_topics_for_word(args.words.split(","), topic_names)
-    pmi = np.load(dir + '/pmi.npy')
+    pmi = artifact.get('pmi', title)
     val = np.mean([pmi[int(i),int(j)] for j in topic_ids for i in topic_ids if j != i])
     print("Score for group: %.3f" % val)
 
@@ -0,0 +1,262 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+'''
+Wikidata lookups shared by count_names.py and get_wikidata_attributes.py.
+
+WikidataLookup finds people by name and gets their gender, occupation and
+ethnic group. Names and IDs are looked up in batches (one SPARQL query with a
+VALUES clause per batch), several batches are sent at once, failed requests
+are retried with exponential backoff, and every answer is saved in a SQLite
+cache so that it is only ever requested once.
+
+The endpoint is pluggable. By default queries go to the public Wikidata
+endpoint, but the scripts' --endpoint argument can point to any other SPARQL
+endpoint, or to a JSON file of canned answers to run offline:
+
+{"people": {"Franklin D. Roosevelt": [["Franklin Delano Roosevelt", "Q8007"]]},
+ "properties": {"Q8007": {"sex or gender": ["male"], "occupation": ["politician"]}}}
+
+The same file can also be served over HTTP, e.g. for benchmarking with a
+simulated latency:
+
+python wikidata.py --fixture stub.json --port 8000 --latency 0.5
+'''
+import argparse
+import json
+import re
+import socket
+import sqlite3
+import time
+import urllib.parse
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.error import HTTPError, URLError
+from urllib.request import Request, urlopen
+
+WIKIDATA_ENDPOINT = "https://query.wikidata.org/sparql"
+USER_AGENT = "textbook-analysis (https://github.com/ddemszky/textbook-analysis)"
+RETRY_CODES = {429, 500, 502, 503, 504}
+
+def clean_entity(entity):
+    '''
+    Removes the characters that would break the quoted name in a query.
+    '''
+    return entity.replace("\"", "").replace("—", "").replace("\\","")
+
+def query_for_people(names):
+    values = " ".join("\"" + name + "\"@en" for name in names)
+    return "SELECT ?name ?item ?itemLabel WHERE {" + \
+    "VALUES ?name { " + values + " } " + \
+    "?item wdt:P31 wd:Q5." + \
+    "?item ?label ?name ." + \
+    "SERVICE wikibase:label { bd:serviceParam wikibase:language \"en\". }" + \
+    "}"
+
+def query_for_multiple_properties(people):
+    values = " ".join("wd:" + person for person in people)
+    return "SELECT ?person ?propLabel ?propertyLabel WHERE { " + \
+      "SERVICE wikibase:label { bd:serviceParam wikibase:language \"[AUTO_LANGUAGE],en\". } " + \
+      "VALUES ?person { " + values + " } " + \
+      "{?person wdt:P21 ?property. " + \
+      "?name ?ref wdt:P21. " + \
+      "?name rdfs:label ?propLabel} " + \
+      "UNION " + \
+      "{?person wdt:P106 ?property. " + \
+      "?name ?ref wdt:P106. " + \
+      "?name rdfs:label ?propLabel} " + \
+      "UNION " + \
+      "{?person wdt:P172 ?property. " + \
+      "?name ?ref wdt:P172. " + \
+      "?name rdfs:label ?propLabel} " + \
+      "FILTER((LANG(?propLabel)) = \"en\") " + \
+      "}"
+
+class SparqlEndpoint:
+    '''
+    Sends SPARQL queries over HTTP, retrying with exponential backoff when
+    the server is busy or the connection fails.
+    '''
+    def __init__(self, url=WIKIDATA_ENDPOINT, retries=5, backoff=1.0, timeout=60):
+        self.url = url
+        self.retries = retries
+        self.backoff = backoff
+        self.timeout = timeout
+
+    def query(self, sparql):
+        data = urllib.parse.urlencode({'query': sparql, 'format': 'json'}).encode('utf-8')
+        request = Request(self.url, data=data, headers={'User-Agent': USER_AGENT,
+                                                        'Accept': 'application/sparql-results+json'})
+        for attempt in range(self.retries + 1):
+            try:
+                with urlopen(request, timeout=self.timeout) as response:
+                    return json.loads(response.read())['results']['bindings']
+            # a read timeout is a socket.timeout, which before Python 3.10 is not a TimeoutError
+            except (HTTPError, URLError, socket.timeout, TimeoutError, ConnectionError) as e:
+                if attempt == self.retries or (isinstance(e, HTTPError) and e.code not in RETRY_CODES):
+                    raise
+                wait = self.backoff * 2 ** attempt
+                if isinstance(e, HTTPError) and (e.headers.get('Retry-After') or '').isdigit():
+                    wait = max(wait, int(e.headers['Retry-After']))
+                print("Request failed (%s), retrying in %.1fs..." % (e, wait))
+                time.sleep(wait)
+
+class StubEndpoint:
+    '''
+    Answers the queries built by this module from a JSON file of canned
+    answers (see the format at the top of this file), without any network.
+    '''
+    def __init__(self, fixture, latency=0.0):
+        with open(fixture, 'r') as infile:
+            answers = json.load(infile)
+        self.people = answers.get('people', {})
+        self.properties = answers.get('properties', {})
+        self.latency = latency
+
+    def query(self, sparql):
+        time.sleep(self.latency)
+        bindings = []
+        if 'VALUES ?name' in sparql:
+            for name in re.findall(r'"([^"]*)"@en', sparql.split('VALUES ?name', 1)[1].split('}', 1)[0]):
+                for label, wikiID in self.people.get(name, []):
+                    bindings.append({'name': {'type': 'literal', 'value': name},
+                                     'item': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + wikiID},
+                                     'itemLabel': {'type': 'literal', 'value': label}})
+        elif 'VALUES ?person' in sparql:
+            for wikiID in re.findall(r'wd:(Q\d+)', sparql.split('VALUES ?person', 1)[1].split('}', 1)[0]):
+                for label, values in self.properties.get(wikiID, {}).items():
+                    for value in values:
+                        bindings.append({'person': {'type': 'uri', 'value': 'http://www.wikidata.org/entity/' + wikiID},
+                                         'propLabel': {'type': 'literal', 'value': label},
+                                         'propertyLabel': {'type': 'literal', 'value': value}})
+        return bindings
+
+def get_endpoint(spec):
+    '''
+    A JSON file of canned answers gives a StubEndpoint, anything else is
+    taken to be the URL of a SPARQL endpoint.
+    '''
+    if spec.endswith('.json'):
+        return StubEndpoint(spec)
+    return SparqlEndpoint(spec)
+
+class WikidataCache:
+    '''
+    SQLite store of every answer already received, as JSON.
+    '''
+    def __init__(self, path):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute('CREATE TABLE IF NOT EXISTS people (name TEXT PRIMARY KEY, candidates TEXT)')
+        self.conn.execute('CREATE TABLE IF NOT EXISTS properties (wikiID TEXT PRIMARY KEY, properties TEXT)')
+        self.conn.commit()
+
+    def get(self, table, keys):
+        key_column, value_column = ('name', 'candidates') if table == 'people' else ('wikiID', 'properties')
+        found = {}
+        keys = list(keys)
+        for i in range(0, len(keys), 500):
+            batch = keys[i:i + 500]
+            rows = self.conn.execute('SELECT %s, %s FROM %s WHERE %s IN (%s)' % (
+                key_column, value_column, table, key_column, ','.join('?' * len(batch))), batch)
+            for key, value in rows:
+                found[key] = json.loads(value)
+        return found
+
+    def put(self, table, items):
+        self.conn.executemany('INSERT OR REPLACE INTO %s VALUES (?, ?)' % table,
+                              [(key, json.dumps(value)) for key, value in items.items()])
+        self.conn.commit()
+
+class WikidataLookup:
+    '''
+    Cached, batched and concurrent lookups of people on Wikidata.
+    @inputs:
+    - endpoint: a SparqlEndpoint or StubEndpoint
+    - cache_path: SQLite file for the cache (':memory:' to not keep it)
+    - batch_size: number of names or IDs per query
+    - max_requests: number of queries sent at the same time
+      (the public Wikidata endpoint allows 5 per IP address)
+    '''
+    def __init__(self, endpoint, cache_path='results/wikidata_cache.sqlite',
+                 batch_size=50, max_requests=4):
+        self.endpoint = endpoint
+        self.cache = WikidataCache(cache_path)
+        self.batch_size = batch_size
+        self.max_requests = max_requests
+        self.cache_hits = 0
+        self.requests = 0
+
+    def lookup(self, table, keys, make_query, parse_bindings):
+        keys = list(dict.fromkeys(keys))
+        found = self.cache.get(table, keys)
+        self.cache_hits += len(found)
+        missing = [k for k in keys if k not in found]
+        batches = [missing[i:i + self.batch_size] for i in range(0, len(missing), self.batch_size)]
+        if batches:
+            print("Querying Wikidata for %d %s in %d requests..." % (len(missing), table, len(batches)))
+            with ThreadPoolExecutor(self.max_requests) as executor:
+                results = executor.map(lambda batch: self.endpoint.query(make_query(batch)), batches)
+                for batch, bindings in zip(batches, results):
+                    self.requests += 1
+                    answers = parse_bindings(batch, bindings)
+                    self.cache.put(table, answers)
+                    found.update(answers)
+        return found
+
+    def find_people(self, names):
+        '''
+        Returns {name : [[label, wikiID], ...]}, with one candidate per match
+        in the order Wikidata returned them. names should already have been
+        passed through clean_entity.
+        '''
+        def parse_bindings(batch, bindings):
+            answers = {name: [] for name in batch}
+            for b in bindings:
+                wikiID = b['item']['value'].split('/')[-1]
+                label = b['itemLabel']['value'].split('/')[-1]
+                answers[b['name']['value']].append([label, wikiID])
+            return answers
+        return self.lookup('people', names, query_for_people, parse_bindings)
+
+    def get_properties(self, wikiIDs):
+        '''
+        Returns {wikiID : {property label : [values]}} for gender,
+        occupation and ethnic group.
+        '''
+        def parse_bindings(batch, bindings):
+            answers = {wikiID: {} for wikiID in batch}
+            for b in bindings:
+                wikiID = b['person']['value'].split('/')[-1]
+                label = b['propLabel']['value']
+                answers[wikiID].setdefault(label, []).append(b['propertyLabel']['value'])
+            return answers
+        return self.lookup('properties', wikiIDs, query_for_multiple_properties, parse_bindings)
+
+def serve_stub(stub, port):
+    class Handler(BaseHTTPRequestHandler):
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            form = urllib.parse.parse_qs(self.rfile.read(length).decode('utf-8'))
+            body = json.dumps({'results': {'bindings': stub.query(form['query'][0])}}).encode('utf-8')
+            self.send_response(200)
+            self.send_header('Content-Type', 'application/sparql-results+json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, format, *args):
+            pass
+
+    server = ThreadingHTTPServer(('localhost', port), Handler)
+    print("Serving stub Wikidata endpoint at http://localhost:%d/sparql" % port)
+    server.serve_forever()
+
+def main():
+    parser = argparse.ArgumentParser(description='Serves canned answers as a local stand-in for the Wikidata endpoint.')
+    parser.add_argument('--fixture', required=True, help="JSON file of canned answers.")
+    parser.add_argument('--port', default=8000, type=int)
+    parser.add_argument('--latency', default=0.0, type=float, help="Seconds to wait before answering each query.")
+    args = parser.parse_args()
+    serve_stub(StubEndpoint(args.fixture, latency=args.latency), args.port)
+
+if __name__ == '__main__':
+    main()
@@ -17,24 +17,44 @@ parser.add_argument('--name1', default="Group1", help="Name for group 1.")
 parser.add_argument('--name2', default="Group2", help="Name for group 2.")
 parser.add_argument('--word2vec_dir', required=True, help="Directory of models.")
 parser.add_argument('--output_file', default="results/word2vec_cosines.csv", help="Output csv file.")
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
+def get_similarities(words, query_words, models):
+    """Cosine similarity of every word to every query in every model.
+
+    Returns:
+        array of shape (number of models * number of words, number of queries),
+        where the rows are ordered by model and then by word
+    """
+    sims = np.empty((len(models), len(words), len(query_words)), dtype=np.float32)
+    for i, m in enumerate(models):
+        sims[i] = get_unit_vectors(m, words) @ get_unit_vectors(m, query_words).T
+    return sims.reshape(-1, len(query_words))
+
 def get_cosines(words1, words2, queries, models):
     df_w1 = []
     df_w2 = []
     df_q = []
     df_type = []
     df_pvals = []
+    query_words = list({q for values in queries.values() for q in values})
+    if query_words:
+        vals1 = get_similarities(words1, query_words, models)
+        vals2 = get_similarities(words2, query_words, models)
+        means1 = vals1.mean(axis=0, dtype=np.float64)
+        means2 = vals2.mean(axis=0, dtype=np.float64)
+        pvals = ttest_ind(vals1, vals2, axis=0)[1]
+    query2idx = {q: i for i, q in enumerate(query_words)}
     for key, values in queries.items():
         for q in values:
-            vals1 = [m.similarity(word1, q) for m in models for word1 in words1]
-            vals2 = [m.similarity(word2, q) for m in models for word2 in words2]
-            df_w1.append(np.mean(vals1))
-            df_w2.append(np.mean(vals2))
+            i = query2idx[q]
+            df_w1.append(means1[i])
+            df_w2.append(means2[i])
             df_q.append(q)
             df_type.append(key)
-            df_pvals.append(ttest_ind(vals1, vals2)[1])
+            df_pvals.append(pvals[i])
     df = pd.DataFrame({args.name1: df_w1, args.name2: df_w2, 'query': df_q, 'word category': df_type, "p value": df_pvals})
     return df
 
@@ -55,12 +75,15 @@ def main():
     with open(args.queries) as f:
         queries = json.load(f)
 
+    metrics = Metrics(args.metrics_file)
     print("Loading models...")
     filelist = []
     for subdir, dirs, files in os.walk(args.word2vec_dir):
         for file in files:
             filelist.append(os.path.join(subdir, file))
-    models = get_models(filelist)
+    with metrics.record('load_models') as record:
+        models = get_models(filelist)
+        record.count('models', len(models))
 
     # Get vocab
     vocab = set(models[0].vocab)
@@ -74,11 +97,14 @@ def main():
         queries[k] = filter_words(v, vocab)
 
     print("Calculating similarity...")
-    sims = get_cosines(words1, words2, queries, models)
+    with metrics.record('query') as record:
+        sims = get_cosines(words1, words2, queries, models)
+        record.count('queries', len(sims))
     print(sims.head())
 
     print("Saving file...")
     sims.to_csv(args.output_file, index=False)
+    metrics.close(vocab=len(vocab))
 
 
 if __name__ == '__main__':
@@ -3,40 +3,75 @@
 # Author: Dora Demszky (ddemszky@stanford.edu)
 import argparse
 import os
+import json
 import numpy as np
 from helpers import *
 parser = argparse.ArgumentParser()
 
 parser.add_argument('--input_file', default=None, help="Text file with input words.")
 parser.add_argument('--words', default=None, help="Comma-separated list of input words.")
+parser.add_argument('--queries', default=None, help="Dictionary file of names to lists of input words, "
+                                                    "to get the closest words for several groups at once.")
 parser.add_argument('--word2vec_dir', required=True, help="Directory for model output.")
+parser.add_argument('--top_k', default=20, type=int, help="Number of closest words to print.")
+parser.add_argument('--metrics_file', default=None, help="JSON-lines file to append timings and counts to.")
 
 args = parser.parse_args()
 
-def get_closest(queries, models, vocab, idx2word):
-    cosines = []
+def get_closest(query_sets, models, vocab, idx2word, top_k=20):
+    """Gets the words closest to each set of queries, on average across queries and models.
+
+    Args:
+        query_sets: dictionary of names to lists of query words
+        models: list of word2vec models
+        vocab: list of words shared by all models
+        idx2word: dictionary of vocab index to word
+
+    Returns:
+        dictionary of names to lists of (word, mean cosine similarity)
+    """
+    word2idx = {w: i for i, w in enumerate(vocab)}
+    names = list(query_sets)
+    cosines = np.zeros((len(vocab), len(names)))
     for m in models:
-        cosines.append([np.mean([m.similarity(q, word) for q in queries]) for word in vocab])
-    cosines = np.mean(np.array(cosines), axis=0)
-    return [(idx2word[idx], cosines[idx]) for idx in cosines.argsort()[-20:][::-1]]
+        vectors = get_unit_vectors(m, vocab)
+        # the mean cosine similarity to a set of queries is the dot product
+        # with the mean of the query vectors
+        query_means = np.array([vectors[[word2idx[q] for q in query_sets[name]]].mean(axis=0)
+                                for name in names])
+        cosines += vectors @ query_means.T
+    cosines /= len(models)
+    closest = {}
+    for i, name in enumerate(names):
+        k = min(top_k, len(vocab))
+        top = np.argpartition(-cosines[:, i], k - 1)[:k]
+        top = top[np.argsort(-cosines[top, i], kind='stable')]
+        closest[name] = [(idx2word[idx], cosines[idx, i]) for idx in top]
+    return closest
 
 def main():
     # Get queries
-    if args.input_file:
+    if args.queries:
+        with open(args.queries) as f:
+            query_sets = json.load(f)
+    elif args.input_file:
         with open(args.input_file) as f:
-            queries = f.read().splitlines()
+            query_sets = {args.input_file: f.read().splitlines()}
     elif args.words:
-        queries = [w.strip() for w in args.words.split(",")]
+        query_sets = {args.words: [w.strip() for w in args.words.split(",")]}
     else:
-        print("Either --input_file or --words must be specified.")
+        print("One of --queries, --input_file or --words must be specified.")
         return
 
+    metrics = Metrics(args.metrics_file)
     print("Loading models...")
     filelist = []
     for subdir, dirs, files in os.walk(args.word2vec_dir):
         for file in files:
             filelist.append(os.path.join(subdir, file))
-    models = get_models(filelist)
+    with metrics.record('load_models') as record:
+        models = get_models(filelist)
+        record.count('models', len(models))
 
     # Get vocab
     vocab = set(models[0].vocab)
@@ -44,21 +79,33 @@ def main():
         vocab &= set(m.vocab)
 
     # Remove queries not in vocab
-    queries = set(queries)
-    not_in_vocab = queries - vocab
-    if not_in_vocab:
-        print("Not in vocab:", not_in_vocab)
-    queries = list(queries - not_in_vocab)
+    for name, queries in list(query_sets.items()):
+        queries = set(queries)
+        not_in_vocab = queries - vocab
+        if not_in_vocab:
+            print("Not in vocab:", not_in_vocab)
+        if queries - not_in_vocab:
+            query_sets[name] = list(queries - not_in_vocab)
+        else:
+            print("Skipping %s: none of its words are in the vocab." % name)
+            del query_sets[name]
+    if not query_sets:
+        print("None of the query words are in the vocab.")
+        return
     vocab = list(vocab)
     idx2word = {i: w for i, w in enumerate(vocab)}
 
     print("Getting most similar words...")
-    closest = get_closest(queries, models, vocab, idx2word)
-    for (w, c) in closest:
-        print("%s %.2f" % (w, c))
+    with metrics.record('query') as record:
+        closest = get_closest(query_sets, models, vocab, idx2word, top_k=args.top_k)
+        record.count('queries', len(query_sets))
+    for name, words in closest.items():
+        if len(closest) > 1:
+            print("\n%s" % name)
+        for (w, c) in words:
+            print("%s %.2f" % (w, c))
+    metrics.close(vocab=len(vocab))
 
 
 if __name__ == '__main__':
     main()
-
-